@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+
+扫描流程基准测试
+    生成可复现的合成代码目录，分别统计遍历、分类、匹配、评估、报告输出各阶段的耗时，
+    结果保存为JSON，可以对比两次结果
+
+    python benchmarks/bench_scan.py -f ../kiwi_data -o before.json
+    python benchmarks/bench_scan.py -f ../kiwi_data -o after.json
+    python benchmarks/bench_scan.py --compare before.json after.json
+'''
+
+
+import os
+import sys
+import json
+import random
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kiwi.core.common import conf
+from kiwi.core.filemgr import filemgr
+from kiwi.core.filemgr import File
+from kiwi.core.featuremgr import featuremgr
+from kiwi.core.issuemgr import issuemgr
+from kiwi.core.reporter import get_reporter
+
+
+
+# 每种语言的文件扩展名、文件头、普通代码行、命中漏洞特征的代码行
+LANGUAGES = {
+    'python': ('.py', "#!/usr/bin/env python", [
+        "import os",
+        "def handler(request, name):",
+        "    value = request.args.get(name, '')",
+        "    result = [item.strip() for item in value.split(',')]",
+        "    return dict(zip(result, range(len(result))))",
+        "# TODO: handle unicode input",
+    ], [
+        "    os.system('ls ' + value)",
+        "    subprocess.call(value, shell=True)",
+        "    module = importlib.import_module(value)",
+    ]),
+    'php': ('.php', "<?php", [
+        "function handler($request, $name) {",
+        "    $value = isset($request[$name]) ? $request[$name] : '';",
+        "    $result = array_map('trim', explode(',', $value));",
+        "    return array_flip($result);",
+        "}",
+    ], [
+        "    eval($value);",
+        "    system('ls ' . $value);",
+        "    mysql_query(\"select * from t where id=\" . $value);",
+    ]),
+    'java': ('.java', "package kiwi.bench;", [
+        "public class Handler {",
+        "    public String handle(Request request, String name) {",
+        "        String value = request.getParameter(name);",
+        "        return value == null ? \"\" : value.trim();",
+        "    }",
+        "}",
+    ], [
+        "        Runtime.getRuntime().exec(value);",
+    ]),
+}
+
+STAGES = ["walk", "classify", "match", "evaluate", "report"]
+REPORT_FORMATS = [".txt", ".json", ".html", ".db"]
+
+
+
+def generate(root, files, size, languages, density, seed):
+    '''
+    生成合成代码目录，相同的参数生成的内容完全相同
+    @params:
+        files:     文件个数
+        size:      每个文件的平均行数
+        languages: 语言列表
+        density:   命中漏洞特征的代码行比例
+        seed:      随机数种子
+    @returns:
+        生成的文件总字节数
+    '''
+    rand = random.Random(seed)
+    total = 0
+
+    for index in range(files):
+        language = languages[index % len(languages)]
+        ext, header, normal, hits = LANGUAGES[language]
+
+        # 每个目录最多32个文件，目录深度最多3层
+        parts = ["d{0}".format(index // 32 % 8 ** (depth + 1) // 8 ** depth) \
+            for depth in range(index % 3 + 1)]
+        dirname = os.path.join(root, *parts)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        lines = [header]
+        for _ in range(rand.randint(size // 2, size * 3 // 2)):
+            if rand.random() < density:
+                lines.append(rand.choice(hits))
+            else:
+                lines.append(rand.choice(normal))
+
+        content = "\n".join(lines) + "\n"
+        with open(os.path.join(dirname, "f{0}{1}".format(index, ext)),
+            "w") as _file:
+            _file.write(content)
+
+        total += len(content)
+
+    return total
+
+
+def init(target, feature_dir):
+    conf.init_args(argparse.Namespace(target=target, feature_dir=feature_dir,
+        feature_ids=None, extensions=None, igexts=None, excludes=None,
+        noignore=False, sctx=2, ectx=10, cache=None, since=None))
+
+    filemgr.init()
+    featuremgr.init()
+
+
+def run_stages(target):
+    '''
+    依次执行各阶段，返回 ({stage: seconds}, counts)
+    '''
+    result = {}
+
+    start = timer()
+    filenames = list(filemgr._walk_files(target))
+    result['walk'] = timer() - start
+
+    start = timer()
+    targets = []
+    for filename in filenames:
+        if filemgr.is_file_skip(filename):
+            continue
+        scope = filemgr._classify(filename)
+        if scope:
+            targets.append((filename, scope))
+    result['classify'] = timer() - start
+
+    start = timer()
+    matches = []
+    for filename, scope in targets:
+        with File(filename, scope) as file:
+            try:
+                matcher = featuremgr.get_matcher(scope)
+            except KeyError:
+                continue
+            matches.extend(file.scan(matcher, conf.ectx))
+    result['match'] = timer() - start
+
+    start = timer()
+    with issuemgr.collect() as issues:
+        for feature, matchctx in matches:
+            feature.evaluate(matchctx, conf.sctx)
+    result['evaluate'] = timer() - start
+
+    tmpdir = tempfile.mkdtemp(prefix="kiwi-bench-report-")
+    try:
+        start = timer()
+        for ext in REPORT_FORMATS:
+            issuemgr.__init__()
+            reporter = get_reporter(os.path.join(tmpdir, "report" + ext))
+            reporter.start()
+            issuemgr.register(reporter)
+            issuemgr.extend(issues)
+            reporter.finish()
+        result['report'] = timer() - start
+    finally:
+        shutil.rmtree(tmpdir)
+
+    counts = {'files': len(targets), 'matches': len(matches),
+        'issues': len(issues)}
+
+    return result, counts
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    root = args.corpus or tempfile.mkdtemp(prefix="kiwi-bench-")
+    if args.corpus and os.path.exists(args.corpus):
+        shutil.rmtree(args.corpus)
+
+    try:
+        size = generate(root, args.files, args.lines, args.languages,
+            args.density, args.seed)
+
+        init(root, args.feature_dir)
+
+        runs = []
+        for _ in range(args.repeat):
+            timings, counts = run_stages(root)
+            runs.append(timings)
+            print " ".join("{0}={1:.3f}s".format(stage, timings[stage]) \
+                for stage in STAGES)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(root)
+
+    counts['bytes'] = size
+
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'params': {'files': args.files, 'lines': args.lines,
+            'languages': args.languages, 'density': args.density,
+            'seed': args.seed, 'repeat': args.repeat},
+        'counts': counts,
+        # 多次运行取最小值，减少系统噪声的影响
+        'stages': dict((stage, {'seconds': min(run[stage] for run in runs),
+            'runs': [run[stage] for run in runs]}) for stage in STAGES),
+    }
+
+
+def compare(base_file, new_file, threshold):
+    '''
+    对比两次基准测试结果
+    @returns:
+        是否有阶段变慢超过threshold
+    '''
+    with open(base_file) as _file:
+        base = json.load(_file)
+    with open(new_file) as _file:
+        new = json.load(_file)
+
+    if base['params'] != new['params']:
+        print "[w]: benchmark parameters differ"
+
+    regressed = False
+    print "{0:<10} {1:>10} {2:>10} {3:>8}".format("Stage", "Base(s)", "New(s)",
+        "Change")
+    for stage in STAGES:
+        old = base['stages'][stage]['seconds']
+        cur = new['stages'][stage]['seconds']
+        change = (cur - old) / old if old else 0.0
+
+        mark = ""
+        if change > threshold:
+            mark = "  slower"
+            regressed = True
+        print "{0:<10} {1:>10.3f} {2:>10.3f} {3:>+7.1%}{4}".format(stage, old,
+            cur, change, mark)
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u"Kiwi 扫描流程基准测试")
+
+    parser.add_argument("-f", "--feature_dir", help=u"指定漏洞特征定义目录")
+    parser.add_argument("-o", "--output", help=u"结果保存的JSON文件")
+    parser.add_argument("-n", "--files", type=int, default=1000,
+        help=u"生成的文件个数，默认为1000")
+    parser.add_argument("--lines", type=int, default=200,
+        help=u"每个文件的平均行数，默认为200")
+    parser.add_argument("--languages", nargs="+", default=["python", "php"],
+        choices=sorted(LANGUAGES), help=u"生成哪些语言的文件")
+    parser.add_argument("--density", type=float, default=0.02,
+        help=u"命中漏洞特征的代码行比例，默认为0.02")
+    parser.add_argument("--seed", type=int, default=0, help=u"随机数种子")
+    parser.add_argument("--repeat", type=int, default=3,
+        help=u"重复运行次数，结果取最小值")
+    parser.add_argument("--corpus", help=u"保留生成的代码目录")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"),
+        help=u"对比两次基准测试结果")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help=u"对比时阶段耗时增加超过该比例视为变慢，默认为0.1")
+
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1],
+            args.threshold) else 0)
+
+    result = benchmark(args)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as _file:
+            _file.write(output)
+    else:
+        print output
+
+
+
+if __name__ == '__main__':
+    main()
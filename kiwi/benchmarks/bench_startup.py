@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+
+启动耗时基准测试
+    在新的python进程中分别统计导入CLI入口、扫描少量文件的耗时，
+    以及扫描过程中导入了哪些较重的依赖，超出时间预算时返回1
+
+    python benchmarks/bench_startup.py -f ../kiwi_data --budget 150
+'''
+
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+from timeit import default_timer as timer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 控制台扫描时不应该导入的依赖
+HEAVY_MODULES = ["jinja2", "yaml", "multiprocessing", "cgi", "ssl",
+    "urllib"]
+
+# 子进程中执行的代码，耗时和已导入的较重依赖输出到stderr
+_IMPORT_CODE = '''
+import sys, json
+from timeit import default_timer as timer
+start = timer()
+import kiwi.ui.cli.main
+elapsed = timer() - start
+sys.stderr.write(json.dumps({"seconds": elapsed,
+    "modules": [m for m in %r if m in sys.modules]}))
+'''
+
+_SCAN_CODE = '''
+import sys, json
+from timeit import default_timer as timer
+start = timer()
+sys.argv = ["kiwi", "-t", %r, "-f", %r]
+from kiwi.ui.cli.main import main
+main()
+elapsed = timer() - start
+sys.stderr.write(json.dumps({"seconds": elapsed,
+    "modules": [m for m in %r if m in sys.modules]}))
+'''
+
+
+
+def run(code, repeat):
+    '''
+    在新的python进程中执行code，返回 (每次耗时列表, 导入的较重依赖)
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', "")
+    env['PYTHONIOENCODING'] = "utf-8"
+
+    runs = []
+    modules = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            start = timer()
+            process = subprocess.Popen([sys.executable, "-c", code], env=env,
+                cwd=ROOT, stdout=devnull, stderr=subprocess.PIPE)
+            output = process.communicate()[1]
+            wall = timer() - start
+
+            if process.returncode != 0:
+                raise RuntimeError(output)
+
+            result = json.loads(output.strip().splitlines()[-1])
+            runs.append({'wall': wall, 'seconds': result['seconds']})
+            modules = result['modules']
+
+    return runs, modules
+
+
+def generate(root):
+    '''
+    生成一个只有3个文件的小目录，模拟 pre-commit 扫描
+    '''
+    files = {
+        "a.py": "import os\nos.system(cmd)\n",
+        "b.py": "def handler(value):\n    return value\n",
+        "c.php": "<?php\neval($value);\n",
+    }
+
+    for name, content in files.items():
+        with open(os.path.join(root, name), "w") as _file:
+            _file.write(content)
+
+
+def summarize(runs):
+    walls = sorted(run['wall'] for run in runs)
+    return {
+        'wall': walls[len(walls) // 2],
+        'seconds': sorted(run['seconds'] for run in runs)[len(runs) // 2],
+        'runs': runs
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u"Kiwi 启动耗时基准测试")
+
+    parser.add_argument("-f", "--feature_dir", required=True,
+        help=u"指定漏洞特征定义目录")
+    parser.add_argument("-o", "--output", help=u"结果保存的JSON文件")
+    parser.add_argument("--repeat", type=int, default=5,
+        help=u"重复运行次数，结果取中位数")
+    parser.add_argument("--budget", type=float,
+        help=u"扫描少量文件的进程总耗时预算，毫秒，超出时返回1")
+
+    args = parser.parse_args()
+
+    feature_dir = os.path.abspath(args.feature_dir)
+
+    root = tempfile.mkdtemp(prefix="kiwi-bench-startup-")
+    try:
+        generate(root)
+
+        import_runs, import_modules = run(_IMPORT_CODE % HEAVY_MODULES,
+            args.repeat)
+        # 第一次扫描生成规则包，不计入结果
+        run(_SCAN_CODE % (root, feature_dir, HEAVY_MODULES), 1)
+        scan_runs, scan_modules = run(
+            _SCAN_CODE % (root, feature_dir, HEAVY_MODULES), args.repeat)
+    finally:
+        shutil.rmtree(root)
+
+    result = {
+        'python': sys.version.split()[0],
+        'import': dict(summarize(import_runs), modules=import_modules),
+        'scan': dict(summarize(scan_runs), modules=scan_modules),
+    }
+
+    print "import cli:  {0:.1f}ms  heavy modules: {1}".format(
+        result['import']['seconds'] * 1000, ",".join(import_modules) or "-")
+    print "small scan:  {0:.1f}ms  (process {1:.1f}ms)  heavy modules: {2}"\
+        .format(result['scan']['seconds'] * 1000,
+        result['scan']['wall'] * 1000, ",".join(scan_modules) or "-")
+
+    if args.output:
+        with open(args.output, "w") as _file:
+            json.dump(result, _file, indent=2, sort_keys=True)
+
+    if args.budget and result['scan']['wall'] * 1000 > args.budget:
+        print "[e]: startup exceeds budget {0}ms".format(args.budget)
+        sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -8,34 +8,505 @@ Copyright (c) 2016 alpha1e0
 '''
 
 
+import os
 import sys
+import threading
+import traceback
 
 from common import Out
 from common import conf
 from filemgr import filemgr
+from filemgr import File
 from featuremgr import featuremgr
+from issuemgr import issuemgr
+from issuemgr import Issue
+from exception import ScanError
+from profiler import profiler
+from profiler import timer
+from rulepack import rulepack
 
 
 
+# 扫描进程使用的增量扫描缓存
+_cache = None
+
+
+
+def scan_file(file):
+    '''
+    使用文件所属scope的所有漏洞特征扫描文件，结果提交给issuemgr
+    '''
+    try:
+        matcher = featuremgr.get_matcher(file.scope)
+        for feature, matchctx in file.scan(matcher, conf.ectx):
+            feature.evaluate(matchctx, conf.sctx)
+    except KeyError:
+        pass
+
+
+def profile_file(file):
+    '''
+    逐个正则扫描文件，记录每个正则的匹配时间和每个特征的评估时间
+    '''
+    try:
+        matcher = featuremgr.get_matcher(file.scope)
+    except KeyError:
+        return
+
+    for index in file.candidates(matcher):
+        feature = matcher.get_feature(index)
+        pattern = matcher.patterns[index]
+
+        start = timer()
+        matches = file.match_pattern(matcher, index)
+        profiler.add_match(feature['ID'], pattern.pattern, timer() - start,
+            len(matches))
+
+        for feature, pattern, offset in matches:
+            matchctx = file.match_context(pattern, offset, conf.ectx)
+
+            start = timer()
+            kept = feature.evaluate(matchctx, conf.sctx)
+            profiler.add_evaluate(feature['ID'], timer() - start, kept)
+
+    profiler.files += 1
+
+
+def _init_worker(cache_path):
+    '''
+    扫描进程初始化，每个进程使用独立的缓存数据库连接
+    '''
+    global _cache
+
+    if cache_path:
+        from cache import ScanCache
+        _cache = ScanCache(cache_path)
+    else:
+        _cache = None
+
+
+def _scan_target(target):
+    '''
+    扫描进程的工作函数
+        在子进程中扫描单个文件，将产生的issue转换为紧凑形式返回给父进程
+    @returns:
+        (filename, scope, length, [record, ...], entry)
+        entry 为保存缓存所需的文件状态，结果来自缓存并且文件状态未变化时为None
+    '''
+    filename, scope = target
+
+    if _cache:
+        cached = _cache.get(filename, scope)
+        if cached:
+            length, records, entry = cached
+            return filename, scope, length, records, entry
+
+    stat = os.stat(filename)
+    with File(filename, scope) as file:
+        with issuemgr.collect() as issues:
+            scan_file(file)
+        records = [issue.to_record() for issue in issues]
+
+        entry = (stat.st_size, stat.st_mtime, file.digest())
+
+        return filename, scope, file.length, records, entry
+
+
+
+def _scan_isolated(target, skip, conn):
+    '''
+    逐个正则扫描文件，用于定位超时的正则
+        每个正则开始匹配之前向父进程发送进度 ("pattern", index, ID, pattern)
+    @params:
+        skip: 跳过的正则的序号
+    @returns:
+        和 _scan_target 相同，跳过了正则时不保存缓存，entry 为None
+    '''
+    filename, scope = target
+
+    stat = os.stat(filename)
+    with File(filename, scope) as file:
+        with issuemgr.collect() as issues:
+            try:
+                matcher = featuremgr.get_matcher(scope)
+                for index in file.candidates(matcher):
+                    if index in skip:
+                        continue
+
+                    feature = matcher.get_feature(index)
+                    conn.send(("pattern", index, feature['ID'],
+                        matcher.patterns[index].pattern))
+
+                    for feature, matchctx in file.scan_pattern(matcher, index,
+                        conf.ectx):
+                        feature.evaluate(matchctx, conf.sctx)
+            except KeyError:
+                pass
+        records = [issue.to_record() for issue in issues]
+
+        if skip:
+            entry = None
+        else:
+            entry = (stat.st_size, stat.st_mtime, file.digest())
+
+        return filename, scope, file.length, records, entry
+
+
+def _supervised_worker(conn, cache_path):
+    '''
+    受监控的扫描进程，依次处理父进程发送的请求
+        ("scan", target)          使用组合匹配器扫描文件
+        ("isolate", target, skip) 逐个正则扫描文件
+        None                      退出
+    '''
+    _init_worker(cache_path)
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+
+        if request is None:
+            break
+
+        try:
+            if request[0] == "scan":
+                result = _scan_target(request[1])
+            else:
+                result = _scan_isolated(request[1], request[2], conn)
+
+            conn.send(("done", result))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+
+
+class ScanSupervisor(object):
+    '''
+    受监控的扫描进程
+        正则匹配无法中断，扫描在子进程中进行，文件扫描超时时结束子进程；
+        之后重新启动子进程逐个正则扫描该文件，跳过超时的正则，记录为扫描警告
+    '''
+    # 一个文件最多跳过多少个超时的正则，超过时放弃扫描该文件
+    MAX_SKIPPED = 3
+
+    def __init__(self, timeout, pattern_timeout, cache_path=None):
+        '''
+        @params:
+            timeout:         单个文件的扫描时间上限，秒
+            pattern_timeout: 逐个正则扫描时单个正则的时间上限，秒
+            cache_path:      增量扫描缓存
+        '''
+        self._timeout = timeout
+        self._pattern_timeout = pattern_timeout
+        self._cache_path = cache_path
+
+        self._conn = None
+        self._process = None
+
+        self._start()
+
+
+    def _start(self):
+        import multiprocessing
+
+        self._conn, child = multiprocessing.Pipe()
+
+        self._process = multiprocessing.Process(target=_supervised_worker,
+            args=(child, self._cache_path))
+        self._process.daemon = True
+        self._process.start()
+
+        child.close()
+
+
+    def _restart(self):
+        self._process.terminate()
+        self._process.join()
+        self._conn.close()
+
+        self._start()
+
+
+    def _recv(self, timeout):
+        '''
+        接收子进程的消息，超时返回None
+        '''
+        if not self._conn.poll(timeout):
+            return None
+
+        try:
+            message = self._conn.recv()
+        except EOFError:
+            raise ScanError("scan process exited unexpectedly")
+
+        if message[0] == "error":
+            raise ScanError(message[1])
+
+        return message
+
+
+    def scan(self, target):
+        '''
+        @returns:
+            (filename, scope, length, records, entry, warnings)
+            warnings 为扫描警告，[(filename, message, ID, pattern), ...]
+        '''
+        filename, scope = target
+        warnings = []
+
+        self._conn.send(("scan", target))
+        message = self._recv(self._timeout)
+        if message:
+            return message[1] + (warnings,)
+
+        self._restart()
+        warnings.append((filename, "scanning exceeded {0}s, rescanning "
+            "pattern by pattern".format(self._timeout), None, None))
+
+        skip = set()
+        while True:
+            self._conn.send(("isolate", target, skip))
+
+            current = None
+            while True:
+                message = self._recv(self._pattern_timeout)
+                if message is None or message[0] == "done":
+                    break
+                current = message[1:]
+
+            if message:
+                return message[1] + (warnings,)
+
+            self._restart()
+
+            if current is None or len(skip) >= self.MAX_SKIPPED:
+                warnings.append((filename, "scanning exceeded time budget, "
+                    "file skipped", None, None))
+                return filename, scope, 0, [], None, warnings
+
+            index, ID, pattern = current
+            skip.add(index)
+            warnings.append((filename, "matching exceeded {0}s, pattern "
+                "skipped".format(self._pattern_timeout), ID, pattern))
+
+
+    def close(self):
+        try:
+            self._conn.send(None)
+        except (IOError, OSError):
+            pass
+
+        self._process.join(1)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+
+        self._conn.close()
+
+
 
 class Analyzer(object):
     '''
     代码审计的入口
     '''
+    # 每次分发给扫描进程的文件个数
+    _CHUNKSIZE = 8
+
     def analyze(self):
+        self.init()
+        self.scan()
+
+
+    def init(self):
+        '''
+        加载规则包、文件类型映射和漏洞特征
+        '''
+        rulepack.init()
         filemgr.init()
         featuremgr.init()
 
-        for file in filemgr.walk():
+
+    def scan(self, cache=None, targets=None):
+        '''
+        扫描 conf.target，结果提交给issuemgr
+        @params:
+            cache:   增量扫描缓存，由调用者负责关闭；为None时根据 conf.cache 打开
+            targets: 只扫描这些文件，[(filename, scope), ...]，默认遍历扫描目录
+        '''
+        owned = cache is None
+
+        jobs = conf.jobs if conf.jobs is not None else 1
+        if jobs <= 0:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+
+        if targets is None:
+            targets = filemgr.walk_targets()
+        else:
+            # 文件较少时不需要启动多个扫描进程
+            jobs = max(1, min(jobs, len(targets)))
+
+        if conf.profile:
+            # 性能分析在当前进程中逐个文件扫描，不使用缓存，保证统计的是实际匹配耗时
+            if jobs != 1 or conf.cache or conf.timeout:
+                Out.wraning("--profile scans serially, ignoring "
+                    "--jobs/--cache/--timeout")
+            profiler.enable()
+            jobs = 1
+            cache = None
+        elif owned and conf.cache:
+            from cache import ScanCache
+            cache = ScanCache(conf.cache)
+
+        try:
+            if conf.timeout and not conf.profile:
+                self._analyze_supervised(jobs, cache, targets)
+            elif jobs == 1:
+                self._analyze_serial(cache, targets)
+            else:
+                self._analyze_parallel(jobs, cache, targets)
+        finally:
+            if cache and owned:
+                cache.close()
+
+            # 保存扫描过程中新编译的组合正则
+            featuremgr.save_pack()
+
+
+    def _filter(self, filename, issues):
+        '''
+        只扫描git变更时，只保留变更的行及其前后--ectx行范围内的issue
+        '''
+        changes = filemgr.changes
+        if changes is None:
+            return issues
+
+        return [issue for issue in issues \
+            if changes.is_changed(filename, issue['lineno'], conf.ectx)]
+
+
+    def _analyze_serial(self, cache, targets):
+        for filename, scope in targets:
             if conf.verbose:
-                Out.info("scanning file {0}".format(file.filename))
-                
-            try:
-                for feature in featuremgr[file.scope]:
-                    matchctxes = file.match(feature.patterns, conf.ectx)
-                    for matchctx in matchctxes:
-                        feature.evaluate(matchctx, conf.sctx)
-            except KeyError:
+                Out.info("scanning file {0}".format(filename))
+
+            cached = cache.get(filename, scope) if cache else None
+            if cached:
+                length, records, entry = cached
+                if entry:
+                    cache.put(filename, scope, entry, length, records)
+
+                filemgr.record(filename, scope, length)
+                issuemgr.extend(self._filter(filename,
+                    [Issue.from_record(r) for r in records]))
                 continue
 
+            stat = os.stat(filename) if cache else None
+            with File(filename, scope) as file:
+                filemgr.record(filename, scope, file.length)
+
+                with issuemgr.collect() as issues:
+                    if profiler.enabled:
+                        profile_file(file)
+                    else:
+                        scan_file(file)
+
+                if cache:
+                    cache.put(filename, scope,
+                        (stat.st_size, stat.st_mtime, file.digest()),
+                        file.length,
+                        [issue.to_record() for issue in issues])
+
+            issuemgr.extend(self._filter(filename, issues))
+
+
+    def _analyze_parallel(self, jobs, cache, targets):
+        '''
+        多进程扫描
+            父进程遍历目录，子进程读取文件、匹配特征、评估漏洞；
+            父进程按照遍历顺序合并扫描结果，保证报告和单进程扫描一致
+        '''
+        import multiprocessing
+
+        pool = multiprocessing.Pool(jobs, _init_worker,
+            (conf.cache if cache else None,))
+
+        try:
+            results = pool.imap(_scan_target, targets, self._CHUNKSIZE)
+
+            for filename, scope, length, records, entry in results:
+                if conf.verbose:
+                    Out.info("scanning file {0}".format(filename))
+
+                filemgr.record(filename, scope, length)
+                issuemgr.extend(self._filter(filename,
+                    [Issue.from_record(r) for r in records]))
+
+                if cache and entry:
+                    cache.put(filename, scope, entry, length, records)
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+    def _analyze_supervised(self, jobs, cache, targets):
+        '''
+        限制扫描时间的扫描
+            每个扫描线程使用一个受监控的扫描进程，超时的文件、正则记录为扫描警告；
+            按照遍历顺序合并扫描结果
+        '''
+        timeout = conf.timeout
+        pattern_timeout = conf.pattern_timeout or timeout
+        cache_path = conf.cache if cache else None
+
+        local = threading.local()
+        lock = threading.Lock()
+        supervisors = []
+
+        def _scan(target):
+            supervisor = getattr(local, "supervisor", None)
+            if supervisor is None:
+                with lock:
+                    supervisor = ScanSupervisor(timeout, pattern_timeout,
+                        cache_path)
+                    supervisors.append(supervisor)
+                local.supervisor = supervisor
+
+            return supervisor.scan(target)
+
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(jobs)
+
+        try:
+            results = pool.imap(_scan, targets)
+
+            for filename, scope, length, records, entry, warnings in results:
+                if conf.verbose:
+                    Out.info("scanning file {0}".format(filename))
+
+                for warning in warnings:
+                    Out.wraning(warning[1] + " @" + filename)
+                    issuemgr.warn(*warning)
+
+                filemgr.record(filename, scope, length)
+                issuemgr.extend(self._filter(filename,
+                    [Issue.from_record(r) for r in records]))
+
+                if cache and entry:
+                    cache.put(filename, scope, entry, length, records)
 
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            for supervisor in supervisors:
+                supervisor.close()
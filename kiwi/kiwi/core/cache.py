@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import os
+import hashlib
+import sqlite3
+import cPickle as pickle
+
+from common import conf
+from exception import DatabaseError
+from featuremgr import featuremgr
+
+
+
+class ScanCache(object):
+    '''
+    增量扫描缓存
+        按文件记录扫描结果，以文件内容hash、规则指纹作为缓存的有效性依据；
+        文件大小、修改时间未变化时直接使用缓存，不读取文件内容；只有修改时间变化时
+        返回新的文件状态，由调用者通过 put 更新，下次扫描不需要再计算hash
+    '''
+    # 缓存格式版本，扫描引擎结果格式变化时需要修改
+    VERSION = "1"
+    # 写入多少条缓存后提交一次
+    _COMMIT_INTERVAL = 256
+
+    def __init__(self, dbname):
+        self._dbname = dbname
+        self._con = None
+
+        # 每个scope的规则指纹
+        self._fingerprints = {}
+        # 未提交的缓存条数
+        self._pending = 0
+
+        dirname = os.path.dirname(self._dbname)
+        if dirname and not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as error:
+                raise DatabaseError("create cache directory {0} error, "
+                    "reason: {1}".format(dirname, str(error)))
+
+        try:
+            self._con = sqlite3.connect(self._dbname)
+            self._con.text_factory = str
+            # WAL模式下多进程扫描时子进程读缓存不会被父进程写缓存阻塞
+            self._con.execute("pragma journal_mode=wal")
+            self._con.execute("create table if not exists Files("
+                "filename nchar(512) primary key,"
+                "scope nchar(64),"
+                "size integer,"
+                "mtime real,"
+                "digest nchar(40),"
+                "fingerprint nchar(40),"
+                "length integer,"
+                "records blob)")
+            self._con.commit()
+        except sqlite3.Error as error:
+            raise DatabaseError("open cache {0} error, reason: {1}".\
+                format(self._dbname, str(error)))
+
+
+    def fingerprint(self, scope):
+        '''
+        scope的规则指纹
+            包括漏洞特征文件、评价函数文件、上下文参数、文件类型映射文件
+        '''
+        if scope not in self._fingerprints:
+            sha = hashlib.sha1()
+            sha.update(self.VERSION)
+            sha.update(featuremgr.fingerprint(scope))
+            sha.update("ectx={0};sctx={1};".format(conf.ectx, conf.sctx))
+
+            with open(conf.mapfile, 'rb') as _file:
+                sha.update(_file.read())
+
+            self._fingerprints[scope] = sha.hexdigest()
+
+        return self._fingerprints[scope]
+
+
+    @staticmethod
+    def digest(filename):
+        '''
+        计算文件内容hash
+        '''
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as _file:
+            for chunk in iter(lambda: _file.read(1024*1024), ""):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+
+    def get(self, filename, scope):
+        '''
+        查询缓存
+        @returns:
+            (length, [record, ...], entry)，缓存无效时返回None
+            entry 为文件内容未变化、大小或修改时间变化时新的 (size, mtime, digest)，
+            需要调用者保存，文件状态未变化时为None
+        '''
+        row = self._con.execute("select scope, size, mtime, digest, "
+            "fingerprint, length, records from Files where filename=?",
+            (filename,)).fetchone()
+        if not row:
+            return None
+
+        cscope, size, mtime, digest, fingerprint, length, records = row
+        if cscope != scope or fingerprint != self.fingerprint(scope):
+            return None
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        entry = None
+        if stat.st_size != size or stat.st_mtime != mtime:
+            if stat.st_size != size or self.digest(filename) != digest:
+                return None
+            entry = (stat.st_size, stat.st_mtime, digest)
+
+        return length, pickle.loads(str(records)), entry
+
+
+    def put(self, filename, scope, entry, length, records):
+        '''
+        保存文件的扫描结果
+        @params:
+            entry:   (size, mtime, digest)，扫描前文件的大小、修改时间和内容hash
+            length:  文件行数
+            records: [record, ...]
+        '''
+        size, mtime, digest = entry
+
+        try:
+            self._con.execute("insert or replace into Files(filename, scope, "
+                "size, mtime, digest, fingerprint, length, records) "
+                "values(?, ?, ?, ?, ?, ?, ?, ?)", (filename, scope, size,
+                mtime, digest, self.fingerprint(scope), length,
+                sqlite3.Binary(pickle.dumps(records, 2))))
+
+            self._pending += 1
+            if self._pending >= self._COMMIT_INTERVAL:
+                self._con.commit()
+                self._pending = 0
+        except sqlite3.Error as error:
+            raise DatabaseError("write cache {0} error, reason: {1}".\
+                format(self._dbname, str(error)))
+
+
+    def close(self):
+        if self._con:
+            self._con.commit()
+            self._con.close()
+            self._con = None
+
+
+
+class MemoryScanCache(object):
+    '''
+    内存中的增量扫描缓存，用于常驻的扫描服务
+        接口和 ScanCache 相同，规则在服务运行期间不变，不检查规则指纹
+    '''
+    def __init__(self):
+        # {filename: (scope, size, mtime, digest, length, records)}
+        self._entries = {}
+
+
+    def get(self, filename, scope):
+        entry = self._entries.get(filename)
+        if not entry:
+            return None
+
+        cscope, size, mtime, digest, length, records = entry
+        if cscope != scope:
+            return None
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        entry = None
+        if stat.st_size != size or stat.st_mtime != mtime:
+            if stat.st_size != size or ScanCache.digest(filename) != digest:
+                return None
+            entry = (stat.st_size, stat.st_mtime, digest)
+
+        return length, records, entry
+
+
+    def put(self, filename, scope, entry, length, records):
+        size, mtime, digest = entry
+        self._entries[filename] = (scope, size, mtime, digest, length,
+            records)
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def close(self):
+        pass
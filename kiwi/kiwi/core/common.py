@@ -13,9 +13,9 @@ import sys
 import threading
 import platform
 import shutil
+import hashlib
 import ConfigParser
 
-import yaml
 from appdirs import AppDirs
 from colorama import init, Fore, Style
 
@@ -32,9 +32,15 @@ class YamlConf(object):
     Yaml configure file loader
     '''
     def __new__(cls, path):
+        # yaml 导入较慢，规则包有效时不需要导入
+        import yaml
+
+        # 优先使用 libyaml 实现的加载器，解析速度快很多
+        loader = getattr(yaml, "CFullLoader", yaml.FullLoader)
+
         try:
             _file = open(path,"r")
-            result = yaml.load(_file, Loader=yaml.FullLoader)
+            result = yaml.load(_file, Loader=loader)
         except IOError:
             raise FileError(
                 "Loading yaml file '{0}' failed, read file failed".format(path))
@@ -220,6 +226,16 @@ class Config(Dict):
         self['pkgpath'] = os.path.dirname(os.path.dirname(
             os.path.realpath(__file__)))
 
+        if self.cache is True:
+            self['cache'] = os.path.join(AppDirs("kiwi").user_cache_dir,
+                "scancache.db")
+
+        # 每个特征目录使用一个规则包
+        if not self.norulepack:
+            self['rulepack'] = os.path.join(AppDirs("kiwi").user_cache_dir,
+                "rulepack-{0}.pickle".format(hashlib.sha1(
+                os.path.realpath(data_path)).hexdigest()[:16]))
+
 
 
 
@@ -14,6 +14,9 @@ class MatchContext(object):
         保存正则匹配上下文信息
         提供漏洞评价相关函数方法
     '''
+    __slots__ = ('filename', 'lineno', 'pattern', 'ctxlines', '_match_line',
+        '_str_ctx')
+
     def __init__(self, filename, pattern, lineno, ctxlines):
         '''
         @params:
@@ -27,12 +30,9 @@ class MatchContext(object):
         self.pattern = pattern
         self.ctxlines = ctxlines
 
-        for line in self.ctxlines:
-            if line[0] == self.lineno:
-                self._match_line = line[1]
-
-        lines = [x[1] for x in self.ctxlines]
-        self._str_ctx = "\n".join(lines)
+        # match_line、str_ctx 在第一次使用时生成
+        self._match_line = None
+        self._str_ctx = None
 
 
     def get_ctx_lines(self, ctxrange):
@@ -82,11 +82,20 @@ class MatchContext(object):
 
     @property
     def match_line(self):
+        if self._match_line is None:
+            self._match_line = ""
+            for line in self.ctxlines:
+                if line[0] == self.lineno:
+                    self._match_line = line[1]
+
         return self._match_line
 
 
     @property
     def str_ctx(self):
+        if self._str_ctx is None:
+            self._str_ctx = "\n".join([x[1] for x in self.ctxlines])
+
         return self._str_ctx
 
 
@@ -94,14 +103,14 @@ class MatchContext(object):
         '''
         判断漏洞特征匹配行是否包含关键字keyword
         '''
-        return keyword in self._match_line
+        return keyword in self.match_line
 
 
     def ctx_contains(self, keyword):
         '''
         判断漏洞特征匹配上下文是否包含关键字keyword
         '''
-        return keyword in self._str_ctx
+        return keyword in self.str_ctx
 
 
 
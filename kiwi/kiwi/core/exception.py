@@ -21,8 +21,7 @@ class KiwiError(Exception):
             return "{} [{}]: {}".format(self.__class__.__name__, self._errno,
                 self._msg)
         else:
-            return "{}: {}".format(self.__class__.__name__, self._errno,
-                self._msg)
+            return "{}: {}".format(self.__class__.__name__, self._msg)
 
 
 
@@ -39,4 +38,12 @@ class IssueFormatError(KiwiError):
 
 
 class DatabaseError(KiwiError):
-    pass
\ No newline at end of file
+    pass
+
+
+class VcsError(KiwiError):
+    pass
+
+
+class ScanError(KiwiError):
+    pass
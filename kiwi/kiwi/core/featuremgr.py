@@ -10,16 +10,18 @@ Copyright (c) 2016 alpha1e0
 
 import os
 import sys
-import re
 import importlib
 import inspect
+import hashlib
 
 from exception import FeatureError
-from common import YamlConf
 from common import conf
 from issuemgr import issuemgr
 from issuemgr import Issue
 from constant import High, Medium, Low, Info
+from matcher import FeatureMatcher
+from matcher import regexes
+from rulepack import rulepack
 
 
 
@@ -60,11 +62,14 @@ class Feature(dict):
 
     def _init_patterns(self):
         repatterns = []
+        # 每个正则的必需字面字符串，用于匹配前的预过滤
+        self._literals = []
 
         for pattern in self['patterns']:
-            rp = re.compile(pattern)
+            rp = regexes.compile(pattern)
 
             repatterns.append(rp)
+            self._literals.append(regexes.required_literal(rp))
 
         self['patterns'] = repatterns
 
@@ -74,6 +79,11 @@ class Feature(dict):
         return self['patterns']
 
 
+    @property
+    def literals(self):
+        return self._literals
+
+
     @property
     def level(self):
         return {'severity': self.get('severity',"unknown"),
@@ -100,6 +110,8 @@ class Feature(dict):
         @params:
             matchctx: 特征匹配的上下文信息
             ctxrange: 漏洞中保存的上下文信息行数
+        @returns:
+            是否构成漏洞
         '''
         evaluate_result = self._evaluate(matchctx)
 
@@ -115,6 +127,9 @@ class Feature(dict):
                 lineno = matchctx.lineno,
                 context = matchctx.get_decoded_ctx_lines(ctxrange)
                 )
+            return True
+
+        return False
 
 
 
@@ -130,20 +145,32 @@ class FeatureManager(object):
         # _features 字典，{scope, featues}，记录所有scope和其相关的features
         self._features = {}
 
+        # _matchers 字典，{scope, matcher}，记录scope的组合正则匹配器
+        self._matchers = {}
+
+        # _sources 字典，{scope, [feature_file, ...]}，记录scope相关的特征文件
+        self._sources = {}
+
 
     def init(self):
         '''
         初始化 漏洞特征管理器，加载所有指定的漏洞特征
+            规则包有效时使用规则包中的特征文件解析结果、正则编译结果，
+            并且只在第一次调用评价函数时导入其所在的文件
         '''
-        # _dfmgr，漏洞评价函数管理器，用于加载、调用评价函数
-        self._efmgr = EvalfuncsManager()
+        if rulepack.loaded:
+            regexes.load(rulepack.regexes)
+            self._efmgr = EvalfuncsManager(rulepack.evalfuncs)
+        else:
+            # _efmgr，漏洞评价函数管理器，用于加载、调用评价函数
+            self._efmgr = EvalfuncsManager()
 
         files = [os.path.join(conf.featurepath,f) \
             for f in os.listdir(conf.featurepath) \
             if f.endswith(".feature")]
 
         for feature_file in files:
-            feature_def = YamlConf(feature_file)
+            feature_def = rulepack.load_yaml(feature_file)
 
             scopes = feature_def['scopes']
             features = []
@@ -155,18 +182,72 @@ class FeatureManager(object):
                 features.append(Feature(feature, scopes, self._efmgr))
 
             for scope in scopes:
+                self._sources.setdefault(scope, []).append(feature_file)
+
                 if scope in self._features:
                     self._features[scope] += features
                 else:
                     self._features[scope] = features
                     self._scopes.append(scope)
 
+        if rulepack.enabled and not rulepack.loaded:
+            rulepack.evalfuncs = self._efmgr.sources
+            self.save_pack()
+
+
+    def save_pack(self):
+        '''
+        保存规则包，规则包未启用或者没有新的正则编译结果时不保存
+        '''
+        if not rulepack.enabled:
+            return
+
+        if rulepack.loaded and not regexes.dirty:
+            return
+
+        rulepack.regexes = regexes.dump()
+        rulepack.save()
+        regexes.dirty = False
+
 
     @property
     def scopes(self):
         return self._scopes
 
 
+    def fingerprint(self, scope):
+        '''
+        scope的规则指纹，规则文件、评价函数文件、加载的规则变化时指纹变化
+        '''
+        files = set(os.path.realpath(f) for f in self._sources.get(scope, []))
+        ids = []
+
+        for feature in self._features.get(scope, []):
+            ids.append(feature['ID'])
+            if 'evaluate' in feature:
+                source = self._efmgr.get_source(feature['evaluate'])
+                if source:
+                    files.add(os.path.realpath(source))
+
+        sha = hashlib.sha1()
+        sha.update(",".join(ids))
+        for filename in sorted(files):
+            with open(filename, 'rb') as _file:
+                sha.update(_file.read())
+
+        return sha.hexdigest()
+
+
+    def get_matcher(self, scope):
+        '''
+        获取scope的组合正则匹配器，第一次使用时编译
+        '''
+        if scope not in self._matchers:
+            self._matchers[scope] = FeatureMatcher(self[scope])
+
+        return self._matchers[scope]
+
+
     def __getattr__(self, scope):
         if scope in self._scopes:
             return self._features[scope]
@@ -186,11 +267,29 @@ class EvalfuncsManager(object):
     '''
     漏洞评价函数管理器
     '''
-    def __init__(self):
+    def __init__(self, sources=None):
+        '''
+        @params:
+            sources: 规则包中保存的 {funcname: 评价函数所在的文件}，
+                     指定时只在第一次调用评价函数时导入其所在的文件
+        '''
         # _evalfuncs 存储所有漏洞评价函数
         self._evalfuncs = {}
+        # _sources 存储漏洞评价函数所在的文件
+        self._sources = {}
 
-        self._load_evalfuncs()
+        if conf.evalpath not in sys.path:
+            sys.path.append(conf.evalpath)
+
+        if sources is None:
+            self._load_evalfuncs()
+        else:
+            self._sources.update(sources)
+
+
+    @property
+    def sources(self):
+        return dict(self._sources)
 
 
     def _load_evalfuncs(self):
@@ -199,23 +298,39 @@ class EvalfuncsManager(object):
         '''
         files = [f[:-3] for f in os.listdir(conf.evalpath) if f.endswith(".py")]
 
-        if conf.evalpath not in sys.path:
-            sys.path.append(conf.evalpath)
-
         for evalfile in files:
-            try:
-                module = importlib.import_module(evalfile)
-            except ImportError:
-                raise FeatureError("import evaluate file '{}' failed"\
-                    .format(evalfile))
+            self._load_module(evalfile)
+
 
-            for member in dir(module):
-                func = getattr(module, member)
-                if inspect.isfunction(func) and hasattr(func, "_evaluate"):
-                    self._evalfuncs[member] = func
+    def _load_module(self, evalfile):
+        '''
+        导入评价函数文件，记录其中的评价函数
+        '''
+        try:
+            module = importlib.import_module(evalfile)
+        except ImportError:
+            raise FeatureError("import evaluate file '{}' failed"\
+                .format(evalfile))
+
+        for member in dir(module):
+            func = getattr(module, member)
+            if inspect.isfunction(func) and hasattr(func, "_evaluate"):
+                self._evalfuncs[member] = func
+                self._sources[member] = os.path.join(conf.evalpath,
+                    evalfile + ".py")
+
+
+    def get_source(self, funcname):
+        '''
+        获取漏洞评价函数所在的文件，找不到时返回None
+        '''
+        return self._sources.get(funcname)
 
 
     def run(self, funcname, *args, **kwargs):
+        if funcname not in self._evalfuncs and funcname in self._sources:
+            self._load_module(os.path.basename(self._sources[funcname])[:-3])
+
         try:
             func = self._evalfuncs[funcname]
         except KeyError:
@@ -10,45 +10,135 @@ Copyright (c) 2016 alpha1e0
 
 import os
 import re
+import mmap
+import array
+import bisect
+import hashlib
 
-from common import YamlConf
 from common import conf
 from context import MatchContext
 from exception import FileError
 from issuemgr import issuemgr
+from vcs import GitChanges
+from matcher import is_combinable
+from ignore import IgnoreRules
+from rulepack import rulepack
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+
+def _list_dir(path):
+    '''
+    列出目录中的所有文件、目录，优先使用scandir，可以避免对每个文件调用stat
+    @returns:
+        [(name, fullpath, is_dir, is_link), ...]
+        is_dir 和os.path.isdir相同，符号链接指向目录时为True
+    '''
+    result = []
+
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            is_link = entry.is_symlink() if is_dir else False
+            result.append((entry.name, entry.path, is_dir, is_link))
+    else:
+        for name in os.listdir(path):
+            fullpath = os.path.join(path, name)
+            is_dir = os.path.isdir(fullpath)
+            is_link = os.path.islink(fullpath) if is_dir else False
+            result.append((name, fullpath, is_dir, is_link))
+
+    return result
 
 
 
 class File(object):
     '''
     文件类，用于正则匹配
+        大文件使用mmap映射到内存直接匹配，不复制文件内容；
+        行索引在第一次需要时才建立，上下文行只在匹配位置附近生成
     '''
+    # 超过该大小的文件使用mmap读取
+    _MMAP_THRESHOLD = 32 * 1024 * 1024
+    # mmap文件的行索引以块为单位记录换行符个数
+    _INDEX_CHUNK = 64 * 1024
+
     def __init__(self, filename, scope, maxlen=0):
         self._filename = filename
         self._scope = scope
 
+        # 文件内容，str或者mmap
+        self._content = ""
+        self._mmap = None
+
+        # 行数
+        self._length = None
+        # 普通文件的行索引，每一行起始位置在文件内容中的偏移，升序排列
+        self._line_starts = None
+        # mmap文件的行索引，第i个元素为第i块之前的换行符个数
+        self._chunk_lines = None
+
         if not os.path.exists(self._filename):
             raise FileError("cannot find file '{0}'".format(self._filename))
 
         try:
-            self._file = open(self._filename)
-        except IOError:
+            with open(self._filename, 'rb') as _file:
+                self._read(_file, maxlen)
+        except (IOError, OSError, mmap.error):
             raise FileError("read file '{0}' error".format(self._filename))
 
+
+    def _read(self, _file, maxlen):
         if maxlen == 0:
-            self._content = self._file.read()
+            size = os.fstat(_file.fileno()).st_size
+            if size >= self._MMAP_THRESHOLD:
+                self._mmap = mmap.mmap(_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+                self._content = self._mmap
+            else:
+                self._content = _file.read()
         elif maxlen > 0:
-            self._content = self._file.read(maxlen)
-        else:
-            self._content = ""
+            self._content = _file.read(maxlen)
 
-        # format [line, (start,end)]
-        self._formated_lines = self._get_formated_lines()
+
+    def close(self):
+        '''
+        释放文件内容，使用mmap读取的文件需要关闭映射
+        '''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+        self._content = ""
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
 
 
     @property
     def length(self):
-        return len(self._formated_lines)
+        if self._length is None:
+            if self._mmap is not None:
+                self._length = self._get_chunk_lines()[-1] + 1
+            else:
+                self._length = self._content.count("\n") + 1
+
+        return self._length
 
 
     @property
@@ -64,30 +154,103 @@ class File(object):
         return True
 
 
-    def _get_formated_lines(self):
+    def digest(self):
         '''
-        文件内容格式化
-            将文本格式化为[line,(start,end)]列表，start/end表示每一行的开始、结束索引
+        文件内容hash
         '''
-        result = []
-        sp = self._content.split("\n")
-        start = end = 0
+        return hashlib.sha1(self._content).hexdigest()
 
-        for l in sp:
-            start = end
-            end = end + len(l) + 1
-            result.append([l+"\n",(start, end)])
 
-        return result
+    def _get_line_starts(self):
+        '''
+        建立行索引
+            记录每一行的开始索引，用于通过二分查找将匹配偏移转换为行号
+        '''
+        if self._line_starts is None:
+            result = array.array('l', [0])
+
+            find = self._content.find
+            pos = find("\n")
+            while pos != -1:
+                result.append(pos+1)
+                pos = find("\n", pos+1)
+
+            self._line_starts = result
+
+        return self._line_starts
+
+
+    def _get_chunk_lines(self):
+        '''
+        建立mmap文件的分块行索引
+            只记录每一块之前的换行符个数，块内的位置通过计数换行符得到
+        '''
+        if self._chunk_lines is None:
+            result = array.array('l', [0])
+
+            size = len(self._content)
+            for start in range(0, size, self._INDEX_CHUNK):
+                chunk = self._content[start:start+self._INDEX_CHUNK]
+                result.append(result[-1] + chunk.count("\n"))
+
+            self._chunk_lines = result
+
+        return self._chunk_lines
+
+
+    def _get_line_start(self, lineno):
+        '''
+        获取某一行的开始位置
+        '''
+        if self._mmap is None:
+            return self._get_line_starts()[lineno-1]
+
+        if lineno <= 1:
+            return 0
+
+        # 第lineno行从第lineno-1个换行符之后开始，先找到该换行符所在的块
+        chunk_lines = self._get_chunk_lines()
+        newlines = lineno - 1
+        idx = bisect.bisect_left(chunk_lines, newlines) - 1
+
+        pos = idx * self._INDEX_CHUNK - 1
+        for i in range(newlines - chunk_lines[idx]):
+            pos = self._content.find("\n", pos+1)
+
+        return pos + 1
+
+
+    def get_lineno(self, offset):
+        '''
+        获取文件内容偏移所在的行号，行号从1开始
+        '''
+        if self._mmap is None:
+            return bisect.bisect_right(self._get_line_starts(), offset)
+
+        idx = offset // self._INDEX_CHUNK
+        start = idx * self._INDEX_CHUNK
+
+        return self._get_chunk_lines()[idx] + \
+            self._content[start:offset].count("\n") + 1
+
+
+    def get_line(self, lineno):
+        '''
+        获取某一行的内容，包括行尾的换行符
+        '''
+        start = self._get_line_start(lineno)
+        end = self._content.find("\n", start)
+        if end == -1:
+            end = len(self._content)
+
+        return self._content[start:end] + "\n"
 
 
     def get_context_lines(self, lineno, ctxrange):
         '''
         获取匹配上下文信息
         '''
-        result = []
-
-        data_lines_len = len(self._formated_lines)
+        data_lines_len = self.length
         if lineno>data_lines_len or lineno<0:
             return ""
 
@@ -96,11 +259,20 @@ class File(object):
         eidx = lineno + ctxrange
         eidx = eidx if eidx<data_lines_len else data_lines_len
 
+        result = []
+
+        # 第一行通过行索引定位，后续行依次查找换行符
+        content = self._content
+        start = self._get_line_start(sidx+1)
         for i in range(sidx+1, eidx+1):
-            result.append((i,self._formated_lines[i-1][0]))
+            end = content.find("\n", start)
+            if end == -1:
+                end = len(content)
 
-        return result
+            result.append((i, content[start:end] + "\n"))
+            start = end + 1
 
+        return result
 
 
     def match(self, patterns, ctxrange):
@@ -115,18 +287,66 @@ class File(object):
         for pattern in patterns:
             for match in pattern.finditer(self._content):
                 # 找到正则匹配的信息在文件中哪一行
-                for index, line in enumerate(self._formated_lines):
-                    if match.start()>=line[1][0] and match.start()<line[1][1]:
-                        ctxlines = self.get_context_lines(index+1, ctxrange)
-                        matchctx = MatchContext(self._filename, pattern.pattern, 
-                            index+1, ctxlines)
+                lineno = self.get_lineno(match.start())
+                ctxlines = self.get_context_lines(lineno, ctxrange)
+                matchctx = MatchContext(self._filename, pattern.pattern,
+                    lineno, ctxlines)
 
-                        result.append(matchctx)
-                        break
+                result.append(matchctx)
 
         return result
 
 
+    def scan(self, matcher, ctxrange):
+        '''
+        使用组合匹配器扫描文件，文件内容只需要扫描一遍
+        @params:
+            matcher:  FeatureMatcher
+            ctxrange: 记录多少行上下文信息
+        @return:
+            [(feature, MatchContext), ...]
+        '''
+        return [(feature, self.match_context(pattern, start, ctxrange)) \
+            for feature, pattern, start in matcher.match(self._content)]
+
+
+    def candidates(self, matcher):
+        '''
+        预过滤之后可能命中的正则的序号列表
+        '''
+        return matcher.candidates(self._content)
+
+
+    def match_pattern(self, matcher, index):
+        '''
+        只使用组合匹配器中的第index个正则匹配文件内容，不生成上下文信息
+        @return:
+            [(feature, pattern, start), ...]
+        '''
+        return matcher.match_pattern(self._content, index)
+
+
+    def scan_pattern(self, matcher, index, ctxrange):
+        '''
+        只使用组合匹配器中的第index个正则扫描文件
+        @return:
+            [(feature, MatchContext), ...]
+        '''
+        return [(feature, self.match_context(pattern, start, ctxrange)) \
+            for feature, pattern, start in matcher.match_pattern(
+            self._content, index)]
+
+
+    def match_context(self, pattern, start, ctxrange):
+        '''
+        生成匹配位置start处的上下文信息
+        '''
+        lineno = self.get_lineno(start)
+        ctxlines = self.get_context_lines(lineno, ctxrange)
+
+        return MatchContext(self._filename, pattern.pattern, lineno, ctxlines)
+
+
 
 class FileManager(object):
     '''
@@ -143,6 +363,9 @@ class FileManager(object):
         #     }
         #
         self._map_conf = {}
+        # 由 _map_conf 生成的文件类型映射规则，ScopeMap
+        self._extension_map = None
+        self._metainfo_map = None
         # 敏感文件定义信息，结构：
         #     {'patterns':[pattern, ...]}
         self._senfile_conf = {}
@@ -150,24 +373,50 @@ class FileManager(object):
         # 保存文件统计信息
         self._scope_statistics = {}
 
-        self._gitignores = []
+        # 根据参数配置编译的文件过滤规则
+        self._skip_rules = None
+
+        # git变更信息，仅扫描变更的文件时使用
+        self._changes = None
+
+        # 各目录中的文件生效的忽略规则，{directory: IgnoreRules}，监控文件变化时使用
+        self._ignores = {}
 
 
     def init(self):
+        '''
+        根据 conf 初始化，可以重复调用，每次扫描之前重新统计
+        '''
         self._load_map_conf()
         self._load_senfiles_conf()
 
+        self._scope_statistics = {}
+        self._ignores = {}
+
+        self._skip_rules = SkipRules(conf.excludes, conf.igexts,
+            conf.extensions)
+
+        if conf.since:
+            self._changes = GitChanges(conf.target, conf.since)
+        else:
+            self._changes = None
+
 
     @property
     def scope_statistics(self):
         return self._scope_statistics
 
 
+    @property
+    def changes(self):
+        return self._changes
+
+
     def _load_map_conf(self):
         '''
         加载文件类型映射信息
         '''
-        config = YamlConf(conf.mapfile)
+        config = rulepack.load_yaml(conf.mapfile)
 
         self._map_conf['extensions'] = []
         self._map_conf['metainfos'] = []
@@ -184,12 +433,15 @@ class FileManager(object):
                 'scope': meta['scope']
                 })
 
+        self._extension_map = ScopeMap(self._map_conf['extensions'])
+        self._metainfo_map = ScopeMap(self._map_conf['metainfos'])
+
 
     def _load_senfiles_conf(self):
         '''
         加载敏感可以文件配置
         '''
-        config = YamlConf(conf.senfiles)
+        config = rulepack.load_yaml(conf.senfiles)
 
         self._senfile_conf['patterns'] = []
         for pattern in config['patterns']:
@@ -211,73 +463,344 @@ class FileManager(object):
         '''
         通过参数配置根据文件名过滤文件
         '''
-        filename_sp = os.path.split(filename)
-        for vs in ['.git', 'CVS', '.svn']:
-            if vs in filename_sp:
-                return True
-
-        if conf.excludes:
-            for kw in conf.excludes:
-                if kw in filename:
-                    return True
-
-        if conf.igexts:
-            for ext in conf.igexts:
-                if filename.endswith(ext):
-                    return True
-
-        if conf.extensions:
-            is_ext_match = False
-            for ext in conf.extensions:
-                if filename.endswith(ext):
-                    is_ext_match = True
-                    break
-            
-            if not is_ext_match:
-                return True
+        return self._skip_rules.is_file_skip(filename)
 
 
-    def walk(self):
+    def walk_targets(self):
+        '''
+        遍历待扫描目录，返回 (filename, scope)
+            不读取文件内容，也不记录敏感文件、统计信息，
+            需要由调用者通过 record 记录
+        '''
         target_dir = os.path.realpath(conf.target)
         if not os.path.exists(target_dir):
             raise FileError("cannot find directory {}".format(target_dir))
 
-        for path, dirs, files in os.walk(target_dir):
-            for f in files:
-                filename = os.path.join(path, f)
-                if self.is_file_skip(filename):
-                    continue
+        if os.path.isfile(target_dir):
+            filenames = [target_dir]
+        else:
+            filenames = self._walk_files(target_dir)
+
+        for filename in filenames:
+            if self.is_file_skip(filename):
+                continue
+
+            scope = self._classify(filename)
+            if not scope:
+                continue
 
-                scope = self._classify(filename)
-                if not scope:
-                    continue
+            yield filename, scope
 
-                self._add_sensitive_file(filename, scope)
 
-                file = File(filename, scope)
-                if scope in self._scope_statistics:
-                    self._scope_statistics[scope] += file.length
+    def _walk_files(self, target_dir):
+        '''
+        遍历目录中的所有文件，指定了git变更信息时只返回变更的文件
+        '''
+        if self._changes is not None:
+            prefix = target_dir.rstrip(os.sep) + os.sep
+            # {directory: 是否需要扫描}
+            targets = {target_dir: True}
+            for filename in self._changes.files:
+                if filename.startswith(prefix) and \
+                    os.path.isfile(filename) and \
+                    self._is_target_file(filename, targets):
+                    yield filename
+            return
+
+        if conf.noignore:
+            ignores = None
+        else:
+            ignores = IgnoreRules.load_parents(target_dir)
+
+        for path, is_dir in self._walk_tree(target_dir, ignores):
+            if not is_dir:
+                yield path
+
+
+    def _is_target_file(self, filename, targets):
+        '''
+        判断扫描目录中的文件是否需要扫描，文件所在的目录需要逐级判断过滤、忽略规则
+        @params:
+            targets: 已经判断过的目录，{directory: 是否需要扫描}，需要包含扫描目录
+        '''
+        directory = os.path.dirname(filename)
+
+        dirs = []
+        parent = directory
+        while parent not in targets:
+            dirs.append(parent)
+            parent = os.path.dirname(parent)
+
+        result = targets[parent]
+        for d in reversed(dirs):
+            result = targets[d] = result and self.is_target_dir(d)
+
+        if not result:
+            return False
+
+        ignores = self._ignore_rules(directory)
+        return ignores is None or not ignores.is_ignored(filename, False)
+
+
+    def _walk_tree(self, root, ignores):
+        '''
+        遍历root中未被过滤、忽略的目录和文件，返回 (path, is_dir)，不包括root自身
+        @params:
+            ignores: root的上层目录生效的忽略规则，为None时不使用忽略规则
+        '''
+        # 深度优先遍历，顺序和os.walk一致：先返回目录中的文件，再依次遍历子目录
+        stack = [(root, ignores)]
+        while stack:
+            path, ignores = stack.pop()
+
+            try:
+                entries = _list_dir(path)
+            except OSError:
+                continue
+
+            if ignores is not None:
+                ignores = ignores.extend(path, [e[0] for e in entries])
+
+            dirs = []
+            for name, fullpath, is_dir, is_link in entries:
+                if is_dir:
+                    if is_link or self._skip_rules.is_dir_skip(fullpath):
+                        continue
+                    if ignores is not None and \
+                        ignores.is_ignored(fullpath, True):
+                        continue
+
+                    dirs.append(fullpath)
+                    yield fullpath, True
                 else:
-                    self._scope_statistics[scope] = file.length
+                    if ignores is not None and \
+                        ignores.is_ignored(fullpath, False):
+                        continue
+
+                    yield fullpath, False
+
+            for d in reversed(dirs):
+                stack.append((d, ignores))
+
+
+    def _parent_ignores(self, directory):
+        '''
+        directory的上层目录生效的忽略规则，directory需要在扫描目录中
+        '''
+        if conf.noignore:
+            return None
+
+        target_dir = os.path.realpath(conf.target)
+        if directory == target_dir or \
+            not directory.startswith(target_dir.rstrip(os.sep) + os.sep):
+            return IgnoreRules.load_parents(directory)
+
+        return self._ignore_rules(os.path.dirname(directory))
+
+
+    def _ignore_rules(self, directory):
+        '''
+        directory中的文件生效的忽略规则
+        '''
+        if conf.noignore:
+            return None
+
+        try:
+            return self._ignores[directory]
+        except KeyError:
+            rules = self._ignores[directory] = \
+                self._parent_ignores(directory).extend(directory)
+            return rules
+
+
+    def walk_tree(self, directory=None):
+        '''
+        遍历directory中需要扫描的子目录和文件，返回 (path, is_dir)，用于监控文件变化
+            不读取文件内容，不判断文件类型
+        @params:
+            directory: 扫描目录中的目录，默认为扫描目录
+        '''
+        target_dir = os.path.realpath(conf.target)
+        if os.path.isfile(target_dir):
+            return iter([(target_dir, False)])
+
+        directory = directory or target_dir
+        return self._walk_tree(directory, self._parent_ignores(directory))
+
+
+    def is_target_dir(self, path):
+        '''
+        判断扫描目录中新出现的目录是否需要扫描
+        '''
+        if self._skip_rules.is_dir_skip(path):
+            return False
+
+        ignores = self._parent_ignores(path)
+        return ignores is None or not ignores.is_ignored(path, True)
+
+
+    def target_scope(self, filename):
+        '''
+        判断变化的文件是否需要扫描
+        @returns:
+            文件的scope，不需要扫描或者文件已经删除时为None
+        '''
+        if not os.path.isfile(filename) or self.is_file_skip(filename):
+            return None
+
+        target_dir = os.path.realpath(conf.target)
+        if os.path.isfile(target_dir):
+            if filename != target_dir:
+                return None
+        else:
+            ignores = self._ignore_rules(os.path.dirname(filename))
+            if ignores is not None and ignores.is_ignored(filename, False):
+                return None
+
+        try:
+            return self._classify(filename)
+        except FileError:
+            return None
+
 
-                yield file
+    def record(self, filename, scope, length):
+        '''
+        记录已扫描文件的敏感文件信息、代码行数统计信息
+        '''
+        self._add_sensitive_file(filename, scope)
+
+        if scope in self._scope_statistics:
+            self._scope_statistics[scope] += length
+        else:
+            self._scope_statistics[scope] = length
+
+
+    def walk(self):
+        for filename, scope in self.walk_targets():
+            file = File(filename, scope)
+            self.record(filename, scope, file.length)
+
+            yield file
 
 
     def _classify(self, filename):
         '''
         判断文件类型，将文件类型映射到相应的scope
+            先通过文件名判断，无法判断时读取一次文件头，使用文件头判断
+        '''
+        scope = self._extension_map.search(filename)
+        if scope:
+            return scope
+
+        if not self._metainfo_map:
+            return None
+
+        try:
+            with open(filename, 'rb') as _file:
+                header = _file.read(self._METAINFOLEN)
+        except IOError:
+            raise FileError("read file '{0}' error".format(filename))
+
+        return self._metainfo_map.search(header)
+
+
+
+class SkipRules(object):
+    '''
+    根据参数配置的文件过滤规则
+        excludes、igexts、extensions 编译为正则；
+        目录路径包含excludes关键字时，目录中的所有文件都会被过滤，直接跳过整个目录
+    '''
+    # 版本控制系统目录
+    VCS_DIRS = frozenset(['.git', 'CVS', '.svn'])
+
+    def __init__(self, excludes=None, igexts=None, extensions=None):
+        '''
+        @params:
+            excludes:   忽略路径包含这些关键字的文件
+            igexts:     忽略以这些后缀结尾的文件
+            extensions: 只保留以这些后缀结尾的文件
         '''
-        for ext in self._map_conf['extensions']:
-            m = ext['pattern'].search(filename)
-            if m:
-                return ext['scope']
-
-        for meta in self._map_conf['metainfos']:
-            with open(filename) as _file:
-                content = _file.read(self._METAINFOLEN)
-                m = meta['pattern'].search(content)
-                if m:
-                    return meta['scope']
+        excludes = [re.escape(kw) for kw in excludes or []]
+        # 使用 \Z 而不是 $，$ 也能匹配结尾的换行符之前
+        igexts = [re.escape(ext) + r"\Z" for ext in igexts or []]
+        extensions = [re.escape(ext) for ext in extensions or []]
+
+        self._excludes = re.compile("|".join(excludes)) if excludes else None
+        self._skips = re.compile("|".join(excludes + igexts)) \
+            if excludes or igexts else None
+        self._extensions = re.compile("(?:" + "|".join(extensions) + r")\Z") \
+            if extensions else None
+
+
+    def is_dir_skip(self, path):
+        '''
+        判断是否跳过整个目录
+        '''
+        if os.path.basename(path) in self.VCS_DIRS:
+            return True
+
+        if self._excludes and self._excludes.search(path + os.sep):
+            return True
+
+        return False
+
+
+    def is_file_skip(self, filename):
+        '''
+        判断是否过滤文件
+        '''
+        if os.path.basename(filename) in self.VCS_DIRS:
+            return True
+
+        if self._skips and self._skips.search(filename):
+            return True
+
+        if self._extensions and not self._extensions.search(filename):
+            return True
+
+        return False
+
+
+
+class ScopeMap(object):
+    '''
+    文件类型映射规则
+        所有规则合并为一个正则快速判断是否有规则匹配，
+        有规则匹配时按照规则定义的顺序返回第一个匹配的scope
+    '''
+    def __init__(self, rules):
+        '''
+        @params:
+            rules: [{'pattern':xx, 'scope':xx}, ...]
+        '''
+        self._rules = rules
+
+        patterns = [r['pattern'] for r in rules \
+            if r['pattern'].flags == 0 and is_combinable(r['pattern'])]
+
+        # 所有规则都可以合并时，合并的正则不匹配则没有规则匹配
+        if patterns and len(patterns) == len(rules):
+            self._guard = re.compile("|".join(p.pattern for p in patterns))
+        else:
+            self._guard = None
+
+
+    def __len__(self):
+        return len(self._rules)
+
+
+    def search(self, content):
+        '''
+        @returns:
+            第一个匹配content的规则的scope，没有匹配的规则时返回None
+        '''
+        if self._guard and not self._guard.search(content):
+            return None
+
+        for rule in self._rules:
+            if rule['pattern'].search(content):
+                return rule['scope']
 
         return None
 
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import os
+import re
+
+
+
+# 忽略文件名称，语法和.gitignore相同
+IGNORE_FILES = ['.gitignore', '.kiwiignore']
+
+
+
+def translate(pattern):
+    '''
+    将.gitignore的通配符转换为正则表达式
+        *   匹配除 / 之外的任意字符
+        ?   匹配除 / 之外的单个字符
+        **  开头的 **/ 、中间的 /**/ 匹配任意层目录，结尾的 /** 匹配目录中的所有内容
+    '''
+    result = []
+
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+
+        if c == '*':
+            if pattern[i:i+2] == '**' and (i == 0 or pattern[i-1] == '/'):
+                if pattern[i+2:i+3] == '/':
+                    result.append('(?:.*/)?')
+                    i += 3
+                    continue
+                elif i+2 == n:
+                    result.append('.*')
+                    i += 2
+                    continue
+
+            while i < n and pattern[i] == '*':
+                i += 1
+            result.append('[^/]*')
+            continue
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+
+            if j >= n:
+                result.append('\\[')
+            else:
+                chars = pattern[i+1:j].replace('\\', '\\\\')
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                result.append('[' + chars + ']')
+                i = j
+        elif c == '\\' and i+1 < n:
+            i += 1
+            result.append(re.escape(pattern[i]))
+        else:
+            result.append(re.escape(c))
+
+        i += 1
+
+    return "".join(result)
+
+
+
+class IgnoreRule(object):
+    '''
+    忽略规则
+        同一个忽略文件中连续的、类型相同的多条规则合并为一个正则
+    '''
+    def __init__(self, base, negate, dir_only, regexes):
+        '''
+        @params:
+            base:     规则所在忽略文件的目录
+            negate:   是否是 ! 开头的反向规则
+            dir_only: 是否只匹配目录
+            regexes:  规则转换得到的正则列表，匹配相对于base的路径
+        '''
+        self.base = base.rstrip(os.sep) + os.sep
+        self.negate = negate
+        self.dir_only = dir_only
+        self.regexes = regexes
+
+        self._pattern = re.compile("(?:" + "|".join(regexes) + ")$")
+
+
+    @classmethod
+    def from_line(cls, base, line):
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+
+        # 包含 / 的规则相对于忽略文件所在的目录，否则匹配任意一层的文件名
+        if '/' in line:
+            regex = translate(line.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + translate(line)
+
+        return cls(base, negate, dir_only, [regex])
+
+
+    def merge(self, other):
+        '''
+        合并类型相同的规则，无法合并时返回None
+        '''
+        if (self.base, self.negate, self.dir_only) != \
+            (other.base, other.negate, other.dir_only):
+            return None
+
+        return IgnoreRule(self.base, self.negate, self.dir_only,
+            self.regexes + other.regexes)
+
+
+    def match(self, path, is_dir):
+        '''
+        @params:
+            path:   绝对路径
+            is_dir: path是否是目录
+        '''
+        if self.dir_only and not is_dir:
+            return False
+
+        if not path.startswith(self.base):
+            return False
+
+        relpath = path[len(self.base):]
+        if os.sep != '/':
+            relpath = relpath.replace(os.sep, '/')
+
+        return bool(self._pattern.match(relpath))
+
+
+
+class IgnoreRules(object):
+    '''
+    某个目录生效的所有忽略规则，包括上层目录的忽略规则
+    '''
+    def __init__(self, rules=None):
+        self._rules = rules or []
+
+
+    @staticmethod
+    def parse(directory, filename):
+        '''
+        解析忽略文件
+        @returns:
+            [IgnoreRule, ...]
+        '''
+        result = []
+
+        try:
+            with open(filename) as _file:
+                lines = _file.read().splitlines()
+        except IOError:
+            return result
+
+        for line in lines:
+            if not line or line.startswith('#'):
+                continue
+
+            # 行尾未转义的空格被忽略
+            stripped = line.rstrip(' ')
+            if stripped.endswith('\\') and len(stripped) < len(line):
+                stripped = stripped + ' '
+            line = stripped
+
+            if line.startswith('\\#') or line.startswith('\\!'):
+                line = line[1:]
+
+            if not line or line == '!':
+                continue
+
+            rule = IgnoreRule.from_line(directory, line)
+            merged = result[-1].merge(rule) if result else None
+            if merged:
+                result[-1] = merged
+            else:
+                result.append(rule)
+
+        return result
+
+
+    def extend(self, directory, names=None):
+        '''
+        加载目录中的忽略文件
+        @params:
+            names: 目录中的文件名列表，为None时直接检查忽略文件是否存在
+        @returns:
+            目录中有忽略文件时返回新的IgnoreRules，否则返回self
+        '''
+        rules = []
+        for ignore_file in IGNORE_FILES:
+            if names is not None and ignore_file not in names:
+                continue
+
+            filename = os.path.join(directory, ignore_file)
+            if names is None and not os.path.isfile(filename):
+                continue
+
+            rules.extend(self.parse(directory, filename))
+
+        if not rules:
+            return self
+
+        return IgnoreRules(self._rules + rules)
+
+
+    def is_ignored(self, path, is_dir):
+        '''
+        判断路径是否被忽略，后定义的规则优先
+        '''
+        for rule in reversed(self._rules):
+            if rule.match(path, is_dir):
+                return not rule.negate
+
+        return False
+
+
+    @classmethod
+    def load_parents(cls, directory):
+        '''
+        加载directory所在git仓库中上层目录的忽略规则
+            directory不在git仓库中时不加载上层目录的忽略规则
+        '''
+        parents = []
+
+        if os.path.exists(os.path.join(directory, '.git')):
+            return cls()
+
+        path = os.path.dirname(directory)
+        while path and path != os.path.dirname(path):
+            parents.append(path)
+            if os.path.exists(os.path.join(path, '.git')):
+                break
+            path = os.path.dirname(path)
+        else:
+            parents = []
+
+        rules = cls()
+        for path in reversed(parents):
+            rules = rules.extend(path)
+
+        return rules
@@ -11,10 +11,12 @@ Copyright (c) 2016 alpha1e0
 import os
 import time
 import json
+import hashlib
 import sqlite3
 
 from common import conf
 from collections import OrderedDict
+from contextlib import contextmanager
 from exception import IssueFormatError
 from exception import DatabaseError
 from constant import High, Medium, Low, Info
@@ -22,11 +24,18 @@ from constant import New, Old, Falsep
 
 
 
-class Issue(dict):
+class Issue(object):
+    '''
+    漏洞信息
+        使用 __slots__ 保存属性以减少内存占用，同时保留字典形式的访问接口，
+        未设置的属性视为不存在的键
+    '''
     ATTRIBUTES = ['ID', 'name', 'scope', 'severity', 'confidence',
         'references', 'pattern', 'filename', 'lineno', 'context',
         'status', 'comment']
 
+    __slots__ = tuple(ATTRIBUTES)
+
 
     def __init__(self, **kwargs):
         '''
@@ -58,22 +67,194 @@ class Issue(dict):
         if 'status' not in kwargs:
             kwargs['status'] = New
 
-        super(Issue, self).__init__(kwargs)
+        for key, value in kwargs.iteritems():
+            setattr(self, key, value)
+
+
+    def __getattr__(self, key):
+        '''
+        未设置的属性返回None
+        '''
+        if key in self.ATTRIBUTES:
+            return None
+        else:
+            raise AttributeError(key)
+
+
+    def __getitem__(self, key):
+        if key not in self.ATTRIBUTES:
+            raise KeyError(key)
+
+        try:
+            return object.__getattribute__(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
 
     def __setitem__(self, key, value):
         if key not in self.ATTRIBUTES:
             raise IssueFormatError('Key {0} is not allowed for Issue'.\
-                    format(item))
+                    format(key))
         else:
-            super(Issue, self).__setitem__(key, value)
+            setattr(self, key, value)
 
 
-    def __getattr__(self, key):
-        if key in self.ATTRIBUTES:
-            return self.get(key, None)
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
         else:
-            super(Issue, self).__getitem__(key)
+            return True
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __repr__(self):
+        return "Issue({0!r})".format(self.to_dict())
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def keys(self):
+        return [key for key in self.ATTRIBUTES if key in self]
+
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+    def to_dict(self):
+        '''
+        转换为字典，用于生成JSON等报告
+        '''
+        return dict(self.items())
+
+
+    def to_record(self):
+        '''
+        转换为紧凑的元组形式，用于在扫描进程之间传递
+            元组按照 ATTRIBUTES 顺序保存，不存在的属性为 None
+        '''
+        return tuple(self.get(key) for key in self.ATTRIBUTES)
+
+
+    @classmethod
+    def from_record(cls, record):
+        '''
+        从 to_record 生成的元组恢复 Issue
+        '''
+        return cls(**dict((key, value) \
+            for key, value in zip(cls.ATTRIBUTES, record) \
+            if value is not None))
+
+
+
+def matched_line(context, lineno):
+    '''
+    从issue的上下文中取出匹配的代码行，没有上下文时为空
+    '''
+    for line in context or []:
+        if line[0] == lineno:
+            return line[1]
+
+    return u""
+
+
+def issue_fingerprint(ID, path, line, occurrence=0):
+    '''
+    计算issue的指纹，用于对比两次扫描的结果
+        由规则ID、相对扫描目录的文件路径、去除空白之后的匹配代码行计算，不包括行号，
+        代码位置移动时指纹不变；同一个文件中相同的代码行按照出现顺序区分
+    @params:
+        path:       相对扫描目录的文件路径，使用/分隔
+        occurrence: 相同的规则ID、文件、代码行第几次出现
+    '''
+    values = [value.encode("utf-8") if isinstance(value, unicode) else value \
+        for value in (ID, path, u"".join(line.split()), str(occurrence))]
+
+    return hashlib.sha1("\0".join(values)).hexdigest()
+
+
+class Fingerprinter(object):
+    '''
+    按照扫描顺序计算issue的指纹
+        记录相同的 (ID, 文件, 代码行) 已经出现的次数，同一次扫描的issue需要使用同一个对象，
+        并且同一个文件的issue需要连续计算
+    '''
+    def __init__(self, directory=None):
+        '''
+        @params:
+            directory: 扫描目录，指纹使用相对该目录的文件路径；扫描单个文件时为文件所在目录
+        '''
+        if isinstance(directory, unicode):
+            directory = directory.encode("utf-8")
+
+        if directory and os.path.isfile(directory):
+            directory = os.path.dirname(directory)
+
+        self.directory = os.path.realpath(directory).rstrip(os.sep) \
+            if directory else None
+
+        # 同一个文件的issue是连续产生的，只记录当前文件中的出现次数
+        self._path = None
+        self._occurrences = {}
+
+
+    def relpath(self, filename):
+        '''
+        相对扫描目录的文件路径，使用/分隔
+        '''
+        if isinstance(filename, unicode):
+            filename = filename.encode("utf-8")
+
+        if self.directory and filename.startswith(self.directory + os.sep):
+            filename = filename[len(self.directory) + 1:]
+
+        return filename.replace(os.sep, "/")
+
+
+    def __call__(self, ID, filename, lineno, context):
+        path = self.relpath(filename)
+        if path != self._path:
+            self._path = path
+            self._occurrences = {}
+
+        key = (ID, path, u"".join(matched_line(context, lineno).split()))
+        occurrence = self._occurrences[key] = self._occurrences.get(key, -1) \
+            + 1
+
+        return issue_fingerprint(key[0], key[1], key[2], occurrence)
+
+
+
+def readonly_uri(filename):
+    '''
+    以只读方式打开数据库文件的URI
+        Python2 的 sqlite3 模块不能按连接启用URI文件名，sqlite 编译时没有启用URI文件名时
+        返回None，调用者只能按普通文件名打开
+    '''
+    options = [row[0] for row in sqlite3.connect(":memory:").execute(
+        "pragma compile_options")]
+    if "USE_URI" not in options and "USE_URI=1" not in options:
+        return None
+
+    # urllib 会导入ssl等较重的依赖，只在打开只读数据库时导入
+    import urllib
+
+    return "file:{0}?mode=ro".format(urllib.pathname2url(
+        os.path.abspath(filename)))
 
 
 
@@ -93,16 +274,81 @@ class IssueDatabase(object):
     '''
     Issue数据库操作类
     '''
-    def __init__(self, dbname):
+    # issue去重使用的唯一索引，name/pattern/filename/lineno相同的issue只记录一次
+    _ISSUE_INDEX = "IssueKey"
+
+    # 统计、过滤、排序、对比基线使用的索引字段
+    _INDEXED_FIELDS = ('severity', 'confidence', 'status', 'issueid',
+        'filename', 'fingerprint')
+
+    # Issues 表的字段，不包括自增id
+    _ISSUE_FIELDS = ('issueid', 'name', 'scope', 'severity', 'confidence',
+        'reference', 'pattern', 'filename', 'lineno', 'context', 'status',
+        'comment', 'fingerprint')
+
+    # 对比基线时，基线中存在、本次扫描中不存在（已修复）的issue
+    _FIXED_TABLE = "FixedIssues"
+
+    # 对比旧版本的基线时，计算了指纹的基线issue临时表
+    _BASELINE_TABLE = "BaselineIssues"
+
+    # query_issues 允许排序的字段
+    SORT_FIELDS = ('id', 'issueid', 'severity', 'confidence', 'status',
+        'filename', 'lineno')
+
+    # 全文索引表，索引漏洞名称、文件名和解码之后的上下文，由触发器维护
+    _SEARCH_TABLE = "IssueSearch"
+
+    # 全文索引的外部内容视图，context 列为上下文中所有代码行拼接的文本
+    _SEARCH_CONTENT = "IssueSearchContent"
+
+    # 统计信息汇总表，由触发器在插入、修改、删除issue时更新
+    _SUMMARY_TABLE = "Summary"
+
+    def __init__(self, dbname, wal=False, summary=False, shared=False,
+        directory=None, readonly=False, upgrade=True):
+        '''
+        @params:
+            dbname:    数据库文件
+            wal:       是否使用WAL日志模式
+            summary:   是否创建统计信息汇总表，已经存在汇总表时总是使用汇总表
+            shared:    数据库连接是否在多个线程中共享，由调用者保证同一时间只有一个线程使用
+            directory: 扫描目录，issue指纹使用相对该目录的文件路径
+            readonly:  只读打开已有的数据库，不升级旧版本数据库、不创建索引，用于查看报告
+            upgrade:   是否升级旧版本数据库、创建索引，为False时只能打开已有的数据库，
+                       用于修改报告中的issue
+        '''
         self._dbname = dbname
+        self._shared = shared
         self._con = None
         self._cur = None
 
+        self._fingerprint = Fingerprinter(directory)
+
+        if readonly or not upgrade:
+            self._connect(readonly, create=False)
+
+            self._summary = self._has_object("table", self._SUMMARY_TABLE)
+            self._search = self._has_object("table", self._SEARCH_TABLE)
+            return
+
         if os.path.exists(self._dbname):
             self._connect()
+            self._add_fingerprints()
         else:
             self._create()
 
+        self._create_index()
+
+        if wal:
+            self._sql("pragma journal_mode=wal")
+
+        self._summary = self._has_object("table", self._SUMMARY_TABLE)
+        if summary and not self._summary:
+            self._create_summary()
+
+        self._search = self._create_search_index()
+
 
     def _sql(self, *args):
         '''
@@ -129,9 +375,18 @@ class IssueDatabase(object):
         return self._cur.fetchall()
 
 
-    def _connect(self):
+    def _connect(self, readonly=False, create=True):
+        if not create and not os.path.isfile(self._dbname):
+            raise DatabaseError("cannot find database {0}".format(
+                self._dbname))
+
+        uri = readonly_uri(self._dbname) if readonly else None
+
         try:
-            self._con = sqlite3.connect(self._dbname)
+            self._con = sqlite3.connect(uri or self._dbname,
+                check_same_thread=not self._shared)
+            if readonly and not uri:
+                self._con.execute("pragma query_only=1")
             self._con.row_factory = dict_factory
             self._cur = self._con.cursor()
         except sqlite3.Error as error:
@@ -166,11 +421,204 @@ class IssueDatabase(object):
             "lineno integer,"
             "context ntext,"
             "status integer,"
-            "comment ntext)")
+            "comment ntext,"
+            "fingerprint nchar(40))")
 
         self._sql(create_issue_table_cmd)
 
 
+    def _add_fingerprints(self):
+        '''
+        旧版本生成的数据库中没有指纹字段，添加字段并计算已有issue的指纹
+        '''
+        columns = [row['name'] for row in self._query(
+            "pragma table_info(Issues)")]
+        if not columns or 'fingerprint' in columns:
+            return
+
+        directory = self._fingerprint.directory
+        if directory is None:
+            info = self._query("select directory from Info limit 1")
+            if info:
+                directory = info[0]['directory']
+        fingerprint = Fingerprinter(directory)
+
+        rows = self._query("select id, issueid, filename, lineno, context "
+            "from Issues order by id")
+
+        try:
+            with self._con:
+                self._con.execute("alter table Issues add column "
+                    "fingerprint nchar(40)")
+                self._con.executemany("update Issues set fingerprint=? "
+                    "where id=?", ((fingerprint(row['issueid'],
+                    row['filename'], row['lineno'],
+                    json.loads(row['context'] or "[]")), row['id']) \
+                    for row in rows))
+        except sqlite3.Error as error:
+            raise DatabaseError("add fingerprints to {0} error, reason: {1}"\
+                .format(self._dbname, str(error)))
+
+
+    def _has_object(self, type, name):
+        '''
+        判断数据库中是否存在指定的表、索引
+        '''
+        result = self._query("select name from sqlite_master where "
+            "type=? and name=?", (type, name))
+
+        return True if result else False
+
+
+    def _create_index(self):
+        '''
+        创建issue去重使用的唯一索引，以及统计、分类查询使用的索引
+            旧版本生成的数据库中没有唯一索引，可能存在重复的issue，创建索引之前先删除重复的issue
+        '''
+        if not self._has_object("index", self._ISSUE_INDEX):
+            self._sql("delete from Issues where id not in (select min(id) "
+                "from Issues group by name, pattern, filename, lineno)")
+
+            self._sql("create unique index if not exists {0} on "
+                "Issues(name, pattern, filename, lineno)".format(
+                self._ISSUE_INDEX))
+
+        for field in self._INDEXED_FIELDS:
+            self._sql("create index if not exists Issue{0} on "
+                "Issues({1})".format(field.capitalize(), field))
+
+
+    def _create_summary(self):
+        '''
+        创建统计信息汇总表，按照已有的issue初始化，之后由触发器维护
+            kind 为 severity 或 status，value 为对应的等级、状态，count 为issue个数
+        '''
+        self._sql("create table if not exists {0}("
+            "kind nchar(16),"
+            "value integer,"
+            "count integer,"
+            "primary key(kind, value))".format(self._SUMMARY_TABLE))
+
+        self._sql("delete from {0}".format(self._SUMMARY_TABLE))
+        for kind in ("severity", "status"):
+            self._sql("insert into {0}(kind, value, count) "
+                "select '{1}', {1}, COUNT(*) from Issues group by {1}".format(
+                self._SUMMARY_TABLE, kind))
+
+        def _change(kind, row, delta):
+            return ("insert or ignore into {table}(kind, value, count) "
+                "values('{kind}', {row}.{kind}, 0);"
+                "update {table} set count=count+({delta}) "
+                "where kind='{kind}' and value={row}.{kind};").format(
+                table=self._SUMMARY_TABLE, kind=kind, row=row, delta=delta)
+
+        self._sql("create trigger if not exists SummaryInsert after insert "
+            "on Issues begin {0}{1} end".format(
+            _change("severity", "new", 1), _change("status", "new", 1)))
+
+        self._sql("create trigger if not exists SummaryDelete after delete "
+            "on Issues begin {0}{1} end".format(
+            _change("severity", "old", -1), _change("status", "old", -1)))
+
+        self._sql("create trigger if not exists SummaryUpdate after update "
+            "of severity, status on Issues begin {0}{1}{2}{3} end".format(
+            _change("severity", "old", -1), _change("status", "old", -1),
+            _change("severity", "new", 1), _change("status", "new", 1)))
+
+        self._summary = True
+
+
+    @staticmethod
+    def _decoded_context(row):
+        '''
+        将json格式的上下文解码为代码文本的sql表达式
+        '''
+        return ("(select group_concat(json_extract(value, '$[1]'), '') "
+            "from json_each({0}.context))".format(row))
+
+
+    def _create_search_index(self):
+        '''
+        创建FTS5全文索引，已有的issue在创建时建立索引
+        @returns:
+            sqlite不支持FTS5或者json函数时返回False
+        '''
+        if self._has_object("table", self._SEARCH_TABLE):
+            return True
+
+        # Python2 的 sqlite3 在DDL之前会自动提交，下面的语句不在同一个事务中，
+        # 需要先确认支持FTS5和json函数，避免只创建了部分视图、触发器
+        if not self._search_supported():
+            return False
+
+        insert = ("insert into {table}(rowid, name, filename, context) "
+            "values(new.id, new.name, new.filename, {context});").format(
+            table=self._SEARCH_TABLE, context=self._decoded_context("new"))
+        delete = ("insert into {table}({table}, rowid, name, filename, "
+            "context) values('delete', old.id, old.name, old.filename, "
+            "{context});").format(table=self._SEARCH_TABLE,
+            context=self._decoded_context("old"))
+
+        try:
+            with self._con:
+                self._con.execute("create view if not exists {0} as "
+                    "select id, name, filename, {1} as context "
+                    "from Issues".format(self._SEARCH_CONTENT,
+                    self._decoded_context("Issues")))
+
+                # 标识符中的下划线不作为分隔符，例如 $_GET、user_id 作为一个词
+                self._con.execute("create virtual table {0} using fts5("
+                    "name, filename, context, content='{1}', "
+                    "content_rowid='id', "
+                    "tokenize=\"unicode61 tokenchars '_'\")".format(
+                    self._SEARCH_TABLE, self._SEARCH_CONTENT))
+
+                self._con.execute("create trigger if not exists "
+                    "IssueSearchInsert after insert on Issues "
+                    "begin {0} end".format(insert))
+                self._con.execute("create trigger if not exists "
+                    "IssueSearchDelete after delete on Issues "
+                    "begin {0} end".format(delete))
+                self._con.execute("create trigger if not exists "
+                    "IssueSearchUpdate after update of name, filename, "
+                    "context on Issues begin {0}{1} end".format(
+                    delete, insert))
+
+                # 外部内容为视图时不支持 rebuild，直接插入已有的issue
+                self._con.execute("insert into {0}(rowid, name, filename, "
+                    "context) select id, name, filename, context from {1}"\
+                    .format(self._SEARCH_TABLE, self._SEARCH_CONTENT))
+        except sqlite3.OperationalError:
+            return False
+
+        return True
+
+
+    @staticmethod
+    def _search_supported():
+        '''
+        sqlite是否支持全文索引需要的FTS5和json函数
+        '''
+        con = sqlite3.connect(":memory:")
+        try:
+            con.execute("select value from json_each('[[1, \"a\"]]') "
+                "where json_extract(value, '$[1]')='a'").fetchall()
+            con.execute("create virtual table Probe using fts5(content)")
+        except sqlite3.Error:
+            return False
+        finally:
+            con.close()
+
+        return True
+
+
+    def close(self):
+        if self._con:
+            self._con.close()
+            self._con = None
+            self._cur = None
+
+
     def record_scan_info(self, directory, scope_titles, scope_contents):
         insert_info_cmd = ("insert into Info(directory, scan_time, "
             "scope_titles, scope_contents) "
@@ -223,17 +671,9 @@ class IssueDatabase(object):
         return True if result else False
 
 
-    def add_issue(self, issue):
-        if self.is_issue_recorded(issue):
-            return
-            
-        insert_cmd = ("insert into Issues(issueid, name, scope, severity, "
-            "confidence, reference, pattern, filename, lineno, "
-            "context, status, comment) values(?, ?, ?, ?, ?, ?, ?, ?, ?,"
-            " ?, ?, ?)")
-
-        self._sql(insert_cmd, (
-            str(issue.ID), 
+    def _issue_values(self, issue):
+        return (
+            str(issue.ID),
             str(issue.name),
             json.dumps(issue.scope),
             issue.severity,
@@ -244,7 +684,30 @@ class IssueDatabase(object):
             issue.lineno,
             json.dumps(issue.context),
             issue.status,
-            str(issue.comment)))
+            str(issue.comment),
+            self._fingerprint(str(issue.ID), str(issue.filename),
+                issue.lineno, issue.context))
+
+
+    def add_issue(self, issue):
+        self.add_issues([issue])
+
+
+    def add_issues(self, issues):
+        '''
+        在一个事务中批量写入issue，已经记录的issue由唯一索引忽略
+        '''
+        insert_cmd = "insert or ignore into Issues({0}) values({1})".format(
+            ", ".join(self._ISSUE_FIELDS),
+            ", ".join(["?"] * len(self._ISSUE_FIELDS)))
+
+        try:
+            with self._con:
+                self._con.executemany(insert_cmd,
+                    (self._issue_values(issue) for issue in issues))
+        except sqlite3.Error as error:
+            raise DatabaseError("execute sql command {0} error, reason: {1}".\
+                format(insert_cmd, str(error)))
 
 
     def get_issues(self):
@@ -253,18 +716,248 @@ class IssueDatabase(object):
         return self._query(query_cmd)
 
 
-    def get_classfied_issues(self):
+    def apply_baseline(self, baseline):
         '''
-        获取分类之后的issues
+        和基线扫描结果对比，按照指纹标记issue
+            基线中存在的issue标记为老漏洞，基线中标记为误报的issue仍然标记为误报，
+            并保留基线中的备注；基线中存在、本次扫描中不存在的issue保存到 FixedIssues 表
+        @params:
+            baseline: 基线扫描结果数据库
+        @returns:
+            (新漏洞个数, 老漏洞个数, 已修复漏洞个数)
+        '''
+        if not os.path.isfile(baseline):
+            raise DatabaseError("cannot find baseline database {0}".format(
+                baseline))
+
+        # 基线只读，不修改基线数据库
+        try:
+            self._con.execute("attach database ? as base",
+                (readonly_uri(baseline) or baseline,))
+        except sqlite3.Error as error:
+            raise DatabaseError("attach baseline {0} error, reason: {1}".\
+                format(baseline, str(error)))
+
+        fields = ", ".join(self._ISSUE_FIELDS)
+
+        try:
+            table = self._baseline_issues()
+            # 只标记本次扫描新记录的issue
+            matched = ("status=? and fingerprint in "
+                "(select fingerprint from " + table + "{0})")
+
+            with self._con:
+                self._con.execute("update Issues set comment=(select "
+                    "b.comment from " + table + " b where "
+                    "b.fingerprint=Issues.fingerprint and b.comment!='' and "
+                    "b.comment!='None' limit 1) where " + matched.format(
+                    " where comment!='' and comment!='None'"), (New,))
+                self._con.execute("update Issues set status=? where " + \
+                    matched.format(" where status=?"), (Falsep, New, Falsep))
+                self._con.execute("update Issues set status=? where " + \
+                    matched.format(""), (Old, New))
+
+                self._con.execute("create table if not exists {0}("
+                    "id integer primary key autoincrement, {1})".format(
+                    self._FIXED_TABLE, fields))
+                self._con.execute("delete from {0}".format(self._FIXED_TABLE))
+                self._con.execute("insert into {0}({1}) select {1} from "
+                    "{2} b where not exists (select 1 from Issues i "
+                    "where i.fingerprint=b.fingerprint) order by b.id".format(
+                    self._FIXED_TABLE, fields, table))
+
+            counts = self._query("select (select COUNT(*) from Issues where "
+                "status=?) as new, (select COUNT(*) from Issues where "
+                "status!=?) as old, (select COUNT(*) from {0}) as fixed"\
+                .format(self._FIXED_TABLE), (New, New))[0]
+        except sqlite3.Error as error:
+            raise DatabaseError("compare with baseline {0} error, reason: {1}"\
+                .format(baseline, str(error)))
+        finally:
+            self._con.execute("drop table if exists temp.{0}".format(
+                self._BASELINE_TABLE))
+            self._con.execute("detach database base")
+
+        return counts['new'], counts['old'], counts['fixed']
+
+
+    def _baseline_issues(self):
         '''
-        new_issues = self._query("select * from Issues where status={0}"\
-            .format(New))
+        基线中的issue表
+            旧版本的基线中没有指纹字段，复制到临时表中计算指纹
+        '''
+        columns = [row['name'] for row in self._query(
+            "pragma base.table_info(Issues)")]
+        if 'fingerprint' in columns:
+            return "base.Issues"
+
+        info = self._query("select directory from base.Info limit 1")
+        fingerprint = Fingerprinter(info[0]['directory'] if info else None)
+
+        fields = [field for field in self._ISSUE_FIELDS \
+            if field != 'fingerprint']
+        rows = self._query("select id, {0} from base.Issues order by id"\
+            .format(", ".join(fields)))
+
+        with self._con:
+            self._con.execute("create temp table {0}("
+                "id integer primary key, {1})".format(self._BASELINE_TABLE,
+                ", ".join(self._ISSUE_FIELDS)))
+            self._con.executemany("insert into temp.{0}(id, {1}) "
+                "values(?, {2})".format(self._BASELINE_TABLE,
+                ", ".join(self._ISSUE_FIELDS),
+                ", ".join(["?"] * len(self._ISSUE_FIELDS))),
+                ([row['id']] + [row[field] for field in fields] + \
+                [fingerprint(row['issueid'], row['filename'], row['lineno'],
+                json.loads(row['context'] or "[]"))] for row in rows))
+
+        return "temp." + self._BASELINE_TABLE
+
+
+    def get_fixed_issues(self):
+        '''
+        对比基线之后已修复的issue，没有对比基线时为空
+        '''
+        if not self._has_object("table", self._FIXED_TABLE):
+            return []
+
+        return self._query("select * from {0} order by id".format(
+            self._FIXED_TABLE))
+
+
+    def query_issues(self, offset=0, limit=50, sort="id", desc=False,
+        severity=None, confidence=None, status=None, scope=None,
+        issueid=None, filename=None):
+        '''
+        分页、排序、过滤查询issue，过滤和排序都在数据库中完成
+        @params:
+            offset:     跳过多少个issue
+            limit:      最多返回多少个issue
+            sort:       排序字段，见 SORT_FIELDS，相同时按照id排序
+            desc:       是否降序排序
+            severity:   漏洞等级列表
+            confidence: 确认度列表
+            status:     漏洞状态列表
+            scope:      scope名称
+            issueid:    漏洞特征ID列表
+            filename:   文件名前缀
+        @returns:
+            (total, issues) total 为符合过滤条件的issue总数
+        '''
+        if sort not in self.SORT_FIELDS:
+            raise DatabaseError("cannot sort issues by {0}".format(sort))
+
+        conditions = []
+        params = []
+
+        for field, values in (('severity', severity),
+            ('confidence', confidence), ('status', status),
+            ('issueid', issueid)):
+            if values:
+                conditions.append("{0} in ({1})".format(field,
+                    ", ".join(["?"] * len(values))))
+                params.extend(values)
+
+        if scope:
+            # scope 字段保存的是json格式的scope列表
+            conditions.append("scope like ? escape '\\'")
+            params.append('%' + self._escape_like(json.dumps(scope)) + '%')
+
+        if filename:
+            # 使用范围查询匹配前缀，可以使用filename索引
+            conditions.append("filename >= ? and filename < ?")
+            params.extend([filename,
+                filename[:-1] + unichr(ord(filename[-1]) + 1)])
+
+        where = " where " + " and ".join(conditions) if conditions else ""
+        order = "desc" if desc else "asc"
+
+        total = self._query("select COUNT(*) as c from Issues" + where,
+            params)[0]['c']
 
-        old_issues = self._query("select * from Issues where status={0}"\
-            .format(Old))
+        issues = self._query("select * from Issues{0} order by {1} {2}, "
+            "id {2} limit ? offset ?".format(where, sort, order),
+            params + [limit, offset])
 
-        falsep_issues = self._query("select * from Issues where status={0}"\
-            .format(Falsep))
+        return total, issues
+
+
+    def search_issues(self, keywords, offset=0, limit=50):
+        '''
+        全文搜索漏洞名称、文件名、上下文，结果按照相关度排序
+        @params:
+            keywords: 空格分隔的关键字，需要全部匹配，以*结尾时按前缀匹配
+        @returns:
+            (total, issues)
+        '''
+        terms = keywords.split()
+        if not terms:
+            return 0, []
+
+        if not self._search:
+            # 不支持FTS5时使用LIKE查询
+            conditions = []
+            params = []
+            for term in terms:
+                conditions.append("(name like ? escape '\\' or "
+                    "filename like ? escape '\\' or "
+                    "context like ? escape '\\')")
+                pattern = '%' + self._escape_like(term.rstrip("*")) + '%'
+                params.extend([pattern] * 3)
+
+            where = " where " + " and ".join(conditions)
+            total = self._query("select COUNT(*) as c from Issues" + where,
+                params)[0]['c']
+            issues = self._query("select * from Issues{0} order by id "
+                "limit ? offset ?".format(where), params + [limit, offset])
+
+            return total, issues
+
+        # 每个关键字作为一个短语，避免关键字中的符号被当作FTS5查询语法
+        phrases = []
+        for term in terms:
+            prefix = term.endswith("*")
+            term = term.rstrip("*")
+            if not term:
+                continue
+
+            phrase = u'"' + term.replace('"', '""') + u'"'
+            phrases.append(phrase + "*" if prefix else phrase)
+
+        if not phrases:
+            return 0, []
+        query = u" AND ".join(phrases)
+
+        try:
+            total = self._query("select COUNT(*) as c from {0} where {0} "
+                "match ?".format(self._SEARCH_TABLE), (query,))[0]['c']
+            issues = self._query("select Issues.* from {0} join Issues on "
+                "Issues.id={0}.rowid where {0} match ? order by rank "
+                "limit ? offset ?".format(self._SEARCH_TABLE),
+                (query, limit, offset))
+        except sqlite3.OperationalError as error:
+            raise DatabaseError("search issues {0} error, reason: {1}".\
+                format(query, str(error)))
+
+        return total, issues
+
+
+    @staticmethod
+    def _escape_like(value):
+        return value.replace("\\", "\\\\").replace("%", "\\%").\
+            replace("_", "\\_")
+
+
+    def get_classfied_issues(self):
+        '''
+        获取分类之后的issues，只查询一次数据库
+        '''
+        issues = self._query("select * from Issues where status in "
+            "(?, ?, ?) order by status desc, id", (New, Old, Falsep))
+
+        new_issues = [x for x in issues if x['status'] == New]
+        old_issues = [x for x in issues if x['status'] == Old]
+        falsep_issues = [x for x in issues if x['status'] == Falsep]
 
         return (new_issues, old_issues, falsep_issues)
 
@@ -287,44 +980,125 @@ class IssueDatabase(object):
 
 
     def statistics(self):
-        severity_info = OrderedDict()
+        '''
+        按照漏洞等级、状态统计issue个数
+            存在汇总表时直接读取汇总表，否则使用分组统计
+        '''
+        counts = {}
+
+        if self._summary:
+            for row in self._query("select kind, value, count as c "
+                "from {0}".format(self._SUMMARY_TABLE)):
+                counts[(row['kind'], row['value'])] = row['c']
+        else:
+            for kind in ("severity", "status"):
+                for row in self._query("select {0} as value, COUNT(*) as c "
+                    "from Issues group by {0}".format(kind)):
+                    counts[(kind, row['value'])] = row['c']
 
-        severity_info[High] = self._query(
-            "select COUNT(*) as c from Issues where severity=?", (High,))\
-            [0]['c']
-        severity_info[Medium] = self._query(
-            "select COUNT(*) as c from Issues where severity=?", (Medium,))\
-            [0]['c']
-        severity_info[Low] = self._query(
-            "select COUNT(*) as c from Issues where severity=?", (Low,))\
-            [0]['c']
-        severity_info[Info] = self._query(
-            "select COUNT(*) as c from Issues where severity=?", (Info,))\
-            [0]['c']
+        severity_info = OrderedDict()
+        for severity in (High, Medium, Low, Info):
+            severity_info[severity] = counts.get(("severity", severity), 0)
 
         status_info = OrderedDict()
-        status_info[New] = self._query(
-            "select COUNT(*) as c from Issues where status=?", (New,))\
-            [0]['c']
-        status_info[Old] = self._query(
-            "select COUNT(*) as c from Issues where status=?", (Old,))\
-            [0]['c']
-        status_info[Falsep] = self._query(
-            "select COUNT(*) as c from Issues where status=?", (Falsep,))\
-            [0]['c']
+        for status in (New, Old, Falsep):
+            status_info[status] = counts.get(("status", status), 0)
 
         return severity_info, status_info
 
 
 
-class IssueManager(list):
+class IssueManager(object):
     '''
     issue管理器
+        产生的issue依次分发给注册的sink（例如报告输出），内存中只保存统计信息；
+        只有sink要求缓存时（例如HTML报告需要所有issue才能生成）才保存所有issue
     '''
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        '''
+        清除注册的sink、统计信息和扫描警告，用于在同一进程中多次扫描
+        '''
+        self._sinks = []
+        self._collectors = []
+        self._buffer = None
+        self._count = 0
+
+        # 扫描警告，[(filename, ID, pattern, message), ...]
+        self.warnings = []
+
+        self._statistics = OrderedDict()
+        self._statistics[High] = 0
+        self._statistics[Medium] = 0
+        self._statistics[Low] = 0
+        self._statistics[Info] = 0
+
+
+    def register(self, sink):
+        '''
+        注册sink
+        @params:
+            sink: 提供 write(issue) 方法的对象，sink.buffered 为True时缓存所有issue，
+                  可以通过迭代issuemgr获取
+        '''
+        self._sinks.append(sink)
+
+        if getattr(sink, "buffered", False) and self._buffer is None:
+            self._buffer = []
+
+
+    @contextmanager
+    def collect(self):
+        '''
+        收集with语句中产生的issue，收集的issue不会分发给sink，
+        需要时由调用者处理之后通过 extend 分发
+        '''
+        issues = []
+        self._collectors.append(issues)
+
+        try:
+            yield issues
+        finally:
+            self._collectors.pop()
+
+
     def add(self, **kwargs):
         issue = Issue(**kwargs)
 
-        self.append(issue)
+        if self._collectors:
+            self._collectors[-1].append(issue)
+        else:
+            self.dispatch(issue)
+
+
+    def extend(self, issues):
+        for issue in issues:
+            self.dispatch(issue)
+
+
+    def dispatch(self, issue):
+        '''
+        将issue分发给所有sink，并更新统计信息
+        '''
+        self._count += 1
+        if issue['severity'] in self._statistics:
+            self._statistics[issue['severity']] += 1
+
+        if self._buffer is not None:
+            self._buffer.append(issue)
+
+        for sink in self._sinks:
+            sink.write(issue)
+
+
+    def warn(self, filename, message, ID=None, pattern=None):
+        '''
+        记录扫描警告，例如扫描超时被跳过的文件、正则
+        '''
+        self.warnings.append((filename, ID, pattern, message))
 
 
     def add_senfile(self, filename, scope, pattern):
@@ -342,23 +1116,18 @@ class IssueManager(list):
 
 
     def statistics(self):
-        result = OrderedDict()
-        result[High] = 0
-        result[Medium] = 0
-        result[Low] = 0
-        result[Info] = 0
-
-        for issue in self:
-            if issue['severity'] == High:
-                result[High] += 1
-            elif issue['severity'] == Medium:
-                result[Medium] += 1
-            elif issue['severity'] == Low:
-                result[Low] += 1
-            elif issue['severity'] == Info:
-                result[Info] += 1
+        return OrderedDict(self._statistics)
 
-        return result
+
+    def __len__(self):
+        return self._count
+
+
+    def __iter__(self):
+        '''
+        遍历缓存的issue，没有sink要求缓存时为空
+        '''
+        return iter(self._buffer or [])
 
 
 
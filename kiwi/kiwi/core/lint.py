@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import os
+import re
+import sre_parse
+import sre_constants
+
+from common import YamlConf
+from common import conf
+
+
+# 上限大于该值的重复视为无上限
+_UNBOUNDED = 100
+
+_ALL = frozenset(range(256))
+_WORD = frozenset(ord(c) for c in
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")
+_DIGIT = frozenset(range(ord("0"), ord("9") + 1))
+_SPACE = frozenset(ord(c) for c in " \t\n\r\f\v")
+_LINEBREAK = frozenset([ord("\n")])
+
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: _DIGIT,
+    sre_constants.CATEGORY_NOT_DIGIT: _ALL - _DIGIT,
+    sre_constants.CATEGORY_SPACE: _SPACE,
+    sre_constants.CATEGORY_NOT_SPACE: _ALL - _SPACE,
+    sre_constants.CATEGORY_WORD: _WORD,
+    sre_constants.CATEGORY_NOT_WORD: _ALL - _WORD,
+    sre_constants.CATEGORY_LINEBREAK: _LINEBREAK,
+    sre_constants.CATEGORY_NOT_LINEBREAK: _ALL - _LINEBREAK,
+}
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_ZERO_WIDTH = (sre_constants.AT, sre_constants.ASSERT,
+    sre_constants.ASSERT_NOT)
+
+
+
+def _char(code):
+    '''
+    超出 0-255 的字符映射到 255，只用于判断字符集是否重叠
+    '''
+    return min(code, 255)
+
+
+def _in_charset(items):
+    result = set()
+    negate = False
+
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            result.add(_char(av))
+        elif op == sre_constants.RANGE:
+            result.update(range(_char(av[0]), _char(av[1]) + 1))
+        elif op == sre_constants.CATEGORY:
+            result.update(_CATEGORIES.get(av, _ALL))
+        else:
+            result.update(_ALL)
+
+    return _ALL - result if negate else frozenset(result)
+
+
+def _item_charset(op, av):
+    '''
+    单字符操作能匹配的字符集，不是单字符操作时返回None
+    '''
+    if op == sre_constants.LITERAL:
+        return frozenset([_char(av)])
+    if op == sre_constants.NOT_LITERAL:
+        return _ALL - frozenset([_char(av)])
+    if op == sre_constants.ANY:
+        return _ALL
+    if op == sre_constants.IN:
+        return _in_charset(av)
+
+    return None
+
+
+def _is_unbounded(op, av):
+    return op in _REPEATS and av[1] > _UNBOUNDED
+
+
+def _flatten(seq):
+    '''
+    展开分组，分组不影响匹配的回溯
+    '''
+    result = []
+    for op, av in seq:
+        if op == sre_constants.SUBPATTERN:
+            result.extend(_flatten(av[-1]))
+        else:
+            result.append((op, av))
+
+    return result
+
+
+def _alternatives(op, av):
+    if op == sre_constants.BRANCH:
+        return av[1]
+    if op == sre_constants.GROUPREF_EXISTS:
+        return [alt or [] for alt in av[1:]]
+
+    return None
+
+
+def _first(seq):
+    '''
+    @returns:
+        (chars, nullable) chars 为seq匹配的第一个字符的集合，nullable 表示seq能否匹配空串
+    '''
+    result = set()
+
+    for op, av in _flatten(seq):
+        charset = _item_charset(op, av)
+        if charset is not None:
+            result.update(charset)
+            return result, False
+
+        alts = _alternatives(op, av)
+        if alts is not None:
+            nullable = False
+            for alt in alts:
+                chars, alt_nullable = _first(alt)
+                result.update(chars)
+                nullable = nullable or alt_nullable
+            if not nullable:
+                return result, False
+        elif op in _REPEATS:
+            chars, nullable = _first(av[2])
+            result.update(chars)
+            if av[0] > 0 and not nullable:
+                return result, False
+        elif op in _ZERO_WIDTH:
+            continue
+        else:
+            # 反向引用等无法确定的操作
+            result.update(_ALL)
+            return result, False
+
+    return result, True
+
+
+def _chars(seq):
+    '''
+    seq能匹配的所有字符的集合
+    '''
+    result = set()
+
+    for op, av in _flatten(seq):
+        charset = _item_charset(op, av)
+        if charset is not None:
+            result.update(charset)
+            continue
+
+        alts = _alternatives(op, av)
+        if alts is not None:
+            for alt in alts:
+                result.update(_chars(alt))
+        elif op in _REPEATS:
+            result.update(_chars(av[2]))
+        elif op not in _ZERO_WIDTH:
+            result.update(_ALL)
+
+    return result
+
+
+def _check_loop(seq, follow, findings):
+    '''
+    检查无上限重复的循环体，循环体中的无上限重复与其后可能出现的字符（包括回到循环体开头）
+    重叠时，同一个字符串有指数级的匹配方式
+    '''
+    seq = _flatten(seq)
+
+    for index, (op, av) in enumerate(seq):
+        chars, nullable = _first(seq[index+1:])
+        if nullable:
+            chars = chars | follow
+
+        if _is_unbounded(op, av):
+            if _chars(av[2]) & chars:
+                findings.append("nested unbounded repetition may cause "
+                    "catastrophic backtracking")
+                return
+
+        alts = _alternatives(op, av)
+        if alts is not None:
+            for alt in alts:
+                _check_loop(alt, chars, findings)
+        elif op in _REPEATS:
+            _check_loop(av[2], chars | _first(av[2])[0], findings)
+
+
+def _check_branches(seq, findings):
+    '''
+    检查无上限重复中的分支，多个分支能以相同的字符开始时回溯次数可能指数级增长
+    '''
+    for op, av in _flatten(seq):
+        alts = _alternatives(op, av)
+        if alts is None:
+            continue
+
+        seen = set()
+        for alt in alts:
+            chars = _first(alt)[0]
+            if seen & chars:
+                findings.append("overlapping alternation inside unbounded "
+                    "repetition may cause catastrophic backtracking")
+                return
+            seen.update(chars)
+
+
+def _check_adjacent(seq, findings):
+    '''
+    检查相邻的无上限重复，中间只隔着可以为空的内容且字符集重叠时回溯次数为多项式级，
+    例如 \w+\w+、\w+\s*\w+=，中间可以为空的无上限重复（\s*）与前后不重叠时继续检查
+    '''
+    seq = _flatten(seq)
+
+    for index, (op, av) in enumerate(seq):
+        if not _is_unbounded(op, av):
+            continue
+
+        chars = _chars(av[2])
+        for next_op, next_av in seq[index+1:]:
+            if _is_unbounded(next_op, next_av) and \
+                chars & _chars(next_av[2]):
+                findings.append("adjacent unbounded repetitions with "
+                    "overlapping characters may cause polynomial "
+                    "backtracking")
+                return
+
+            if not _first([(next_op, next_av)])[1]:
+                break
+
+
+def _check(seq, findings):
+    _check_adjacent(seq, findings)
+
+    for op, av in _flatten(seq):
+        alts = _alternatives(op, av)
+        if alts is not None:
+            for alt in alts:
+                _check(alt, findings)
+        elif op in _REPEATS:
+            if _is_unbounded(op, av):
+                _check_loop(av[2], _first(av[2])[0], findings)
+                _check_branches(av[2], findings)
+            _check(av[2], findings)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            _check(av[1], findings)
+
+
+def lint_pattern(pattern, flags=0):
+    '''
+    检查正则是否可能出现灾难性回溯
+    @params:
+        pattern: 正则表达式字符串
+    @returns:
+        问题描述列表，没有问题时为空
+    '''
+    try:
+        re.compile(pattern, flags)
+        parsed = sre_parse.parse(pattern, flags)
+    except (re.error, OverflowError) as error:
+        return ["invalid regular expression: {0}".format(error)]
+
+    findings = []
+    _check(list(parsed), findings)
+
+    # 同一个正则中相同的问题只报告一次
+    result = []
+    for finding in findings:
+        if finding not in result:
+            result.append(finding)
+
+    return result
+
+
+def lint_features():
+    '''
+    检查特征库中所有特征的正则，只检查 conf.feature_ids 指定的特征
+    @returns:
+        生成器，(feature_file, ID, pattern, message)
+    '''
+    files = sorted([os.path.join(conf.featurepath, f) \
+        for f in os.listdir(conf.featurepath) \
+        if f.endswith(".feature")])
+
+    for feature_file in files:
+        feature_def = YamlConf(feature_file)
+
+        for feature in feature_def['features']:
+            if conf.feature_ids:
+                if feature['ID'] not in conf.feature_ids:
+                    continue
+
+            for pattern in feature['patterns']:
+                for message in lint_pattern(pattern):
+                    yield feature_file, feature['ID'], pattern, message
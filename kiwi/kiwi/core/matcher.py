@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import re
+import _sre
+import sre_parse
+import sre_compile
+import sre_constants
+
+
+
+def _walk_parsed(parsed):
+    '''
+    遍历 sre_parse 的解析结果，返回所有 (op, av)
+    '''
+    for op, av in parsed:
+        yield op, av
+
+        if op == sre_constants.BRANCH:
+            for item in av[1]:
+                for sub in _walk_parsed(item):
+                    yield sub
+        elif op == sre_constants.SUBPATTERN:
+            for sub in _walk_parsed(av[-1]):
+                yield sub
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            for sub in _walk_parsed(av[2]):
+                yield sub
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            for sub in _walk_parsed(av[1]):
+                yield sub
+        elif op == sre_constants.GROUPREF_EXISTS:
+            for item in av[1:]:
+                if item:
+                    for sub in _walk_parsed(item):
+                        yield sub
+
+
+# 正则中的内联 VERBOSE 标志，例如 (?x)、(?ix)
+_VERBOSE_FLAG = re.compile(r"\(\?[a-zA-Z]*x")
+
+
+def is_combinable(pattern):
+    '''
+    判断正则是否可以合并到组合正则中
+        使用命名分组、分组引用的正则合并后分组编号、名称会冲突，需要单独匹配；
+        VERBOSE 模式的正则中的 # 注释会吞掉组合时添加在后面的 | 和括号
+    '''
+    if pattern.groupindex:
+        return False
+
+    if pattern.flags & re.VERBOSE or _VERBOSE_FLAG.search(pattern.pattern):
+        return False
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (sre_constants.error, TypeError):
+        return False
+
+    for op, av in _walk_parsed(parsed):
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return False
+
+    return True
+
+
+
+def required_literal(pattern):
+    '''
+    提取正则的必需字面字符串
+        正则的任何匹配结果中都必定包含该字符串，有多个时返回最长的一个；
+        无法确定时返回None
+    '''
+    if pattern.flags & re.IGNORECASE:
+        return None
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except (sre_constants.error, TypeError):
+        return None
+
+    is_unicode = isinstance(pattern.pattern, unicode)
+
+    candidates = []
+    _collect_literals(parsed, is_unicode, candidates)
+
+    candidates = [c for c in candidates if c]
+    if not candidates:
+        return None
+
+    return max(candidates, key=len)
+
+
+def _collect_literals(parsed, is_unicode, candidates):
+    '''
+    收集顺序匹配的 parsed 中连续的字面字符串
+    '''
+    run = []
+
+    for op, av in parsed:
+        if op == sre_constants.LITERAL and not (is_unicode and av > 127):
+            run.append(chr(av))
+            continue
+
+        # 零宽断言（例如\b）不消耗字符，不会打断连续的字面字符串
+        if op == sre_constants.AT:
+            continue
+
+        candidates.append("".join(run))
+        run = []
+
+        if op == sre_constants.SUBPATTERN:
+            _collect_literals(av[-1], is_unicode, candidates)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[0] >= 1:
+                _collect_literals(av[2], is_unicode, candidates)
+
+    candidates.append("".join(run))
+
+
+
+def _compile_args(pattern, flags):
+    '''
+    编译正则，返回 _sre.compile 的参数，和 sre_compile.compile 一致
+    '''
+    parsed = sre_parse.parse(pattern, flags)
+    code = sre_compile._code(parsed, flags)
+
+    if parsed.pattern.groups > 100:
+        raise AssertionError(
+            "sorry, but this version only supports 100 named groups")
+
+    groupindex = parsed.pattern.groupdict
+    indexgroup = [None] * parsed.pattern.groups
+    for k, i in groupindex.items():
+        indexgroup[i] = k
+
+    return (pattern, flags | parsed.pattern.flags, code,
+        parsed.pattern.groups - 1, groupindex, indexgroup)
+
+
+
+class RegexCache(object):
+    '''
+    正则编译结果缓存
+        缓存正则的 sre 字节码以及必需字面字符串、是否可以合并，
+        可以保存到规则包中，下次启动时不需要重新解析、编译正则
+    '''
+    def __init__(self):
+        # {key: _sre.compile 参数}
+        self._codes = {}
+        # {key: 必需字面字符串}
+        self._literals = {}
+        # {key: 是否可以合并}
+        self._combinables = {}
+
+        # 是否有新的编译结果需要保存
+        self.dirty = False
+
+
+    @staticmethod
+    def _key(pattern, flags):
+        # 相同内容的str、unicode正则的编译结果不同
+        return (pattern, isinstance(pattern, unicode), flags)
+
+
+    def compile(self, pattern, flags=0):
+        '''
+        和 re.compile 相同，使用缓存的字节码
+        '''
+        # LOCALE 正则的编译结果依赖运行时的locale，不缓存
+        if flags & re.LOCALE:
+            return re.compile(pattern, flags)
+
+        key = self._key(pattern, flags)
+        args = self._codes.get(key)
+        if args is None:
+            try:
+                args = _compile_args(pattern, flags)
+            except sre_constants.error as error:
+                raise re.error(error)
+
+            self._codes[key] = args
+            self.dirty = True
+
+        return _sre.compile(*args)
+
+
+    def required_literal(self, pattern):
+        key = self._key(pattern.pattern, pattern.flags)
+        try:
+            return self._literals[key]
+        except KeyError:
+            literal = self._literals[key] = required_literal(pattern)
+            self.dirty = True
+            return literal
+
+
+    def is_combinable(self, pattern):
+        key = self._key(pattern.pattern, pattern.flags)
+        try:
+            return self._combinables[key]
+        except KeyError:
+            result = self._combinables[key] = is_combinable(pattern)
+            self.dirty = True
+            return result
+
+
+    def dump(self):
+        return {'codes': self._codes, 'literals': self._literals,
+            'combinables': self._combinables}
+
+
+    def load(self, state):
+        self._codes.update(state['codes'])
+        self._literals.update(state['literals'])
+        self._combinables.update(state['combinables'])
+
+
+
+class _CombinedPattern(object):
+    '''
+    多个正则的组合
+        guard: 所有正则的分支，用于快速定位任一正则可以匹配的位置
+        probe: 每个正则放在一个可选的前向断言分组中，用于确定该位置哪些正则匹配
+    '''
+    def __init__(self, entries, flags):
+        '''
+        @params:
+            entries: [(index, pattern), ...]
+            flags:   所有正则共同的 flags
+        '''
+        self.indexes = []
+        self.groups = []
+
+        probe = []
+        group = 1
+        for index, pattern in entries:
+            self.indexes.append(index)
+            self.groups.append(group)
+            probe.append("(?:(?=({0}))|)".format(pattern.pattern))
+            group += pattern.groups + 1
+
+        self.guard = regexes.compile("|".join(p.pattern for i, p in entries),
+            flags)
+        self.probe = regexes.compile("".join(probe), flags)
+
+
+    def match(self, content, result):
+        '''
+        在content中匹配，将 (index, start) 添加到result中
+            结果和每个正则单独调用 finditer 一致：同一正则的匹配互不重叠，
+            空匹配之后从下一个位置继续查找
+        '''
+        search = self.guard.search
+        probe = self.probe.match
+        groups = self.groups
+        indexes = self.indexes
+        # 每个正则下一次匹配允许的最小开始位置
+        nexts = [0] * len(groups)
+
+        pos = 0
+        length = len(content)
+        while pos <= length:
+            m = search(content, pos)
+            if not m:
+                break
+
+            pos = m.start()
+            regs = probe(content, pos).regs
+
+            for i, group in enumerate(groups):
+                start, end = regs[group]
+                if start == -1 or start < nexts[i]:
+                    continue
+
+                result.append((indexes[i], start))
+                nexts[i] = end if end > start else end + 1
+
+            pos += 1
+
+
+
+class PatternMatcher(object):
+    '''
+    组合正则匹配器
+        将多个正则合并为少量组合正则，每个文件只需要扫描少量几遍；
+        匹配之前先检查每个正则的必需字面字符串，只匹配可能命中的正则
+    '''
+    # python re 最多支持100个分组
+    _MAX_GROUPS = 99
+    # 缓存多少种预过滤结果对应的组合正则
+    _MAX_SUBSETS = 64
+
+    def __init__(self, patterns, literals=None):
+        '''
+        @params:
+            patterns: 待匹配的正则表达式的列表
+            literals: 每个正则的必需字面字符串列表，元素为None表示不过滤
+        '''
+        self._patterns = patterns
+
+        # 需要检查的字面字符串，[(literal, [index, ...]), ...]
+        self._literals = []
+        # 不需要预过滤的正则
+        self._unfiltered = []
+
+        literal_indexes = {}
+        for index in range(len(patterns)):
+            literal = literals[index] if literals else None
+            if literal is None:
+                self._unfiltered.append(index)
+            elif literal in literal_indexes:
+                literal_indexes[literal].append(index)
+            else:
+                literal_indexes[literal] = [index]
+                self._literals.append((literal, literal_indexes[literal]))
+
+        # 所有正则的编译结果，(standalones, combined)
+        self._compiled = self._compile(range(len(patterns)))
+        # 部分正则的编译结果，{(index, ...): (standalones, combined)}
+        self._subsets = {}
+
+
+    @property
+    def patterns(self):
+        return self._patterns
+
+
+    def _compile(self, indexes):
+        '''
+        编译indexes指定的正则
+        @returns:
+            (standalones, combined)
+            standalones 无法合并的正则，[(index, pattern), ...]
+            combined    组合正则，[_CombinedPattern, ...]
+        '''
+        standalones = []
+        combined = []
+
+        chunks = {}
+        for index in indexes:
+            pattern = self._patterns[index]
+            if not regexes.is_combinable(pattern) or \
+                pattern.groups + 1 > self._MAX_GROUPS:
+                standalones.append((index, pattern))
+                continue
+
+            chunk = chunks.setdefault(pattern.flags, [[]])
+            groups = sum(p.groups + 1 for i, p in chunk[-1])
+            if groups + pattern.groups + 1 > self._MAX_GROUPS:
+                chunk.append([])
+            chunk[-1].append((index, pattern))
+
+        for flags, chunk in chunks.iteritems():
+            for entries in chunk:
+                combined.append(_CombinedPattern(entries, flags))
+
+        return standalones, combined
+
+
+    def _prefilter(self, content):
+        '''
+        检查每个正则的必需字面字符串是否出现在content中
+        @returns:
+            可能命中的正则的序号列表
+        '''
+        result = list(self._unfiltered)
+
+        for literal, indexes in self._literals:
+            if content.find(literal) != -1:
+                result.extend(indexes)
+
+        result.sort()
+
+        return result
+
+
+    def _get_compiled(self, indexes):
+        if len(indexes) == len(self._patterns):
+            return self._compiled
+
+        key = tuple(indexes)
+        if key not in self._subsets:
+            if len(self._subsets) >= self._MAX_SUBSETS:
+                self._subsets.clear()
+            self._subsets[key] = self._compile(indexes)
+
+        return self._subsets[key]
+
+
+    def candidates(self, content):
+        '''
+        预过滤之后可能命中的正则的序号列表
+        '''
+        return self._prefilter(content)
+
+
+    def match_pattern(self, content, index):
+        '''
+        单独使用一个正则匹配
+        @returns:
+            [(index, start), ...]
+        '''
+        return [(index, match.start()) \
+            for match in self._patterns[index].finditer(content)]
+
+
+    def match(self, content):
+        '''
+        @params:
+            content: 待匹配的内容
+        @returns:
+            [(index, start), ...] index 为正则在patterns中的序号，start 为匹配开始位置，
+            按照 (index, start) 排序
+        '''
+        result = []
+
+        indexes = self._prefilter(content)
+        if not indexes:
+            return result
+
+        standalones, combined = self._get_compiled(indexes)
+
+        for cp in combined:
+            cp.match(content, result)
+
+        for index, pattern in standalones:
+            for match in pattern.finditer(content):
+                result.append((index, match.start()))
+
+        result.sort()
+
+        return result
+
+
+
+class FeatureMatcher(PatternMatcher):
+    '''
+    漏洞特征匹配器
+        将一个scope的所有漏洞特征的正则合并匹配，并记录每个正则所属的特征
+    '''
+    def __init__(self, features):
+        '''
+        @params:
+            features: 漏洞特征列表
+        '''
+        self._features = []
+
+        patterns = []
+        literals = []
+        for feature in features:
+            for pattern, literal in zip(feature.patterns, feature.literals):
+                self._features.append(feature)
+                patterns.append(pattern)
+                literals.append(literal)
+
+        super(FeatureMatcher, self).__init__(patterns, literals)
+
+
+    def match(self, content):
+        '''
+        @returns:
+            [(feature, pattern, start), ...] 和依次使用每个特征的每个正则匹配的顺序一致
+        '''
+        return [(self._features[index], self._patterns[index], start) \
+            for index, start in super(FeatureMatcher, self).match(content)]
+
+
+    def match_pattern(self, content, index):
+        '''
+        @returns:
+            [(feature, pattern, start), ...]
+        '''
+        return [(self._features[index], self._patterns[index], start) \
+            for index, start in super(FeatureMatcher, self).match_pattern(
+            content, index)]
+
+
+    def get_feature(self, index):
+        '''
+        获取第index个正则所属的特征
+        '''
+        return self._features[index]
+
+
+
+regexes = RegexCache()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import json
+from timeit import default_timer as timer
+
+from exception import FileError
+
+
+
+class FeatureProfile(object):
+    '''
+    单个漏洞特征的性能统计
+    '''
+    __slots__ = ('ID', 'patterns', 'eval_time', 'evaluations', 'issues')
+
+    def __init__(self, ID):
+        self.ID = ID
+        # {pattern: [match_time, matches]}
+        self.patterns = {}
+        self.eval_time = 0.0
+        self.evaluations = 0
+        self.issues = 0
+
+
+    @property
+    def match_time(self):
+        return sum(stat[0] for stat in self.patterns.values())
+
+
+    @property
+    def matches(self):
+        return sum(stat[1] for stat in self.patterns.values())
+
+
+    @property
+    def total_time(self):
+        return self.match_time + self.eval_time
+
+
+    def to_dict(self):
+        patterns = sorted(self.patterns.items(), key=lambda x: x[1][0],
+            reverse=True)
+
+        return {
+            'ID': self.ID,
+            'total_time': self.total_time,
+            'match_time': self.match_time,
+            'matches': self.matches,
+            'eval_time': self.eval_time,
+            'evaluations': self.evaluations,
+            'issues': self.issues,
+            'patterns': [{'pattern': pattern, 'match_time': stat[0],
+                'matches': stat[1]} for pattern, stat in patterns]
+        }
+
+
+
+class Profiler(object):
+    '''
+    漏洞特征性能分析器
+        记录每个正则的匹配时间、匹配次数，每个特征的评估时间、评估次数、产生的漏洞数，
+        用于找出拖慢扫描的漏洞特征
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.files = 0
+        # {ID: FeatureProfile}
+        self._features = {}
+
+
+    def enable(self):
+        self.enabled = True
+
+
+    def _get(self, ID):
+        try:
+            return self._features[ID]
+        except KeyError:
+            profile = self._features[ID] = FeatureProfile(ID)
+            return profile
+
+
+    def add_match(self, ID, pattern, elapsed, matches):
+        stat = self._get(ID).patterns.setdefault(pattern, [0.0, 0])
+        stat[0] += elapsed
+        stat[1] += matches
+
+
+    def add_evaluate(self, ID, elapsed, kept):
+        profile = self._get(ID)
+        profile.eval_time += elapsed
+        profile.evaluations += 1
+        if kept:
+            profile.issues += 1
+
+
+    @property
+    def features(self):
+        '''
+        按照总耗时从高到低排序的特征统计
+        '''
+        return sorted(self._features.values(), key=lambda x: x.total_time,
+            reverse=True)
+
+
+    def to_dict(self):
+        return {
+            'files': self.files,
+            'features': [profile.to_dict() for profile in self.features]
+        }
+
+
+    def format_table(self, limit=None):
+        '''
+        格式化为文本表格，每个特征之后列出其正则
+        @params:
+            limit: 只输出耗时最高的limit个特征
+        '''
+        lines = ["{0:>10} {1:>10} {2:>10} {3:>8} {4:>8} {5:>7}  {6}".format(
+            "Total(s)", "Match(s)", "Eval(s)", "Matches", "Evals", "Issues",
+            "Feature/Pattern")]
+
+        for profile in self.features[:limit]:
+            lines.append(
+                "{0:>10.4f} {1:>10.4f} {2:>10.4f} {3:>8} {4:>8} {5:>7}  {6}"\
+                .format(profile.total_time, profile.match_time,
+                profile.eval_time, profile.matches, profile.evaluations,
+                profile.issues, profile.ID))
+
+            for item in profile.to_dict()['patterns']:
+                lines.append(u"{0:>10} {1:>10.4f} {2:>10} {3:>8} {4:>8} {5:>7}"
+                    u"    {6}".format("", item['match_time'], "",
+                    item['matches'], "", "", item['pattern']))
+
+        return "\n".join(lines)
+
+
+    def save(self, path):
+        try:
+            with open(path, "w") as _file:
+                json.dump(self.to_dict(), _file, indent=2)
+        except IOError:
+            raise FileError("write profile file '{0}' failed".format(path))
+
+
+
+profiler = Profiler()
@@ -13,13 +13,12 @@ import sys
 import time
 import abc
 import json
-import cgi
-
-from jinja2 import Template
 
 from common import Out
 from common import conf
 from issuemgr import issuemgr
+from issuemgr import Fingerprinter
+from issuemgr import matched_line
 from issuemgr import IssueDatabase
 from filemgr import filemgr
 from constant import severity_map, confidence_map, status_map
@@ -40,17 +39,41 @@ def get_reporter(filename):
     if filename.endswith(".json"):
         return JsonReporter(filename)
 
+    if filename.endswith(".jsonl"):
+        return JsonLinesReporter(filename)
+
+    if filename.endswith(".sarif"):
+        return SarifReporter(filename)
+
     return TextReporter(filename)
 
 
 
 class Reporter(object):
+    '''
+    报告输出基类
+        作为issuemgr的sink，扫描开始时调用start，每产生一个issue调用write，
+        扫描结束时调用finish，报告内容边扫描边输出
+    '''
     scope = 'default'
     _WIDTH = 80
 
-    def __init__(self, filename):
+    # 报告文件的写缓冲区大小
+    _BUFSIZE = 1 << 16
+
+    # 是否需要issuemgr缓存所有issue，只有生成报告需要所有issue时设置为True
+    buffered = False
+
+    def __init__(self, filename, stream=None):
+        '''
+        @params:
+            filename: 报告文件，为None时输出到stream
+            stream:   报告输出的文件对象，为None时输出到标准输出，由调用者负责关闭
+        '''
         self.banner = self._banner()
         self._filename = filename
+        self._stream = stream
+        self._file = None
 
 
     @property
@@ -77,24 +100,69 @@ class Reporter(object):
         return banner
 
 
+    def start(self):
+        '''
+        开始输出报告
+        '''
+        if self._filename:
+            self._file = open(self._filename, 'wb', self._BUFSIZE)
+        else:
+            self._file = self._stream
+
+        self._write(self._header())
+
+
+    def write(self, issue):
+        '''
+        输出一个issue
+        '''
+        self._write(self._format_issue(issue))
+
+
+    def finish(self):
+        '''
+        结束输出报告
+        '''
+        self._write(self._footer())
+
+        if self._file and self._filename:
+            self._file.close()
+        self._file = None
+
+
     def report(self):
         '''
-        输出问题
+        一次性输出issuemgr中缓存的所有issue
         '''
-        content = self._report()
+        self.start()
+        for issue in issuemgr:
+            self.write(issue)
+        self.finish()
 
-        if content is not None:
-            if not self._filename:
-                print content
-            else:
-                with open(self._filename, 'wb') as _file:
-                    if isinstance(content, unicode):
-                        content = content.encode("utf-8")
 
-                    _file.write(content)
+    def _write(self, content):
+        if not content:
+            return
+
+        if self._file:
+            if isinstance(content, unicode):
+                content = content.encode("utf-8")
+            self._file.write(content)
+        else:
+            if isinstance(content, unicode):
+                content = content.encode(sys.stdout.encoding or "utf-8")
+            sys.stdout.write(content)
 
 
-    def _report(self):
+    def _header(self):
+        pass
+
+
+    def _format_issue(self, issue):
+        pass
+
+
+    def _footer(self):
         pass
         
 
@@ -139,18 +207,17 @@ class TextReporter(Reporter):
             context = self._format_issue_context(issue))
     
 
-    def _report(self):
-        template = u"{title}\n\n\n{issues}\n\n{statistics}"
-
+    def _header(self):
         title = u"{banner}\nScaning <{directory}> at {time}".format(
                 banner = self.banner,
                 directory = conf.target,
                 time = self.now)
 
-        issues_content = "-"*80 + "\nFound security issues as follows:\n\n"
-        for issue in issuemgr:
-            issues_content = issues_content + self._format_issue(issue)
+        return title + u"\n\n\n" + \
+            "-"*80 + "\nFound security issues as follows:\n\n"
+
 
+    def _footer(self):
         statistics = "-"*80 + "\nStatistics information:\n"
         sinfo = issuemgr.statistics()
         for s in sinfo:
@@ -158,10 +225,23 @@ class TextReporter(Reporter):
                 "{key}: {value}".format(key=severity_map[s][0].capitalize(), 
                     value=sinfo[s]) + "\n"
 
-        content = template.format(
-            title = title,
-            issues = issues_content,
-            statistics = statistics)
+        return u"\n\n" + statistics + self._format_warnings()
+
+
+    def _format_warnings(self):
+        '''
+        扫描警告，没有警告时为空
+        '''
+        if not issuemgr.warnings:
+            return u""
+
+        content = "-"*80 + "\nScan warnings:\n"
+        for filename, ID, pattern, message in issuemgr.warnings:
+            if ID:
+                content = content + u"@{0} [{1}] <Match:{2}>: {3}\n".format(
+                    filename, ID, pattern, message)
+            else:
+                content = content + u"@{0}: {1}\n".format(filename, message)
 
         return content
 
@@ -207,19 +287,16 @@ class ConsoleReporter(TextReporter):
             context = self._format_issue_context(issue))
     
 
-    def _report(self):
-        template = u"\n{title}\n{issues}\n\n{statistics}"
-
+    def _header(self):
         title = u"Scaning <{directory}> at {time}".format(
                 directory = Out.R(conf.target),
                 time = Out.R(self.now))
 
-        issues_content = \
+        return u"\n" + title + u"\n" + \
             Out.Y("-"*80 + "\nFound security issues as follows:\n\n")
 
-        for issue in issuemgr:
-            issues_content = issues_content + self._format_issue(issue)
 
+    def _footer(self):
         statistics = Out.Y("-"*80 + "\nStatistics information:\n")
         sinfo = issuemgr.statistics()
         for s in sinfo:
@@ -227,19 +304,23 @@ class ConsoleReporter(TextReporter):
                 "{key}: {value}".format(key=severity_map[s][0].capitalize(), 
                     value=sinfo[s]) + "\n"
 
-        content = template.format(
-            title = title,
-            issues = issues_content,
-            statistics = statistics)
+        warnings = self._format_warnings()
+        if warnings:
+            warnings = Out.Y(warnings)
 
-        return content
+        return u"\n\n" + statistics + warnings + u"\n"
 
 
 
 class HtmlReporter(Reporter):
     CONTEXT_LINE_LENGTH = 120  # HTML报告中context最大长度
 
+    # HTML报告需要所有issue才能生成
+    buffered = True
+
     def _get_formated_issues(self):
+        import cgi
+
         def _get_filelink(filename, scandir, lineno):
             opengrok_base = os.getenv("KIWI_OPENGROK_BASE")
             if not opengrok_base:
@@ -313,7 +394,10 @@ class HtmlReporter(Reporter):
         return scan_info
 
 
-    def _report(self):
+    def _footer(self):
+        # jinja2 导入较慢，只在生成HTML报告时导入
+        from jinja2 import Template
+
         scan_info = self._get_scan_info()
         issues = self._get_formated_issues()
 
@@ -328,26 +412,208 @@ class HtmlReporter(Reporter):
 
 
 class JsonReporter(Reporter):
-    def _report(self):
-        return json.dumps(issuemgr, indent=2)
+    '''
+    JSON报告，逐个输出issue，输出内容和 json.dumps(issues, indent=2) 一致
+    '''
+    def _header(self):
+        self._count = 0
+        return "["
+
+
+    def _format_issue(self, issue):
+        content = json.dumps(issue.to_dict(), indent=2).replace("\n", "\n  ")
+
+        self._count += 1
+        if self._count == 1:
+            return "\n  " + content
+        else:
+            return ", \n  " + content
+
+
+    def _footer(self):
+        return "\n]" if self._count else "]"
+
+
+
+class JsonLinesReporter(Reporter):
+    '''
+    JSON Lines报告，每行一个issue，附带issue指纹，便于流式处理
+    '''
+    def start(self):
+        self._fingerprint = Fingerprinter(conf.target)
+        Reporter.start(self)
+
+
+    def _format_issue(self, issue):
+        data = issue.to_dict()
+        data['fingerprint'] = self._fingerprint(str(issue['ID']),
+            str(issue['filename']), issue['lineno'], issue['context'])
+
+        return json.dumps(data) + "\n"
+
+
+
+class SarifReporter(Reporter):
+    '''
+    SARIF 2.1.0 格式报告，用于代码扫描平台导入
+        扫描开始时还没有加载漏洞特征，results 之后再输出 tool，
+        rules 只包括产生了issue的漏洞特征
+    '''
+    SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+
+    _LEVELS = {High: "error", Medium: "warning", Low: "note", Info: "note"}
+
+    def start(self):
+        self._fingerprint = Fingerprinter(conf.target)
+        self._count = 0
+        # {ID: ruleIndex}，以及按照出现顺序排列的rules
+        self._rule_index = {}
+        self._rules = []
+
+        Reporter.start(self)
+
+
+    def _header(self):
+        return ('{{"$schema": {0}, "version": "2.1.0", "runs": [{{'
+            '"originalUriBaseIds": {1}, "results": [').format(
+            json.dumps(self.SCHEMA), json.dumps({'SRCROOT': {
+            'uri': self._uri(self._fingerprint.directory) + "/"}}))
+
+
+    # URI中不需要转义的字符，urllib 会导入ssl等较重的依赖，这里直接转义
+    _URI_SAFE = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        "0123456789-._~/")
+
+    @classmethod
+    def _uri(cls, path):
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        path = "".join(c if c in cls._URI_SAFE else "%{0:02X}".format(ord(c)) \
+            for c in path.replace(os.sep, "/"))
+
+        return "file://" + path if path.startswith("/") else path
+
+
+    def _rule(self, issue):
+        ID = str(issue['ID'])
+        try:
+            return self._rule_index[ID]
+        except KeyError:
+            index = self._rule_index[ID] = len(self._rules)
+            self._rules.append({
+                'id': ID,
+                'name': issue['name'],
+                'shortDescription': {'text': issue['name']},
+                'defaultConfiguration': {
+                    'level': self._LEVELS.get(issue['severity'], "note")},
+                'properties': {'scopes': issue['scope']}
+            })
+            return index
+
+
+    def _format_issue(self, issue):
+        ID = str(issue['ID'])
+        filename = str(issue['filename'])
+
+        relpath = self._fingerprint.relpath(filename)
+        if relpath.startswith("/"):
+            location = {'uri': self._uri(filename)}
+        else:
+            location = {'uri': self._uri(relpath), 'uriBaseId': "SRCROOT"}
+
+        physical = {'artifactLocation': location}
+
+        lineno = int(issue['lineno'] or 0)
+        context = issue['context'] or []
+        if lineno > 0:
+            physical['region'] = {'startLine': lineno}
+            line = matched_line(context, issue['lineno'])
+            if line:
+                physical['region']['snippet'] = {'text': line}
+        if context:
+            physical['contextRegion'] = {'startLine': int(context[0][0]),
+                'endLine': int(context[-1][0]),
+                'snippet': {'text': u"".join(l[1] for l in context)}}
+
+        result = {
+            'ruleId': ID,
+            'ruleIndex': self._rule(issue),
+            'level': self._LEVELS.get(issue['severity'], "note"),
+            'message': {'text': issue['name']},
+            'locations': [{'physicalLocation': physical}],
+            'partialFingerprints': {'kiwiFingerprint/v1': self._fingerprint(
+                ID, filename, issue['lineno'], context)},
+            'properties': {
+                'severity': severity_map[issue['severity']][0],
+                'confidence': confidence_map[issue['confidence']][0],
+                'pattern': issue['pattern']
+            }
+        }
+
+        self._count += 1
+        return (", " if self._count > 1 else "") + json.dumps(result) + "\n"
+
+
+    def _footer(self):
+        notifications = []
+        for filename, ID, pattern, message in issuemgr.warnings:
+            notification = {'level': "warning", 'message': {'text': message},
+                'locations': [{'physicalLocation': {'artifactLocation': {
+                'uri': self._uri(filename)}}}]}
+            if ID:
+                notification['associatedRule'] = {'id': ID}
+            notifications.append(notification)
+
+        tool = {'driver': {
+            'name': "kiwi",
+            'informationUri': "https://github.com/alpha1e0/kiwi",
+            'rules': self._rules
+        }}
+        invocation = {'executionSuccessful': True,
+            'toolExecutionNotifications': notifications}
+
+        return '], "tool": {0}, "invocations": [{1}]}}]}}\n'.format(
+            json.dumps(tool), json.dumps(invocation))
 
 
 
 class DatabaseReporter(Reporter):
-    def _report(self):
-        db = IssueDatabase(self._filename)
+    # 每次批量写入数据库的issue个数
+    _BATCH_SIZE = 1000
+
+    def start(self):
+        self._db = IssueDatabase(self._filename, conf.wal, conf.summary,
+            directory=conf.target)
+        self._issues = []
+
+
+    def write(self, issue):
+        self._issues.append(issue)
 
+        if len(self._issues) >= self._BATCH_SIZE:
+            self._flush()
+
+
+    def finish(self):
         scope_titles = []
         scope_contents = []
         for scope,linenum in filemgr.scope_statistics.iteritems():
             scope_titles.append(scope)
             scope_contents.append(linenum)
 
-        db.record_scan_info(conf.target, ",".join(scope_titles), 
+        self._db.record_scan_info(conf.target, ",".join(scope_titles), 
             ",".join([str(x) for x in scope_contents]))
 
-        for issue in issuemgr:
-            db.add_issue(issue)
+        self._flush()
+
+        if conf.baseline:
+            new, old, fixed = self._db.apply_baseline(conf.baseline)
+            Out.info(u"对比基线 {0}: 新漏洞 {1}, 老漏洞 {2}, 已修复 {3}".format(
+                conf.baseline, new, old, fixed))
+
+        self._db.close()
 
-        return None
 
+    def _flush(self):
+        self._db.add_issues(self._issues)
+        self._issues = []
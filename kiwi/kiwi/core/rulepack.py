@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import os
+import sys
+import _sre
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from common import YamlConf
+from common import conf
+
+
+
+class RulePack(object):
+    '''
+    编译好的规则包
+        保存特征库中yaml文件的解析结果、正则的编译结果、评价函数所在的文件，
+        规则源文件、python版本变化时规则包失效，重新生成
+    '''
+    # 规则包格式版本，保存的内容变化时需要修改
+    VERSION = "3"
+
+    def __init__(self):
+        # 规则包文件，未启用时为None
+        self.path = None
+        self.fingerprint = None
+        self.loaded = False
+
+        # {path: yaml文件的解析结果}
+        self.documents = {}
+        # {funcname: 评价函数所在的文件}，为None时需要导入所有评价函数文件
+        self.evalfuncs = None
+        # RegexCache 的状态
+        self.regexes = None
+
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+
+    def init(self):
+        '''
+        加载 conf.rulepack 指定的规则包，规则包不存在或者失效时 loaded 为False
+        '''
+        if not conf.rulepack:
+            return
+
+        sources = sorted([os.path.join(conf.featurepath, f) \
+            for f in os.listdir(conf.featurepath) if f.endswith(".feature")])
+        sources += sorted([os.path.join(conf.evalpath, f) \
+            for f in os.listdir(conf.evalpath) if f.endswith(".py")])
+        sources += [conf.mapfile, conf.senfiles]
+
+        self.path = conf.rulepack
+        self.fingerprint = self._fingerprint(sources)
+        self.loaded = self._load()
+
+
+    def _fingerprint(self, sources):
+        sha = hashlib.sha1()
+        # 正则字节码只对同一版本的python有效
+        sha.update("{0}:{1}:{2}".format(self.VERSION, sys.version,
+            _sre.MAGIC))
+
+        for filename in sources:
+            sha.update(os.path.realpath(filename))
+            try:
+                with open(filename, 'rb') as _file:
+                    sha.update(_file.read())
+            except IOError:
+                pass
+
+        return sha.hexdigest()
+
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as _file:
+                data = pickle.load(_file)
+        except Exception:
+            # 规则包不存在或者损坏时重新生成
+            return False
+
+        if not isinstance(data, dict) or \
+            data.get('fingerprint') != self.fingerprint:
+            return False
+
+        self.documents = data['documents']
+        self.evalfuncs = data['evalfuncs']
+        self.regexes = data['regexes']
+
+        return True
+
+
+    def load_yaml(self, path):
+        '''
+        加载yaml文件，优先使用规则包中的解析结果
+            规则包按照特征库的真实路径保存，使用真实路径查找，
+            同一个特征库使用相对路径、绝对路径指定时都可以使用规则包
+        '''
+        key = os.path.realpath(path)
+        try:
+            return self.documents[key]
+        except KeyError:
+            document = YamlConf(path)
+            if self.enabled:
+                self.documents[key] = document
+            return document
+
+
+    def save(self):
+        '''
+        保存规则包，先写入临时文件再替换，保存失败时忽略
+        '''
+        if not self.enabled:
+            return
+
+        data = {
+            'fingerprint': self.fingerprint,
+            'documents': self.documents,
+            'evalfuncs': self.evalfuncs,
+            'regexes': self.regexes
+        }
+
+        dirname = os.path.dirname(self.path)
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+
+            fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as _file:
+                    pickle.dump(data, _file, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmpname, self.path)
+            except:
+                os.remove(tmpname)
+                raise
+        except (IOError, OSError, pickle.PicklingError):
+            return
+
+        self.loaded = True
+
+
+
+rulepack = RulePack()
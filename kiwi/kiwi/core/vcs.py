@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import os
+import re
+import bisect
+import subprocess
+
+from exception import VcsError
+
+
+
+class GitChanges(object):
+    '''
+    git变更信息
+        记录工作区相对于某个提交新增、修改的文件，以及每个文件修改的行，
+        只使用本地仓库数据，不访问网络
+    '''
+    _HUNK_PATTERN = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+    def __init__(self, directory, ref):
+        '''
+        @params:
+            directory: 仓库中的目录
+            ref:       git 提交，例如 HEAD~1、origin/master、提交hash
+        '''
+        self._ref = ref
+
+        # {filename: [(start, end), ...]}，记录文件修改的行的区间（包括start和end），
+        # 区间列表为None表示整个文件都是新的
+        self._changes = {}
+
+        self._toplevel = os.path.realpath(self._git(directory, "rev-parse",
+            "--show-toplevel").strip())
+
+        self._load_diff()
+        self._load_untracked()
+
+
+    @property
+    def files(self):
+        '''
+        新增、修改的文件，按文件名排序
+        '''
+        return sorted(self._changes)
+
+
+    def _git(self, cwd, *args):
+        cmd = ["git", "-c", "core.quotepath=off"] + list(args)
+
+        try:
+            process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            output, error = process.communicate()
+        except OSError as error:
+            raise VcsError("run git command '{0}' failed, reason: {1}".format(
+                " ".join(cmd), str(error)))
+
+        if process.returncode != 0:
+            raise VcsError("run git command '{0}' failed, reason: {1}".format(
+                " ".join(cmd), error.strip()))
+
+        return output
+
+
+    def _path(self, name):
+        '''
+        将git输出的相对路径转换为绝对路径
+        '''
+        if name.startswith('"') and name.endswith('"'):
+            name = name[1:-1].decode("string_escape")
+
+        return os.path.join(self._toplevel, name)
+
+
+    def _load_diff(self):
+        # 文件列表以 -z 格式获取，文件名不需要转义和解析
+        output = self._git(self._toplevel, "diff", "--name-only", "-z",
+            "--no-ext-diff", "--diff-filter=AMR", self._ref, "--")
+        for name in output.split("\0"):
+            if name:
+                # 没有找到行信息的文件（例如二进制文件）认为整个文件都是新的
+                self._changes[os.path.join(self._toplevel, name)] = None
+
+        # 明确指定前缀，不受 diff.noprefix、diff.mnemonicPrefix 配置影响
+        output = self._git(self._toplevel, "diff", "-U0", "--no-color",
+            "--no-ext-diff", "--src-prefix=a/", "--dst-prefix=b/",
+            "--diff-filter=AMR", self._ref, "--")
+
+        filename = None
+        for line in output.split("\n"):
+            if line.startswith("diff --git "):
+                filename = None
+            elif line.startswith("rename to "):
+                # 只重命名的文件没有修改的行
+                filename = self._diff_path(line[len("rename to "):])
+            elif line.startswith("+++ "):
+                filename = self._diff_path(line[4:], "b/")
+            elif line.startswith("@@") and filename:
+                match = self._HUNK_PATTERN.match(line)
+                if not match:
+                    continue
+
+                start = int(match.group(1))
+                count = int(match.group(2)) if match.group(2) is not None \
+                    else 1
+                if count > 0:
+                    self._changes[filename].append((start, start+count-1))
+                else:
+                    # 只删除了行，删除位置的前后文仍然需要检查
+                    start = max(start, 1)
+                    self._changes[filename].append((start, start))
+
+
+    def _diff_path(self, name, prefix=""):
+        '''
+        解析diff输出中的文件名，文件名不在变更文件列表中时返回None
+        '''
+        # 包含空格的文件名，git 会在行尾添加TAB
+        name = name.rstrip("\t")
+        if prefix:
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+            elif name.startswith('"' + prefix):
+                name = '"' + name[len(prefix)+1:]
+
+        filename = self._path(name)
+        if filename not in self._changes:
+            return None
+
+        if self._changes[filename] is None:
+            self._changes[filename] = []
+
+        return filename
+
+
+    def _load_untracked(self):
+        output = self._git(self._toplevel, "ls-files", "--others",
+            "--exclude-standard", "-z")
+
+        for name in output.split("\0"):
+            if name:
+                self._changes[os.path.join(self._toplevel, name)] = None
+
+
+    def __contains__(self, filename):
+        return filename in self._changes
+
+
+    def is_changed(self, filename, lineno, ctxrange=0):
+        '''
+        判断文件的某一行是否在修改的行附近
+        @params:
+            ctxrange: 修改的行前后多少行也认为是修改的
+        '''
+        if filename not in self._changes:
+            return False
+
+        hunks = self._changes[filename]
+        if hunks is None:
+            return True
+
+        lineno = int(lineno)
+        # 区间按行号升序且互不重叠，只需检查最后一个 start-ctxrange <= lineno 的区间
+        idx = bisect.bisect_right(hunks, (lineno+ctxrange, float("inf"))) - 1
+        if idx < 0:
+            return False
+
+        return hunks[idx][1] + ctxrange >= lineno
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from timeit import default_timer as timer
+
+from common import Out
+from common import conf
+from filemgr import filemgr
+from issuemgr import issuemgr
+from issuemgr import matched_line
+from ignore import IGNORE_FILES
+from exception import FileError
+from constant import severity_map
+
+
+
+# inotify 事件类型，见 <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+
+class InotifyWatcher(object):
+    '''
+    通过Linux inotify监控扫描目录中的文件变化
+        监控所有需要扫描的目录，新建、移入的目录自动加入监控
+    '''
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+        IN_DELETE
+
+    # 收到第一个事件之后继续等待的时间，合并保存文件、切换分支等操作产生的多个事件
+    DEBOUNCE = 0.2
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+            use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        # {wd: directory}
+        self._watches = {}
+
+        try:
+            self.sync()
+        except:
+            self.close()
+            raise
+
+
+    def sync(self):
+        '''
+        重新遍历扫描目录，监控新的需要扫描的目录，取消监控不再需要扫描的目录，
+        用于忽略规则变化、事件队列溢出之后
+        '''
+        root = os.path.realpath(conf.target)
+        directories = set([os.path.dirname(root) if os.path.isfile(root) \
+            else root])
+        for path, is_dir in filemgr.walk_tree():
+            if is_dir:
+                directories.add(path)
+
+        for wd, path in self._watches.items():
+            if path not in directories:
+                self._rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+        watched = set(self._watches.values())
+        for directory in sorted(directories - watched):
+            self._watch(directory)
+
+
+    def _watch(self, directory):
+        wd = self._add_watch(self._fd, directory, self.MASK)
+        if wd >= 0:
+            self._watches[wd] = directory
+            return
+
+        error = ctypes.get_errno()
+        # 目录在加入监控之前被删除时忽略
+        if error not in (errno.ENOENT, errno.ENOTDIR):
+            raise OSError(error, "{0}: {1}".format(os.strerror(error),
+                directory))
+
+
+    def _unwatch(self, directory):
+        '''
+        目录被移出扫描目录时取消监控其中的所有目录
+        '''
+        prefix = directory + os.sep
+        for wd, path in self._watches.items():
+            if path == directory or path.startswith(prefix):
+                self._rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+
+    def _add_tree(self, directory, changes):
+        '''
+        监控新出现的目录，目录中已有的文件视为变化的文件
+        '''
+        if not filemgr.is_target_dir(directory):
+            return
+
+        self._watch(directory)
+        for path, is_dir in filemgr.walk_tree(directory):
+            if is_dir:
+                self._watch(path)
+            else:
+                changes.add(path)
+
+
+    def _parse(self, data, changes):
+        '''
+        解析inotify事件，变化的路径加入changes
+        @returns:
+            事件队列是否溢出
+        '''
+        overflow = False
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+
+            path = os.path.join(directory, name)
+            changes.add(path)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path, changes)
+                elif mask & IN_MOVED_FROM:
+                    self._unwatch(path)
+
+        return overflow
+
+
+    def wait(self):
+        '''
+        等待文件变化
+        @returns:
+            变化的路径集合，包括新建、修改、删除的文件和目录；
+            事件队列溢出时返回None，需要重新扫描所有文件
+        '''
+        changes = set()
+        overflow = False
+
+        timeout = None
+        while select.select([self._fd], [], [], timeout)[0]:
+            overflow = self._parse(os.read(self._fd, 65536), changes) or \
+                overflow
+            timeout = self.DEBOUNCE
+
+        return None if overflow else changes
+
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+
+class PollingWatcher(object):
+    '''
+    定时遍历扫描目录，通过文件大小、修改时间判断文件变化，用于不支持inotify的系统
+    '''
+    def __init__(self, interval):
+        self._interval = interval
+        self._snapshot = self._take()
+
+
+    def _take(self):
+        snapshot = {}
+        for path, is_dir in filemgr.walk_tree():
+            if is_dir:
+                continue
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_size, stat.st_mtime)
+
+        return snapshot
+
+
+    def wait(self):
+        while True:
+            time.sleep(self._interval)
+
+            snapshot = self._take()
+            changes = set(path for path, stat in snapshot.iteritems() \
+                if self._snapshot.get(path) != stat)
+            changes.update(path for path in self._snapshot \
+                if path not in snapshot)
+
+            self._snapshot = snapshot
+            if changes:
+                return changes
+
+
+    def sync(self):
+        '''
+        重新遍历扫描目录，用于忽略规则变化之后
+        '''
+        self._snapshot = self._take()
+
+
+    def close(self):
+        pass
+
+
+
+def create_watcher(interval=1.0):
+    '''
+    优先使用inotify监控文件变化，不支持inotify或者超出监控数量限制时定时遍历扫描目录
+    @params:
+        interval: 定时遍历的间隔，秒
+    '''
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as error:
+            Out.wraning("inotify unavailable ({0}), polling every {1}s".format(
+                error, interval))
+
+    return PollingWatcher(interval)
+
+
+
+def issue_key(issue):
+    '''
+    同一个文件中区分issue的标识
+        不包括行号，文件中其他位置的修改导致行号变化时仍然是同一个issue
+    '''
+    return issue['ID'], issue['pattern'], \
+        matched_line(issue['context'], issue['lineno']).strip()
+
+
+
+class LiveIssues(object):
+    '''
+    当前所有文件的issue，文件重新扫描之后对比得到新增、变化、解决的issue
+    '''
+    def __init__(self):
+        # {filename: {key: issue}}
+        self._files = {}
+
+
+    def __len__(self):
+        return sum(len(issues) for issues in self._files.itervalues())
+
+
+    @property
+    def filenames(self):
+        return self._files.keys()
+
+
+    def update(self, filename, issues):
+        '''
+        @params:
+            issues: 文件重新扫描的结果，文件删除时为空
+        @returns:
+            [(event, issue, previous), ...]
+            event 为 added/changed/resolved，previous 为变化之前的issue
+        '''
+        current = {}
+        occurrences = {}
+        for issue in issues:
+            key = issue_key(issue)
+            # 同一行代码出现多次时按照出现顺序区分
+            occurrence = occurrences[key] = occurrences.get(key, -1) + 1
+            current[key + (occurrence,)] = issue
+
+        previous = self._files.pop(filename, {})
+        if current:
+            self._files[filename] = current
+
+        events = []
+        for key, issue in current.iteritems():
+            old = previous.get(key)
+            if old is None:
+                events.append(("added", issue, None))
+            elif old['lineno'] != issue['lineno'] or \
+                old['severity'] != issue['severity'] or \
+                old['confidence'] != issue['confidence']:
+                events.append(("changed", issue, old))
+
+        for key, issue in previous.iteritems():
+            if key not in current:
+                events.append(("resolved", issue, None))
+
+        events.sort(key=lambda x: int(x[1]['lineno']))
+
+        return events
+
+
+
+class _FileIssues(object):
+    '''
+    按照文件收集一次扫描产生的issue的sink
+    '''
+    def __init__(self):
+        self.files = {}
+
+    def write(self, issue):
+        self.files.setdefault(issue['filename'], []).append(issue)
+
+
+
+class ConsoleEventWriter(object):
+    '''
+    在控制台输出issue变化
+    '''
+    _MARKS = {
+        'added': ("+", Out.R),
+        'changed': ("~", Out.Y),
+        'resolved': ("-", Out.G),
+    }
+
+    def write(self, event, issue, previous):
+        mark, color = self._MARKS[event]
+
+        location = u"{0}:{1}".format(issue['filename'], issue['lineno'])
+        if previous is not None:
+            location = location + u" (was {0})".format(previous['lineno'])
+
+        print color(u"[{0}] {1:<6} [{2}:{3}] {4}".format(mark,
+            severity_map[issue['severity']][0].capitalize(), issue['ID'],
+            issue['name'], location))
+
+
+    def summary(self, info):
+        Out.info(u"{clock} scanned {files} files in {elapsed:.3f}s, "
+            u"{issues} issues (+{added} ~{changed} -{resolved})".format(
+            clock=time.strftime("%H:%M:%S", time.localtime(info['time'])),
+            **info))
+
+
+    def close(self):
+        pass
+
+
+
+class JsonlEventWriter(object):
+    '''
+    以JSON Lines格式输出issue变化，每行一个事件，便于编辑器、CI等工具读取
+    '''
+    def __init__(self, filename):
+        if filename == "-":
+            self._file = sys.stdout
+        else:
+            try:
+                self._file = open(filename, "a")
+            except IOError:
+                raise FileError("can not open file '{0}'".format(filename))
+
+
+    def _dump(self, data):
+        self._file.write(json.dumps(data) + "\n")
+        self._file.flush()
+
+
+    def write(self, event, issue, previous):
+        data = {'event': event, 'time': time.time(), 'issue': issue.to_dict()}
+        if previous is not None:
+            data['previous'] = {'lineno': previous['lineno'],
+                'severity': previous['severity'],
+                'confidence': previous['confidence']}
+
+        self._dump(data)
+
+
+    def summary(self, info):
+        self._dump(dict(info, event="scan"))
+
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+
+class WatchSession(object):
+    '''
+    监控模式
+        首先扫描整个目录，之后监控文件变化，只重新扫描变化的文件，
+        规则只加载一次，输出新增、变化、解决的issue
+    '''
+    def __init__(self, analyzer, writer, interval=1.0):
+        '''
+        @params:
+            analyzer: 已经初始化的 Analyzer
+            writer:   事件输出，ConsoleEventWriter/JsonlEventWriter
+            interval: 不支持inotify时定时遍历的间隔，秒
+        '''
+        self._analyzer = analyzer
+        self._writer = writer
+        self._interval = interval
+
+        self._live = LiveIssues()
+        self._watcher = None
+
+
+    def _scan(self, targets, removed):
+        '''
+        扫描文件，输出issue变化
+        @params:
+            targets: 需要扫描的文件，[(filename, scope), ...]，为None时扫描整个目录
+            removed: 删除或者不再需要扫描的文件
+        '''
+        start = timer()
+
+        if targets is None:
+            targets = list(filemgr.walk_targets())
+        elif not targets and not removed:
+            return
+
+        issuemgr.reset()
+        sink = _FileIssues()
+        issuemgr.register(sink)
+
+        self._analyzer.scan(targets=targets)
+
+        scanned = [filename for filename, scope in targets]
+
+        for warning in issuemgr.warnings:
+            Out.wraning(u"{0} @{1}".format(warning[3], warning[0]))
+
+        counts = {'added': 0, 'changed': 0, 'resolved': 0}
+        for filename in sorted(set(scanned) | set(removed)):
+            for event, issue, previous in self._live.update(filename,
+                sink.files.get(filename, [])):
+                counts[event] += 1
+                self._writer.write(event, issue, previous)
+
+        self._writer.summary(dict(counts, time=time.time(),
+            files=len(scanned), elapsed=timer() - start,
+            issues=len(self._live)))
+
+
+    def _rescan(self):
+        '''
+        重新扫描整个目录，例如忽略文件变化、事件丢失时
+            先按照新的忽略规则更新监控的目录，再扫描，扫描期间的变化不会丢失
+        '''
+        filemgr.init()
+        self._watcher.sync()
+        self._scan(None, self._live.filenames)
+
+
+    def _update(self, changes):
+        targets = []
+        removed = []
+
+        live = self._live.filenames
+        for path in changes:
+            scope = filemgr.target_scope(path)
+            if scope:
+                targets.append((path, scope))
+            elif not os.path.isdir(path):
+                # 删除的文件、目录，或者不再需要扫描的文件
+                prefix = path + os.sep
+                removed.extend(f for f in live \
+                    if f == path or f.startswith(prefix))
+
+        targets.sort()
+        self._scan(targets, removed)
+
+
+    def run(self):
+        self._scan(None, [])
+
+        watcher = self._watcher = create_watcher(self._interval)
+        try:
+            while True:
+                changes = watcher.wait()
+
+                if changes is None or any(os.path.basename(path) in \
+                    IGNORE_FILES for path in changes):
+                    self._rescan()
+                else:
+                    self._update(changes)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            self._writer.close()
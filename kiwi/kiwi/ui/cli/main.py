@@ -14,9 +14,6 @@ import argparse
 
 from kiwi.core.common import conf
 from kiwi.core.common import Out
-from kiwi.core.analyzer import Analyzer
-from kiwi.core.reporter import get_reporter
-from kiwi.core.reporter import ConsoleReporter
 
 
 
@@ -58,7 +55,82 @@ class IDParamParser(argparse.Action):
 
 
 
+def rules_main(argv):
+    '''
+    kiwi rules 子命令，管理漏洞特征
+    '''
+    out = Out()
+    out.init(u"Kiwi 漏洞特征检查")
+
+    parser = argparse.ArgumentParser(prog="kiwi rules",
+        description=u"Kiwi. 漏洞特征管理")
+    subparsers = parser.add_subparsers(dest="command")
+
+    lint_parser = subparsers.add_parser("lint",
+        help=u"检查漏洞特征中可能出现灾难性回溯的正则")
+    lint_parser.add_argument("-f", "--feature_dir", help=u"指定漏洞特征定义目录")
+    lint_parser.add_argument("-i", "--feature_ids", nargs="+",
+        action=IDParamParser, help=u"指定检查哪些漏洞特征")
+
+    args = parser.parse_args(argv)
+
+    conf.init_args(args)
+
+    from kiwi.core.lint import lint_features
+
+    count = 0
+    for feature_file, ID, pattern, message in lint_features():
+        count += 1
+        Out.wraning(u"{0} {1}: {2}".format(os.path.basename(feature_file),
+            ID, message))
+        print u"    {0}".format(pattern).encode("utf-8")
+
+    out.info(u"检查完成，发现 {0} 个问题".format(count))
+    out.close()
+
+    if count:
+        sys.exit(1)
+
+
+
+def watch_main(out):
+    '''
+    监控模式，规则只加载一次，持续输出漏洞变化
+    '''
+    from kiwi.core.analyzer import Analyzer
+    from kiwi.core.watcher import WatchSession
+    from kiwi.core.watcher import ConsoleEventWriter
+    from kiwi.core.watcher import JsonlEventWriter
+
+    if conf.outputs or conf.since or conf.profile:
+        Out.wraning("--watch reports changes as events, ignoring "
+            "--outputs/--since/--profile")
+        conf.outputs = conf.since = conf.profile = None
+
+    if conf.events:
+        writer = JsonlEventWriter(conf.events)
+    else:
+        writer = ConsoleEventWriter()
+
+    out.info(u"kiwi 监控 {0} ...".format(conf.target))
+
+    analyzer = Analyzer()
+    analyzer.init()
+
+    WatchSession(analyzer, writer, conf.interval).run()
+
+    out.close()
+
+
+
 def main():
+    if sys.argv[1:2] == ["rules"]:
+        return rules_main(sys.argv[2:])
+
+    if sys.argv[1:2] == ["serve"]:
+        from kiwi.ui.cli.serve import main as serve_main
+        return serve_main(sys.argv[2:])
+
     out = Out()
     out.init(u"Kiwi 代码安全扫描")
 
@@ -75,12 +147,43 @@ def main():
         help=u"指定忽略扫描哪些类型文件，例如--igexts php js则忽略扫描.php .js文件")
     parser.add_argument("--excludes", nargs="+",
         help=u"忽略扫描文件路径包含关键字的文件")
+    parser.add_argument("--noignore", action="store_true",
+        help=u"不使用.gitignore/.kiwiignore文件忽略文件")
     parser.add_argument("-c", "--sctx", type=int, default=2,
         help=u"指定扫描结果显示的上下文行数")
     parser.add_argument("--ectx", type=int, default=10,
         help=u"指定用于评估漏洞所需的上下文信息的文件行数")
     parser.add_argument("-o", "--outputs", nargs="+",
-        help=u"指定输出报告文件，支持.txt/.html/.json/.db")
+        help=u"指定输出报告文件，支持.txt/.html/.json/.jsonl/.sarif/.db")
+    parser.add_argument("--wal", action="store_true",
+        help=u"生成.db报告时使用WAL日志模式")
+    parser.add_argument("--summary", action="store_true",
+        help=u"在.db报告中维护统计信息汇总表，加快大报告的统计")
+    parser.add_argument("--baseline", metavar="DB",
+        help=u"和基线.db报告对比，.db报告中基线已有的漏洞标记为老漏洞，保留基线中的误报"
+        u"标记和备注，基线中已修复的漏洞保存到FixedIssues表")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help=u"指定扫描进程数，默认为1，0表示使用所有CPU")
+    parser.add_argument("--cache", nargs="?", const=True,
+        help=u"启用增量扫描缓存，可指定缓存文件，未变化的文件直接使用上次的扫描结果")
+    parser.add_argument("--norulepack", action="store_true",
+        help=u"不使用编译好的规则包缓存，每次重新解析特征文件、编译正则")
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+        help=u"单个文件的扫描时间上限，超时后逐个正则重新扫描，跳过超时的正则")
+    parser.add_argument("--pattern_timeout", type=float, metavar="SECONDS",
+        help=u"逐个正则重新扫描时单个正则的时间上限，默认与--timeout相同")
+    parser.add_argument("--profile", nargs="?", const="kiwi_profile.json",
+        metavar="PATH", help=u"统计每个漏洞特征、正则的耗时，输出耗时排序表，"
+        u"并将统计结果保存为JSON文件，默认为kiwi_profile.json")
+    parser.add_argument("--since", metavar="GIT_REF",
+        help=u"只扫描相对于git提交GIT_REF新增、修改的文件，只报告修改的行附近的漏洞")
+    parser.add_argument("--watch", action="store_true",
+        help=u"监控模式，扫描之后监控目录中的文件变化，只重新扫描变化的文件，"
+        u"输出新增、变化、解决的漏洞")
+    parser.add_argument("--events", metavar="PATH",
+        help=u"监控模式下以JSON Lines格式输出漏洞变化到文件，-表示标准输出")
+    parser.add_argument("--interval", type=float, default=1.0,
+        help=u"监控模式下不支持inotify时遍历目录的间隔，秒，默认为1")
     parser.add_argument("-v", "--verbose", action="store_true",
         help=u"详细模式，输出扫描过程信息")
     
@@ -88,17 +191,47 @@ def main():
 
     conf.init_args(args)
 
+    if conf.watch:
+        return watch_main(out)
+
+    if conf.baseline:
+        if not os.path.isfile(conf.baseline):
+            out.error(u"找不到基线报告 {0}".format(conf.baseline))
+            sys.exit(1)
+        if not [o for o in conf.outputs or [] if o.endswith(".db")]:
+            Out.wraning("--baseline only applies to .db reports")
+
+    # 扫描引擎、报告在解析参数之后再导入，只导入需要的报告依赖
+    from kiwi.core.analyzer import Analyzer
+    from kiwi.core.issuemgr import issuemgr
+    from kiwi.core.reporter import get_reporter
+    from kiwi.core.reporter import ConsoleReporter
+
     out.info(u"kiwi 扫描 {0} ...".format(conf.target, ))
+
+    # 报告边扫描边输出
+    if conf.outputs:
+        reporters = [get_reporter(name) for name in conf.outputs]
+    else:
+        reporters = [ConsoleReporter(None)]
+
+    for reporter in reporters:
+        reporter.start()
+        issuemgr.register(reporter)
+
     Analyzer().analyze()
 
     if conf.outputs:
         out.info(u"kiwi 生成报告 {0}".format(",".join(conf.outputs)))
-        for report_name in conf.outputs:
-            reporter = get_reporter(report_name)
-            reporter.report()
-    else:
-        reporter = ConsoleReporter(None)
-        reporter.report()
+    for reporter in reporters:
+        reporter.finish()
+
+    if conf.profile:
+        from kiwi.core.profiler import profiler
+
+        profiler.save(conf.profile)
+        out.info(u"kiwi 性能分析结果 {0}".format(conf.profile))
+        print profiler.format_table().encode("utf-8")
 
     out.close()
 
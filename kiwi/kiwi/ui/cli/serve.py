@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+
+kiwi serve，常驻的扫描服务
+    规则只加载一次，文件的扫描结果缓存在内存中，编辑器、git hook 通过本地HTTP调用：
+
+    GET  /ping                  服务状态
+    POST /scan/file             {"filename": 文件}
+    POST /scan/tree             {"target": 目录, "excludes": [...], "extensions": [...],
+                                 "igexts": [...], "noignore": false, "since": null,
+                                 "format": "txt"}
+                                format 为 txt 时结果中的 report 为文本格式的报告
+    GET  /issues?target=&filename=&severity=
+                                查询最近一次扫描的结果
+    POST /shutdown              停止服务
+'''
+
+
+import os
+import sys
+import json
+import socket
+import argparse
+import urlparse
+from cStringIO import StringIO
+import SocketServer
+import BaseHTTPServer
+from timeit import default_timer as timer
+
+from kiwi.core.common import conf
+from kiwi.core.common import Out
+from kiwi.core.analyzer import Analyzer
+from kiwi.core.issuemgr import issuemgr
+from kiwi.core.filemgr import filemgr
+from kiwi.core.cache import MemoryScanCache
+from kiwi.core.exception import KiwiError
+from kiwi.core.constant import severity_map
+
+
+
+class _Collector(object):
+    '''
+    收集一次扫描产生的所有issue的sink
+    '''
+    def __init__(self):
+        self.issues = []
+
+    def write(self, issue):
+        self.issues.append(issue.to_dict())
+
+
+
+class ScanService(object):
+    '''
+    扫描服务
+        所有请求在同一个线程中依次处理，扫描引擎的全局状态不需要加锁
+    '''
+    # 每次扫描可以覆盖的参数
+    _SCAN_OPTIONS = ('excludes', 'extensions', 'igexts', 'noignore', 'since')
+    # 取值必须为列表的参数
+    _LIST_OPTIONS = ('excludes', 'extensions', 'igexts')
+
+    def __init__(self):
+        self._analyzer = Analyzer()
+        self._analyzer.init()
+
+        self._cache = MemoryScanCache()
+        # 每个扫描目标最近一次的扫描结果，{target: [issue, ...]}
+        self._results = {}
+
+        self.started = timer()
+        self.running = True
+
+
+    def ping(self, params):
+        return {
+            'status': "ok",
+            'pid': os.getpid(),
+            'uptime': timer() - self.started,
+            'cached_files': len(self._cache),
+        }
+
+
+    def scan_file(self, params):
+        filename = params.get('filename')
+        if not filename:
+            raise KiwiError("missing parameter 'filename'")
+
+        return self.scan_tree({'target': filename})
+
+
+    def scan_tree(self, params):
+        '''
+        扫描目录或文件，未变化的文件使用内存中的扫描结果
+        '''
+        target = params.get('target')
+        if not target:
+            raise KiwiError("missing parameter 'target'")
+
+        target = os.path.realpath(target)
+        if not os.path.exists(target):
+            raise KiwiError("cannot find target {0}".format(target))
+
+        for option in self._LIST_OPTIONS:
+            value = params.get(option)
+            if value is not None and (not isinstance(value, list) or \
+                not all(isinstance(v, basestring) for v in value)):
+                raise KiwiError("parameter '{0}' should be a list of "
+                    "strings".format(option))
+
+        conf.target = target
+        for option in self._SCAN_OPTIONS:
+            conf[option] = params.get(option)
+
+        start = timer()
+
+        issuemgr.reset()
+        filemgr.init()
+
+        collector = _Collector()
+        issuemgr.register(collector)
+
+        # 服务不写文件，报告内容通过结果返回，由调用者保存
+        reporter = None
+        report_format = params.get('format')
+        if report_format:
+            if report_format != "txt":
+                raise KiwiError("unsupported report format {0}".format(
+                    report_format))
+
+            from kiwi.core.reporter import TextReporter
+
+            report = StringIO()
+            reporter = TextReporter(None, report)
+            reporter.start()
+            issuemgr.register(reporter)
+
+        self._analyzer.scan(self._cache)
+
+        self._results[target] = collector.issues
+
+        result = {
+            'target': target,
+            'elapsed': timer() - start,
+            'lines': sum(filemgr.scope_statistics.values()),
+            'issues': collector.issues,
+            'warnings': [{'filename': w[0], 'ID': w[1], 'pattern': w[2],
+                'message': w[3]} for w in issuemgr.warnings],
+        }
+
+        if reporter:
+            reporter.finish()
+            result['report'] = report.getvalue().decode("utf-8")
+
+        return result
+
+
+    def query_issues(self, params):
+        '''
+        查询最近一次扫描的结果，target 为文件时查询包含该文件的扫描结果
+        '''
+        target = params.get('target')
+        if not target:
+            raise KiwiError("missing parameter 'target'")
+        target = os.path.realpath(target)
+
+        issues = self._results.get(target)
+        if issues is None:
+            prefix = target.rstrip(os.sep) + os.sep
+            for scanned, scanned_issues in self._results.iteritems():
+                if target.startswith(scanned.rstrip(os.sep) + os.sep):
+                    issues = [i for i in scanned_issues \
+                        if i['filename'] == target or \
+                        i['filename'].startswith(prefix)]
+                    break
+            else:
+                raise KiwiError("target {0} has not been scanned".format(
+                    target))
+
+        filename = params.get('filename')
+        if filename:
+            filename = os.path.realpath(filename)
+            issues = [i for i in issues if i['filename'] == filename]
+
+        severity = params.get('severity')
+        if severity:
+            levels = dict((v[0], k) for k, v in severity_map.items())
+            level = levels.get(severity.lower())
+            issues = [i for i in issues if i['severity'] == level]
+
+        return {'target': target, 'issues': issues}
+
+
+    def shutdown(self, params):
+        self.running = False
+        return {'status': "stopping"}
+
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    把HTTP请求转换为 ScanService 的调用，参数和结果都是JSON
+    '''
+    _ROUTES = {
+        ('GET', '/ping'): 'ping',
+        ('POST', '/scan/file'): 'scan_file',
+        ('POST', '/scan/tree'): 'scan_tree',
+        ('GET', '/issues'): 'query_issues',
+        ('POST', '/shutdown'): 'shutdown',
+    }
+
+    def _send(self, code, data):
+        body = json.dumps(data)
+
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _params(self, url):
+        params = dict((k, v[-1]) for k, v in \
+            urlparse.parse_qs(url.query).iteritems())
+
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            # 只接受JSON请求，跨域发送JSON请求需要经过预检
+            content_type = self.headers.getheader('content-type') or ""
+            if content_type.split(";")[0].strip().lower() != \
+                "application/json":
+                raise ValueError("request body should be application/json")
+
+            body = json.loads(self.rfile.read(length))
+            if not isinstance(body, dict):
+                raise ValueError("request body should be a JSON object")
+            params.update(body)
+
+        return params
+
+
+    def _handle(self, method):
+        # 浏览器中的网页可以向本地服务发送跨域请求，拒绝所有带 Origin 的请求
+        if self.headers.getheader('origin') is not None:
+            self._send(403, {'error': "cross-origin requests are not allowed"})
+            return
+
+        # DNS rebinding 的网页发出的同源请求没有 Origin，Host 为攻击者的域名
+        hosts = self.server.allowed_hosts
+        if hosts is not None and \
+            (self.headers.getheader('host') or "").lower() not in hosts:
+            self._send(403, {'error': "host is not allowed"})
+            return
+
+        url = urlparse.urlparse(self.path)
+        name = self._ROUTES.get((method, url.path))
+        if name is None:
+            self._send(404, {'error': "unknown api {0} {1}".format(method,
+                url.path)})
+            return
+
+        try:
+            result = getattr(self.server.service, name)(self._params(url))
+        except (KiwiError, ValueError) as error:
+            self._send(400, {'error': str(error)})
+            return
+        except Exception as error:
+            Out.error(u"{0} failed: {1}".format(url.path, error))
+            self._send(500, {'error': str(error)})
+            return
+
+        self._send(200, result)
+
+
+    def do_GET(self):
+        self._handle('GET')
+
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+    def address_string(self):
+        # Unix socket 的客户端地址为空
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+
+    def log_message(self, format, *args):
+        if conf.verbose:
+            Out.info(u"{0} {1}".format(self.address_string(), format % args))
+
+
+
+class ServiceServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ServiceHandler)
+        self.service = service
+
+        # 请求的 Host 只能是本机地址加监听端口
+        ip, port = self.server_address[:2]
+        hosts = ["localhost", "127.0.0.1"]
+        if ip not in ("", "0.0.0.0"):
+            hosts.append(ip)
+        self.allowed_hosts = frozenset("{0}:{1}".format(host, port) \
+            for host in hosts)
+
+
+
+class UnixServiceServer(SocketServer.UnixStreamServer):
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.remove(path)
+
+        SocketServer.UnixStreamServer.__init__(self, path, ServiceHandler)
+        self.service = service
+
+        # BaseHTTPRequestHandler 需要的属性
+        self.server_name = "localhost"
+        # 浏览器不能访问 Unix socket，不检查 Host
+        self.allowed_hosts = None
+        self.server_port = 0
+
+
+
+def main(argv):
+    out = Out()
+    out.init(u"Kiwi 扫描服务")
+
+    parser = argparse.ArgumentParser(prog="kiwi serve",
+        description=u"Kiwi. 常驻的扫描服务，通过本地HTTP调用")
+
+    parser.add_argument("-f", "--feature_dir", help=u"指定漏洞特征定义目录")
+    parser.add_argument("-i", "--feature_ids", nargs="+",
+        help=u"指定加载哪些漏洞特征")
+    parser.add_argument("-p", "--port", type=int, default=7001,
+        help=u"指定监听端口，默认为7001")
+    parser.add_argument("--ip", default="127.0.0.1",
+        help=u"指定监听IP，默认为127.0.0.1")
+    parser.add_argument("--socket", help=u"监听Unix socket，而不是TCP端口")
+    parser.add_argument("-c", "--sctx", type=int, default=2,
+        help=u"指定扫描结果显示的上下文行数")
+    parser.add_argument("--ectx", type=int, default=10,
+        help=u"指定用于评估漏洞所需的上下文信息的文件行数")
+    parser.add_argument("--norulepack", action="store_true",
+        help=u"不使用编译好的规则包缓存")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help=u"详细模式，输出请求信息")
+
+    args = parser.parse_args(argv)
+
+    conf.init_args(args)
+    # 服务在单个进程中扫描
+    conf.jobs = 1
+
+    service = ScanService()
+
+    try:
+        if args.socket:
+            server = UnixServiceServer(args.socket, service)
+            address = args.socket
+        else:
+            server = ServiceServer((args.ip, args.port), service)
+            address = "http://{0}:{1}".format(args.ip, args.port)
+    except socket.error as error:
+        out.error(u"监听 {0} 失败: {1}".format(args.socket or args.port,
+            error))
+        sys.exit(1)
+
+    out.info(u"kiwi 扫描服务 {0}".format(address))
+
+    try:
+        while service.running:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+    out.close()
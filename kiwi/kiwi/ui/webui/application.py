@@ -11,36 +11,92 @@ Copyright (c) 2016 alpha1e0
 
 import os
 import json
+import calendar
+from datetime import datetime
 
 from flask import Flask
 from flask import request
 from flask import render_template
 from flask import redirect
 from flask import url_for
+from flask import jsonify
 
-from kiwi.core.issuemgr import IssueDatabase
+from kiwi.core.exception import DatabaseError
 from kiwi.core.constant import status_map, severity_map, confidence_map
 from kiwi.core.constant import High, Medium, Low, Info
 from kiwi.core.constant import New, Old, Falsep
 
+from reports import ReportIndex
+
 
 
 application = Flask(__name__)
 
 application.report_path = None
 
+# /api/issues 每页默认、最多返回的issue个数
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+
+# {report_path: ReportIndex}
+_report_indexes = {}
+
+
+
+def get_report_index(report_path):
+    '''
+    获取报告目录索引，缓存报告列表和数据库连接
+    '''
+    if report_path not in _report_indexes:
+        _report_indexes[report_path] = ReportIndex(report_path)
+
+    return _report_indexes[report_path]
 
 
 def get_reports(report_path, current_report=None):
-    reports = []
+    return get_report_index(report_path).names
+
+
+def not_modified(etag, last_modified):
+    '''
+    判断客户端缓存的页面是否仍然有效，优先使用ETag判断
+    '''
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
 
-    for name in os.listdir(report_path):
-        if name.endswith(".db"):
-            reports.append(name[:-3])
+    if request.if_modified_since:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        return int(last_modified) <= since
 
-    reports.sort()
+    return False
 
-    return reports
+
+def cacheable(response, etag, last_modified):
+    '''
+    设置ETag/Last-Modified，客户端每次都需要重新验证
+    '''
+    response.set_etag(etag)
+    response.last_modified = datetime.utcfromtimestamp(int(last_modified))
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def conditional(etag, last_modified, view):
+    '''
+    客户端缓存有效时返回304，否则调用view生成页面
+    '''
+    if not_modified(etag, last_modified):
+        response = application.response_class(status=304)
+    else:
+        response = application.make_response(view())
+
+    if response.status_code in (200, 304):
+        cacheable(response, etag, last_modified)
+
+    return response
 
 
 
@@ -120,24 +176,151 @@ def view_report():
     except KeyError:
         current_report = None
 
-    reports = get_reports(application.report_path)
+    index = get_report_index(application.report_path)
+    reports = index.names
     current_report = current_report or reports[0]
 
-    report_file = os.path.join(application.report_path, current_report) + ".db"
-    rdb = IssueDatabase(report_file)
+    report = index.get(current_report)
+    if report is None:
+        return u"Error: cannot find report {0}".format(current_report), 404
+
+    # 报告列表也在页面中显示，报告目录变化时页面也需要更新
+    etag, last_modified = report.version()
+    etag = "{0}-{1!r}".format(etag, index.mtime)
+    last_modified = max(last_modified, index.mtime)
+
+    def _view():
+        with index.open(current_report) as rdb:
+            origin_scan_info = rdb.get_scan_info()[-1]
+            severity_info, status_info = rdb.statistics()
+
+        scan_info = get_scan_info(origin_scan_info, reports, current_report, 
+            severity_info, status_info)
+
+        # issue由页面通过 /api/issues 分页加载
+        return render_template('page.html', 
+            scaninfo=scan_info,
+            page_size=PAGE_SIZE)
+
+    return conditional(etag, last_modified, _view)
+
+
+def _api_error(message, code):
+    response = jsonify(error=message)
+    response.status_code = code
+
+    return response
+
+
+def _get_list_arg(key, type=unicode):
+    '''
+    获取列表参数，支持 key=a&key=b 以及 key=a,b 两种形式
+    '''
+    result = []
+    for value in request.args.getlist(key):
+        result.extend([type(x) for x in value.split(",") if x])
+
+    return result
+
+
+@application.route('/api/issues', methods=['GET'])
+def api_issues():
+    '''
+    分页查询issue
+        参数: name offset limit sort order(asc|desc) 
+              severity confidence status scope issueid filename(文件名前缀)
+    '''
+    index = get_report_index(application.report_path)
+    reports = index.names
+    current_report = request.args.get('name') or \
+        (reports[0] if reports else None)
+
+    report = index.get(current_report) if current_report else None
+    if report is None:
+        return _api_error(u"cannot find report {0}".format(current_report),
+            404)
+
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+
+        severity = _get_list_arg('severity', int)
+        confidence = _get_list_arg('confidence', int)
+        status = _get_list_arg('status', int)
+    except ValueError:
+        return _api_error(u"invalid parameter", 400)
+
+    sort = request.args.get('sort', 'id')
+    desc = request.args.get('order', 'asc') == 'desc'
+
+    def _view():
+        with index.open(current_report) as rdb:
+            try:
+                total, origin_issues = rdb.query_issues(offset, limit, sort,
+                    desc,
+                    severity = severity,
+                    confidence = confidence,
+                    status = status,
+                    scope = request.args.get('scope'),
+                    issueid = _get_list_arg('issueid'),
+                    filename = request.args.get('filename'))
+            except DatabaseError as error:
+                return _api_error(unicode(error), 400)
+
+            scan_info = rdb.get_scan_info()[-1]
+
+        issues = get_formated_issues(origin_issues, scan_info)
+
+        return jsonify(total=total, offset=offset, limit=limit, issues=issues)
+
+    etag, last_modified = report.version()
+
+    return conditional(etag, last_modified, _view)
+
+
+@application.route('/api/search', methods=['GET'])
+def api_search():
+    '''
+    全文搜索issue，结果按照相关度排序
+        参数: name q(空格分隔的关键字) offset limit
+    '''
+    index = get_report_index(application.report_path)
+    reports = index.names
+    current_report = request.args.get('name') or \
+        (reports[0] if reports else None)
+
+    report = index.get(current_report) if current_report else None
+    if report is None:
+        return _api_error(u"cannot find report {0}".format(current_report),
+            404)
+
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return _api_error(u"invalid parameter", 400)
+
+    keywords = request.args.get('q', u"")
+
+    def _view():
+        with index.open(current_report) as rdb:
+            try:
+                total, origin_issues = rdb.search_issues(keywords, offset,
+                    limit)
+            except DatabaseError as error:
+                return _api_error(unicode(error), 400)
+
+            scan_info = rdb.get_scan_info()[-1]
 
-    origin_scan_info = rdb.get_scan_info()[-1]
-    severity_info, status_info = rdb.statistics()
+        issues = get_formated_issues(origin_issues, scan_info)
 
-    scan_info = get_scan_info(origin_scan_info, reports, current_report, 
-        severity_info, status_info)
+        return jsonify(total=total, offset=offset, limit=limit, issues=issues)
 
-    new_issues, old_issues, falsep_issues = rdb.get_classfied_issues()
-    issues = get_formated_issues(new_issues+old_issues+falsep_issues, scan_info)
+    etag, last_modified = report.version()
 
-    return render_template('page.html', 
-        scaninfo=scan_info,
-        issues=issues)
+    return conditional(etag, last_modified, _view)
 
 
 @application.route("/modify", methods=['POST'])
@@ -150,15 +333,21 @@ def modify():
     except KeyError:
         return "Error: missing parameter"
 
-    report_file = os.path.join(application.report_path, report_name) + ".db"
-    rdb = IssueDatabase(report_file)
+    index = get_report_index(application.report_path)
+    report = index.get(report_name)
+    if report is None:
+        return u"Error: cannot find report {0}".format(report_name)
 
-    if falsep:
+    if falsep == 'true':
         status = Falsep
     else:
         status = None
 
-    rdb.modify(issue_id, status, comment)
+    with report.lock:
+        try:
+            report.modify(issue_id, status, comment)
+        except DatabaseError as error:
+            return u"Error: {0}".format(unicode(error))
 
     return redirect(url_for('view_report', name=report_name))
 
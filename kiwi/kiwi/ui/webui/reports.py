@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+
+'''
+Kiwi, Security tool for auditing source code
+--------------------------------------------------------------------------------
+Copyright (c) 2016 alpha1e0
+'''
+
+
+import os
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from kiwi.core.issuemgr import IssueDatabase
+
+
+
+class Report(object):
+    '''
+    报告数据库
+        缓存数据库连接，报告文件被替换（inode变化）时重新连接
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        # eventlet 的协程在同一个线程中运行，数据库操作期间不会切换协程，
+        # 锁只用于多线程运行时保证同一时间只有一个线程使用连接
+        self.lock = threading.Lock()
+
+        # 本进程对报告的修改次数，用于生成ETag
+        self.revision = 0
+
+        self._database = None
+        self._inode = None
+
+
+    def _stat(self):
+        try:
+            return os.stat(self.filename)
+        except OSError:
+            return None
+
+
+    @property
+    def database(self):
+        stat = self._stat()
+        inode = (stat.st_dev, stat.st_ino) if stat else None
+
+        if self._database is None or inode != self._inode:
+            if self._database:
+                self._database.close()
+
+            self._database = IssueDatabase(self.filename, shared=True,
+                readonly=True)
+            self._inode = inode
+
+        return self._database
+
+
+    def modify(self, id, status=None, comment=""):
+        '''
+        修改issue的状态和备注
+            查看报告使用只读连接，修改时单独打开可写的连接，不升级旧版本的报告
+        '''
+        database = IssueDatabase(self.filename, upgrade=False)
+        try:
+            database.modify(id, status, comment)
+        finally:
+            database.close()
+
+        self.revision += 1
+
+
+    def version(self):
+        '''
+        报告的版本信息，报告文件（包括WAL日志）变化或者被修改时变化
+        @returns:
+            (etag, last_modified)  last_modified 为时间戳
+        '''
+        stats = [self._stat(), None]
+        try:
+            stats[1] = os.stat(self.filename + "-wal")
+        except OSError:
+            pass
+
+        info = [self.revision]
+        last_modified = 0
+        for stat in stats:
+            if stat:
+                info.extend([stat.st_ino, stat.st_size, stat.st_mtime])
+                last_modified = max(last_modified, stat.st_mtime)
+
+        etag = hashlib.md5(repr(info)).hexdigest()
+
+        return etag, last_modified
+
+
+    def close(self):
+        if self._database:
+            self._database.close()
+            self._database = None
+
+
+
+class ReportIndex(object):
+    '''
+    报告目录索引
+        缓存报告列表，报告目录的mtime变化时重新加载；缓存每个报告的数据库连接
+    '''
+    def __init__(self, report_path):
+        self.report_path = report_path
+
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._names = []
+        # {name: Report}
+        self._reports = {}
+
+
+    @property
+    def mtime(self):
+        return os.stat(self.report_path).st_mtime
+
+
+    @property
+    def names(self):
+        '''
+        按名称排序的报告列表
+        '''
+        mtime = self.mtime
+
+        with self._lock:
+            if mtime != self._mtime:
+                names = sorted([name[:-3] for name in \
+                    os.listdir(self.report_path) if name.endswith(".db")])
+
+                for name in set(self._reports) - set(names):
+                    self._reports.pop(name).close()
+
+                self._names = names
+                self._mtime = mtime
+
+            return list(self._names)
+
+
+    def get(self, name):
+        '''
+        获取报告，报告不存在时返回None
+        '''
+        if name not in self.names:
+            return None
+
+        with self._lock:
+            if name not in self._reports:
+                self._reports[name] = Report(
+                    os.path.join(self.report_path, name) + ".db")
+
+            return self._reports[name]
+
+
+    @contextmanager
+    def open(self, name):
+        '''
+        使用报告的数据库连接，with语句执行期间其它线程不能使用该连接
+        '''
+        report = self.get(name)
+        if report is None:
+            raise KeyError(name)
+
+        with report.lock:
+            yield report.database
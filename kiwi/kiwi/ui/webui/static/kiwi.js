@@ -0,0 +1,221 @@
+/*
+ * Kiwi, Security tool for auditing source code
+ * -----------------------------------------------------------------------------
+ * Copyright (c) 2016 alpha1e0
+ *
+ * 报告查看器：滚动页面时通过 /api/issues、/api/search 分页加载漏洞
+ */
+
+(function ($) {
+    'use strict';
+
+    var state = {
+        report: null,
+        pageSize: 50,
+        query: {},
+        offset: 0,
+        total: null,
+        loading: false,
+        // 过滤条件改变后，丢弃之前未完成的请求的结果
+        generation: 0
+    };
+
+    var HTML_ESCAPES = {
+        '&': '&amp;',
+        '<': '&lt;',
+        '>': '&gt;',
+        '"': '&quot;',
+        "'": '&#39;'
+    };
+
+    // 转义之后的文本也用于属性值，引号同样需要转义
+    function escapeHtml(text) {
+        return (text === null || text === undefined ? '' : String(text))
+            .replace(/[&<>"']/g, function (c) {
+                return HTML_ESCAPES[c];
+            });
+    }
+
+    function renderContext(issue) {
+        var html = '';
+
+        $.each(issue.context, function (i, line) {
+            var cls = line[0] == issue.lineno ? 'lineno-strong' : 'lineno';
+            html += "<i class='" + cls + "'>" + escapeHtml(line[0]) +
+                ": </i>" + escapeHtml(line[1]);
+        });
+
+        return html;
+    }
+
+    function renderIssue(issue) {
+        var falsep = issue.status == 1;
+        var id = escapeHtml(issue.id);
+
+        return "<div class='issue' id='" + id + "'>" +
+            "<div class='issue-block'>" +
+                "<div class='issue-label'>" +
+                    "<span class='label label-id'><a class='issue-link' href='#" +
+                        id + "'>ISSUE-" + id + "</a></span> " +
+                    "<span class='label label-" +
+                        escapeHtml(issue.status_class) + "'>" +
+                        escapeHtml(issue.status_prompt) + "</span> " +
+                    "<span class='label label-" +
+                        escapeHtml(issue.severity_class) + "'>" +
+                        escapeHtml(issue.severity_prompt) + "</span> " +
+                    "<span class='label label-" +
+                        escapeHtml(issue.confidence_class) + "'>" +
+                        escapeHtml(issue.confidence_prompt) + "</span>" +
+                "</div>" +
+                "<div class='issue-title'>" +
+                    "<b>" + escapeHtml(issue.issueid) + ": </b> " +
+                    escapeHtml(issue.name) + "<br>" +
+                "</div>" +
+                "<b>匹配关键字: </b><ins class='issue-pattern'>" +
+                    escapeHtml(issue.pattern) + "</ins>&nbsp&nbsp" +
+                "<b>目标文件: </b><a href='" + escapeHtml(issue.filelink) +
+                    "' target='_blank'>" + escapeHtml(issue.filename) +
+                    "</a><br />" +
+                "<div class='context'><pre>" + renderContext(issue) +
+                    "</pre></div>" +
+            "</div>" +
+            "<div class='issue-handle'>" +
+                "<form action='/modify' method='post'>" +
+                    "<input type='radio' name='falsep' value='true'" +
+                        (falsep ? " checked='true'" : "") + ">误报 " +
+                    "<input type='radio' name='falsep' value='false'" +
+                        (falsep ? "" : " checked='true'") + ">非误报" +
+                    "&nbsp&nbsp&nbsp&nbsp备注：<input type='text' " +
+                        "name='comment' placeholder='备注信息' value='" +
+                        escapeHtml(issue.comment) + "'> " +
+                    "<input type='text' name='name' value='" +
+                        escapeHtml(state.report) + "' hidden='true'>" +
+                    "<input type='text' name='id' value='" + id +
+                        "' hidden='true'>" +
+                    "<input type='submit' value='提交'>" +
+                "</form>" +
+            "</div>" +
+        "</div>";
+    }
+
+    function hasMore() {
+        return state.total === null || state.offset < state.total;
+    }
+
+    function nearBottom() {
+        return $(window).scrollTop() + $(window).height() >=
+            $(document).height() - 600;
+    }
+
+    function loadMore() {
+        if (state.loading || !hasMore()) {
+            return;
+        }
+
+        var generation = state.generation;
+        var params = $.extend({
+            name: state.report,
+            offset: state.offset,
+            limit: state.pageSize
+        }, state.query);
+
+        state.loading = true;
+        $('#loading').text('加载中...');
+
+        // 输入了搜索关键字时使用全文搜索，结果按照相关度排序
+        var url = state.query.q ? '/api/search' : '/api/issues';
+
+        $.getJSON(url, $.param(params, true))
+            .done(function (data) {
+                if (generation !== state.generation) {
+                    return;
+                }
+
+                var html = $.map(data.issues, renderIssue).join('');
+                $('#results').append(html);
+
+                state.total = data.total;
+                state.offset += data.issues.length;
+                if (!data.issues.length) {
+                    state.total = state.offset;
+                }
+
+                $('#issue-count').text(state.offset + ' / ' + state.total);
+                $('#loading').text('');
+            })
+            .fail(function (xhr) {
+                var message = xhr.responseJSON && xhr.responseJSON.error;
+                $('#loading').text('加载失败 ' + (message || xhr.status));
+                state.total = state.offset;
+            })
+            .always(function () {
+                if (generation !== state.generation) {
+                    return;
+                }
+
+                state.loading = false;
+
+                // 页面未填满时继续加载
+                if (hasMore() && nearBottom()) {
+                    loadMore();
+                }
+            });
+    }
+
+    function reload() {
+        var query = {};
+
+        $.each($('#filter').serializeArray(), function (i, field) {
+            var value = $.trim(field.value);
+            if (value) {
+                query[field.name] = value;
+            }
+        });
+
+        state.query = query;
+        state.offset = 0;
+        state.total = null;
+        state.loading = false;
+        state.generation += 1;
+
+        $('#results').empty();
+        $('#issue-count').text('');
+        loadMore();
+    }
+
+    $(function () {
+        var results = $('#results');
+
+        state.report = results.data('report');
+        state.pageSize = parseInt(results.data('page-size'), 10) ||
+            state.pageSize;
+
+        $('#filter').on('submit', function (event) {
+            event.preventDefault();
+            reload();
+        });
+
+        // 修改误报状态、备注后只更新当前issue，不重新加载页面
+        results.on('submit', '.issue-handle form', function (event) {
+            var form = $(this);
+            event.preventDefault();
+
+            $.post(form.attr('action'), form.serialize()).done(function () {
+                var falsep = form.find("input[name='falsep']:checked")
+                    .val() === 'true';
+                if (falsep) {
+                    form.closest('.issue').find('.label').eq(1)
+                        .attr('class', 'label label-low').text('误报漏洞');
+                }
+            });
+        });
+
+        $(window).on('scroll', function () {
+            if (nearBottom()) {
+                loadMore();
+            }
+        });
+
+        reload();
+    });
+})(jQuery);
@@ -10,10 +10,13 @@ Copyright (c) 2016 alpha1e0
 
 import os
 import re
+import json
 import yaml
 import time
 import threading
 import subprocess
+import urllib.request
+import urllib.error
 
 import sublime
 import sublime_plugin
@@ -554,8 +557,39 @@ class CacheFile(object):
 
 
 
+def server_request(api, data, timeout=60):
+    '''
+    调用 kiwi serve 扫描服务，未配置服务或者服务不可用时返回None，
+        服务返回错误时结果中的 error 为错误信息
+    @params:
+        api:  接口路径，例如 /scan/tree
+        data: 请求参数
+    '''
+    settings = sublime.load_settings(BTLIME_SETTING_FILE)
+    server = settings.get("kiwi_server", None)
+    if not server:
+        return None
+
+    request = urllib.request.Request(server.rstrip("/") + api,
+        data=json.dumps(data).encode(DEFAULT_ENCODING),
+        headers={"Content-Type": "application/json"})
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+        return json.loads(response.read().decode(DEFAULT_ENCODING))
+    except urllib.error.HTTPError as error:
+        # 服务返回的错误信息，例如扫描目标不存在
+        try:
+            return json.loads(error.read().decode(DEFAULT_ENCODING))
+        except ValueError:
+            return {"error": str(error)}
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+
+
+
 def analyze(view, btcmd, projdir, cachedir):
-    if btcmd:
+    if btcmd or sublime.load_settings(BTLIME_SETTING_FILE).get("kiwi_server"):
         bt_analyze(view, btcmd, projdir, cachedir)
     else:
         simple_analyze(view, projdir, cachedir)
@@ -571,12 +605,31 @@ def bt_analyze(view, btcmd, projdir, cachedir):
     if not os.path.exists(cachedir):
         os.mkdir(cachedir)
 
+    show_status("Running kiwi ...")
+
+    # 优先使用常驻的扫描服务，服务不可用时运行kiwi命令
+    result = server_request("/scan/tree", {"target": projdir,
+        "excludes": [cachename], "format": "txt"})
+    if result is not None:
+        if "error" in result:
+            show_error(result["error"])
+            return
+
+        with open(result_file, "w", encoding=DEFAULT_ENCODING) as _file:
+            _file.write(result["report"])
+
+        show_status("Bugtrack scan finished.")
+        view.window().open_file(result_file)
+        return
+
+    if not btcmd:
+        show_error("Can not connect to kiwi server")
+        return
+
     cmd = [btcmd, projdir, "--exclude", cachename,
         "-o", result_file]
     cmd = " ".join(cmd)
 
-    show_status("Running kiwi ...")
-
     shell = True
     try:
         output = subprocess.check_output(cmd, shell=shell)
@@ -956,3 +1009,41 @@ class OpenIssueDefCommand(sublime_plugin.TextCommand):
             idfile = os.path.join(current.pkgpath(), 'issuedef', 
                 entry['filename'])
             self.view.window().open_file(idfile)
+
+
+
+class ScanOnSaveListener(sublime_plugin.EventListener):
+    '''
+    保存文件时通过扫描服务扫描该文件，标记有漏洞的代码行
+        需要在配置文件中设置 kiwi_server 并打开 scan_on_save
+    '''
+    ISSUE_KEY = "kiwilime-saved-issue"
+    ISSUE_SCOPE = "invalid.illegal"
+
+    def on_post_save_async(self, view):
+        settings = sublime.load_settings(BTLIME_SETTING_FILE)
+        if not settings.get("scan_on_save", False):
+            return
+
+        filename = view.file_name()
+        if not filename:
+            return
+
+        result = server_request("/scan/file", {"filename": filename},
+            timeout=5)
+        if result is None or "error" in result:
+            return
+
+        regions = []
+        for issue in result["issues"]:
+            try:
+                lineno = int(issue["lineno"])
+            except (KeyError, ValueError):
+                continue
+            if lineno > 0:
+                regions.append(view.line(view.text_point(lineno - 1, 0)))
+
+        view.add_regions(self.ISSUE_KEY, regions, self.ISSUE_SCOPE, "dot",
+            sublime.DRAW_NO_FILL)
+        show_status("kiwi: {0} issues in {1}".format(len(result["issues"]),
+            os.path.basename(filename)))